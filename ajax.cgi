@@ -11,53 +11,20 @@ Version:    2011-02-07
 '''
 
 # Standard library imports
-from cgi import FieldStorage
-from os import environ
 from os.path import dirname
 from os.path import join as path_join
-from sys import path as sys_path, stdout
+from sys import path as sys_path
+from wsgiref.handlers import CGIHandler
 
 # Local imports
 sys_path.append(path_join(dirname(__file__), 'server/src'))
 
-from server import serve
+from wsgi import application
 
 def main(args):
-    # Get data required for server call
-    try:
-        remote_addr = environ['REMOTE_ADDR']
-    except KeyError:
-        remote_addr = None
-    try:
-        remote_host = environ['REMOTE_HOST']
-    except KeyError:
-        remote_host = None
-    try:
-        cookie_data = environ['HTTP_COOKIE']
-    except KeyError:
-        cookie_data = None
-
-    params = FieldStorage()
-
-    # Call main server
-    cookie_hdrs, response_data = serve(params, remote_addr, remote_host,
-            cookie_data)
-
-    # Package and send response
-    if cookie_hdrs is not None:
-        response_hdrs = [hdr for hdr in cookie_hdrs]
-    else:
-        response_hdrs = []
-    response_hdrs.extend(response_data[0])
-
-    stdout.write('\n'.join('%s: %s' % (k, v) for k, v in response_hdrs))
-    stdout.write('\n')
-    stdout.write('\n')
-    # Hack to support binary data and general Unicode for SVGs and JSON
-    if isinstance(response_data[1], unicode):
-        stdout.write(response_data[1].encode('utf-8'))
-    else:
-        stdout.write(response_data[1])
+    # The request parsing and response packaging are shared with the
+    # other entry points, see server/src/wsgi.py
+    CGIHandler().run(application)
     return 0
 
 def profile_main(argv):
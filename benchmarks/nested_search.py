@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Benchmark for searches restricted by annotation nesting
+# (nested_types) and embedding (restrict_types for text search),
+# comparing the server search implementation against a naive
+# all-pairs containment check. Run on nested-entity corpora in brat
+# standoff format such as GENIA or AnEM, or on a synthetic collection
+# (see synthetic.py) if no files are given.
+
+from __future__ import with_statement
+
+import os
+import sys
+
+from os.path import dirname, isdir, join as path_join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+# assume script in brat benchmarks/ directory, extend path to find search.py
+sys.path.append(path_join(dirname(__file__), '../server/src'))
+
+import search
+from annotation import TextAnnotations
+
+from synthetic import (add_arguments, collection_options,
+                       write_synthetic_collection)
+
+def argparser():
+    import argparse
+
+    ap = argparse.ArgumentParser(description='Benchmark nested annotation '
+                                 'search on brat standoff files.')
+    ap.add_argument('-n', '--nested', metavar='TYPE', nargs='+',
+                    default=None, help='Nested types to search for ' +
+                    '(default: all types)')
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help='Repetitions of each search (default 3)')
+    ap.add_argument('-s', '--synthetic', type=int, default=200,
+                    help='Number of synthetic documents to generate if ' +
+                    'no files are given (default 200)')
+    ap.add_argument('--no-naive', default=False, action='store_true',
+                    help='Skip the naive reference implementation')
+    add_arguments(ap)
+    ap.add_argument('files', metavar='FILE', nargs='*',
+                    help='Annotation files or directories')
+    return ap
+
+def document_paths(paths):
+    documents = []
+    for path in paths:
+        if isdir(path):
+            documents.extend(sorted(path_join(path, fn[:-4])
+                                    for fn in os.listdir(path)
+                                    if fn.endswith('.txt')))
+        else:
+            documents.append(os.path.splitext(path)[0])
+    return documents
+
+def naive_nested_textbounds(ann_objs, nested_types):
+    # the all-pairs check search_anns_for_textbound used originally
+    found = 0
+    for ann_obj in ann_objs:
+        for t in ann_obj.get_entities():
+            nested = [x for x in ann_obj.get_textbounds()
+                      if x != t and t.contains(x)]
+            if len([x for x in nested if x.type in nested_types]) != 0:
+                found += 1
+    return found
+
+def naive_embedded_text(ann_objs, text, restrict_types):
+    # the all-textbounds check search_anns_for_text used originally,
+    # with the span comparison done directly on offsets
+    regex = search._get_match_regex(text)
+    found = 0
+    for ann_obj in ann_objs:
+        for m in regex.finditer(ann_obj.get_document_text()):
+            for t in ann_obj.get_textbounds():
+                if t.type not in restrict_types:
+                    continue
+                if [1 for s, e in t.spans if s <= m.start() and m.end() <= e]:
+                    found += 1
+                    break
+    return found
+
+def timed(repeat, function, *args, **kwargs):
+    best, result = None, None
+    for i in xrange(repeat):
+        start = time()
+        result = function(*args, **kwargs)
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+
+    tmp_dir = None
+    try:
+        if args.files:
+            documents = document_paths(args.files)
+        else:
+            tmp_dir = mkdtemp()
+            write_synthetic_collection(tmp_dir, args.synthetic,
+                                       **collection_options(args))
+            documents = document_paths([tmp_dir])
+
+        ann_objs = [TextAnnotations(doc, read_only=True) for doc in documents]
+        textbound_num = sum(len(list(a.get_textbounds())) for a in ann_objs)
+        print 'Documents: %d, textbounds: %d' % (len(ann_objs), textbound_num)
+
+        nested_types = args.nested
+        if nested_types is None:
+            nested_types = sorted(set(t.type for a in ann_objs
+                                      for t in a.get_textbounds()))
+
+        results = []
+
+        elapsed, matches = timed(args.repeat, search.search_anns_for_textbound,
+                                 ann_objs, '', nested_types=nested_types,
+                                 max_matches=-1)
+        results.append(('textbound nested_types', elapsed, len(matches)))
+        if not args.no_naive:
+            elapsed, found = timed(args.repeat, naive_nested_textbounds,
+                                   ann_objs, nested_types)
+            results.append(('textbound nested_types (naive)', elapsed, found))
+
+        elapsed, matches = timed(args.repeat, search.search_anns_for_event,
+                                 ann_objs, '', [], nested_types=nested_types,
+                                 max_matches=-1)
+        results.append(('event nested_types', elapsed, len(matches)))
+
+        elapsed, matches = timed(args.repeat, search.search_anns_for_text,
+                                 ann_objs, 'the', restrict_types=nested_types,
+                                 max_matches=-1)
+        results.append(('text restrict_types', elapsed, len(matches)))
+        if not args.no_naive:
+            elapsed, found = timed(args.repeat, naive_embedded_text,
+                                   ann_objs, 'the', nested_types)
+            results.append(('text restrict_types (naive)', elapsed, found))
+
+        for name, elapsed, found in results:
+            print '%-32s %8.3fs %8d matches' % (name, elapsed, found)
+    finally:
+        if tmp_dir is not None:
+            rmtree(tmp_dir)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Benchmark of the brat server: generates a synthetic collection (see
+# synthetic.py) with a normalization DB for its proteins, replays a
+# random mix of client requests directly against server.serve() and
+# reports the throughput and latency percentiles per action. The
+# server runs with its own configuration in a temporary directory, so
+# no brat installation needs to be configured. With a fixed seed,
+# repeated searches are mostly answered from the search result caches;
+# use --no-cache to measure the searches themselves.
+
+from __future__ import with_statement
+
+import json
+import random
+import re
+import sys
+
+from os import listdir, makedirs
+from os.path import abspath, dirname, join as path_join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from synthetic import (add_arguments, collection_options,
+                       write_synthetic_collection, PROTEIN_NAMES, WORDS)
+
+BENCHMARK_DIR = abspath(dirname(__file__))
+BRAT_DIR = dirname(BENCHMARK_DIR)
+
+COLLECTION = '/bench/'
+NORM_DB = 'BenchNorm'
+USER, PASSWORD = 'bench', 'bench'
+
+CONFIG = '''\
+BASE_DIR = %(base)r
+DATA_DIR = %(data)r
+WORK_DIR = %(work)r
+ADMIN_CONTACT_EMAIL = 'benchmark@example.com'
+USER_PASSWORD = {%(user)r: %(password)r}
+DEBUG = False
+'''
+
+# Configuration added by --no-cache
+NO_CACHE_CONFIG = '''\
+SEARCH_CACHE_SIZE = 0
+NORM_SEARCH_CACHE_SIZE = 0
+'''
+
+TOOLS_CONF = '''\
+[normalization]
+
+%s	INDEX:ngram, <URL>:http://example.com/
+''' % NORM_DB
+
+# Relative frequencies of the actions in the default mix
+DEFAULT_MIX = 'getDocument=40,createSpan=10,createArc=5,' \
+    'getCollectionInformation=10,searchTextInCollection=10,' \
+    'searchEntityInCollection=10,searchEventInCollection=5,' \
+    'searchRelationInCollection=5,normSearch=5'
+
+PERCENTILES = (50, 90, 99)
+
+def argparser():
+    import argparse
+
+    ap = argparse.ArgumentParser(description='Benchmark the brat server ' +
+                                 'by replaying requests on a synthetic ' +
+                                 'collection.')
+    ap.add_argument('-n', '--documents', type=int, default=100,
+                    help='Number of documents (default 100)')
+    ap.add_argument('-r', '--requests', type=int, default=500,
+                    help='Number of requests to replay (default 500)')
+    ap.add_argument('-w', '--warmup', type=int, default=50,
+                    help='Number of requests to send before measuring ' +
+                    '(default 50)')
+    ap.add_argument('-m', '--mix', default=DEFAULT_MIX,
+                    help='Actions to replay with their relative ' +
+                    'frequencies (default %s)' % DEFAULT_MIX)
+    ap.add_argument('--seed', type=int, default=0,
+                    help='Random seed (default 0)')
+    ap.add_argument('-k', '--keep', metavar='DIR', default=None,
+                    help='Set up the server in given directory and do not ' +
+                    'remove it afterwards')
+    ap.add_argument('--no-cache', default=False, action='store_true',
+                    help='Run the server without its search result caches')
+    add_arguments(ap)
+    return ap
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        action, weight = item.split('=')
+        weights.append((action.strip(), float(weight)))
+    return weights
+
+def setup_server(directory, args):
+    '''
+    Writes the collection, normalization DB and configuration of the
+    benchmark server into the given directory and imports the server
+    with that configuration.
+    '''
+    data_dir = path_join(directory, 'data')
+    work_dir = path_join(directory, 'work')
+    collection_dir = path_join(data_dir, COLLECTION.strip('/'))
+    makedirs(work_dir)
+    write_synthetic_collection(collection_dir, args.documents, args.seed,
+                               **collection_options(args))
+    with open(path_join(collection_dir, 'tools.conf'), 'wb') as conf_file:
+        conf_file.write(TOOLS_CONF)
+
+    # normalization DB of the protein names, with some synonyms
+    norm_data = path_join(directory, 'norm.txt')
+    with open(norm_data, 'wb') as norm_file:
+        for i in xrange(1, PROTEIN_NAMES + 1):
+            print >> norm_file, 'ID%d\tname:Name:P%d\tname:Synonym:protein %d\t' \
+                'attr:Organism:%s' % (i, i, i, ('human', 'mouse')[i % 2])
+    sys.path.append(path_join(BRAT_DIR, 'tools'))
+    import norm_db_init
+    if norm_db_init.main(['norm_db_init.py', '-i', 'ngram', '-d',
+                          path_join(work_dir, NORM_DB), norm_data]) != 0:
+        raise RuntimeError('failed to create normalization DB')
+
+    # the server reads its configuration from the "config" module; the
+    # stats cache is only used if BASE_DIR contains a config.py
+    with open(path_join(directory, 'config.py'), 'wb') as config_file:
+        config_file.write(CONFIG % {
+                'base': directory,
+                'data': data_dir,
+                'work': work_dir,
+                'user': USER,
+                'password': PASSWORD,
+                })
+        if args.no_cache:
+            config_file.write(NO_CACHE_CONFIG)
+    sys.path.insert(0, directory)
+    sys.path.append(path_join(BRAT_DIR, 'server/src'))
+    # imported before the server checks for a config.py in BASE_DIR
+    import config
+    import server
+    return collection_dir
+
+class Params(dict):
+    # the part of the cgi.FieldStorage interface used by the server
+    def getvalue(self, key):
+        return self[key]
+
+class Client(object):
+    '''
+    Sends requests to the server like the brat client, keeping the
+    session cookie.
+    '''
+
+    def __init__(self):
+        self.cookie = None
+
+    def request(self, **params):
+        from server import serve
+
+        params['protocol'] = '1'
+        cookie_hdrs, (hdrs, body) = serve(Params(params), '127.0.0.1',
+                                          'localhost', self.cookie)
+        if cookie_hdrs is not None:
+            for name, value in cookie_hdrs:
+                if name == 'Set-Cookie':
+                    self.cookie = value.split(';')[0]
+        if dict(hdrs).get('Content-Type') != 'application/json':
+            # e.g. downloads
+            return {}
+        return json.loads(body)
+
+class RequestGenerator(object):
+    '''
+    Generates the parameters of random requests for the documents of
+    the synthetic collection.
+    '''
+
+    def __init__(self, collection_dir, rnd):
+        self.rnd = rnd
+        self.documents = sorted(fn[:-4] for fn in listdir(collection_dir)
+                                if fn.endswith('.txt'))
+        # per document: offsets of the words, and IDs of the Proteins
+        # and their possible Part-of targets
+        self.words, self.proteins, self.enclosing = {}, {}, {}
+        for doc in self.documents:
+            base = path_join(collection_dir, doc)
+            with open(base + '.txt') as txt_file:
+                self.words[doc] = [m.span() for m in
+                                   re.finditer(r'\S+', txt_file.read())]
+            proteins, enclosing = [], []
+            with open(base + '.ann') as ann_file:
+                for line in ann_file:
+                    fields = line.split('\t')
+                    if not fields[0].startswith('T'):
+                        continue
+                    ann_type = fields[1].split(' ')[0]
+                    if ann_type == 'Protein':
+                        proteins.append(fields[0])
+                    elif ann_type in ('Complex', 'Cell'):
+                        enclosing.append(fields[0])
+            self.proteins[doc] = proteins
+            self.enclosing[doc] = enclosing
+
+    def params(self, action):
+        rnd = self.rnd
+        doc = rnd.choice(self.documents)
+        params = {'action': action, 'collection': COLLECTION}
+        if action == 'getDocument':
+            params['document'] = doc
+        elif action == 'createSpan':
+            start, end = rnd.choice(self.words[doc])
+            params.update({
+                    'document': doc,
+                    'offsets': json.dumps([[start, end]]),
+                    'type': rnd.choice(('Protein', 'Complex', 'Cell')),
+                    })
+        elif action == 'createArc':
+            if not self.proteins[doc] or not self.enclosing[doc]:
+                return self.params('getDocument')
+            params.update({
+                    'document': doc,
+                    'origin': rnd.choice(self.proteins[doc]),
+                    'target': rnd.choice(self.enclosing[doc]),
+                    'type': 'Part-of',
+                    })
+        elif action.startswith('search'):
+            params['document'] = ''
+            if action == 'searchTextInCollection':
+                params['text'] = rnd.choice(WORDS)
+            elif action == 'searchEntityInCollection':
+                params['type'] = 'Protein'
+                params['text'] = 'P%d' % rnd.randint(1, PROTEIN_NAMES)
+            elif action == 'searchEventInCollection':
+                params['type'] = rnd.choice(('Binding', 'Regulation'))
+                params['trigger'] = rnd.choice(WORDS)
+                params['args'] = '[]'
+            elif action == 'searchRelationInCollection':
+                params['type'] = 'Part-of'
+        elif action == 'normSearch':
+            params.update({
+                    'database': NORM_DB,
+                    'name': rnd.choice(('P%d', 'protein %d', 'P%d human')) %
+                    rnd.randint(1, PROTEIN_NAMES),
+                    })
+        return params
+
+def percentile(sorted_values, p):
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def replay(client, generator, mix, request_num, rnd):
+    '''
+    Sends request_num random requests, returning the latencies by action
+    and the number of requests that failed.
+    '''
+    total = sum(weight for _, weight in mix)
+    latencies, errors = {}, {}
+    for i in xrange(request_num):
+        r = rnd.random() * total
+        for action, weight in mix:
+            r -= weight
+            if r < 0:
+                break
+        params = generator.params(action)
+        action = params['action']
+
+        start = time()
+        response = client.request(**params)
+        elapsed = time() - start
+
+        latencies.setdefault(action, []).append(elapsed)
+        if ('exception' in response or
+            [m for m in response.get('messages', []) if m[1] == 'error']):
+            errors[action] = errors.get(action, 0) + 1
+    return latencies, errors
+
+def report(latencies, errors, elapsed, out=sys.stdout):
+    request_num = sum(len(l) for l in latencies.values())
+    print >> out, 'Requests: %d in %.2fs, %.1f requests/s' % (
+        request_num, elapsed, request_num / elapsed)
+    print >> out, '%-28s %6s %6s %8s %8s %8s %8s %8s' % ((
+            'action', 'count', 'errors', 'mean') +
+            tuple('p%d' % p for p in PERCENTILES) + ('max', ))
+    for action in sorted(latencies):
+        values = sorted(latencies[action])
+        print >> out, '%-28s %6d %6d %8.2f %8.2f %8.2f %8.2f %8.2f' % ((
+                action, len(values), errors.get(action, 0),
+                1000 * sum(values) / len(values)) +
+                tuple(1000 * percentile(values, p) for p in PERCENTILES) +
+                (1000 * values[-1], ))
+    print >> out, '(latencies in milliseconds)'
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    mix = parse_mix(args.mix)
+
+    if args.keep is not None:
+        directory = args.keep
+        makedirs(directory)
+    else:
+        directory = mkdtemp()
+    try:
+        collection_dir = setup_server(directory, args)
+
+        rnd = random.Random(args.seed)
+        generator = RequestGenerator(collection_dir, rnd)
+        client = Client()
+        client.request(action='login', user=USER, password=PASSWORD)
+
+        replay(client, generator, mix, args.warmup, rnd)
+        start = time()
+        latencies, errors = replay(client, generator, mix, args.requests,
+                                   rnd)
+        report(latencies, errors, time() - start)
+    finally:
+        if args.keep is None:
+            rmtree(directory)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
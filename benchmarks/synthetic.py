@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Generator of synthetic brat collections for benchmarking: documents
+# of random text with Protein mentions, nested and discontinuous
+# Complex and Cell spans, Binding and Regulation events, Part-of
+# relations and Equiv annotations at configurable densities, together
+# with a matching annotation.conf.
+
+from __future__ import with_statement
+
+import random
+import sys
+
+from os import makedirs
+from os.path import exists, join as path_join
+
+ANNOTATION_CONF = '''\
+[entities]
+
+Protein
+Complex
+Cell
+
+[relations]
+
+Part-of	Arg1:Protein, Arg2:Complex|Cell
+Equiv	Arg1:Protein, Arg2:Protein, <REL-TYPE>:symmetric-transitive
+<OVERLAP>	Arg1:<ENTITY>, Arg2:<ENTITY>, <OVL-TYPE>:<ANY>
+
+[events]
+
+Binding	Theme+:Protein
+Regulation	Theme:Protein|<EVENT>, Cause?:Protein
+
+[attributes]
+
+Negation	Arg:<EVENT>
+'''
+
+WORDS = ['the', 'of', 'binding', 'cell', 'complex', 'expression', 'in',
+         'and', 'induced', 'factor', 'receptor', 'with', 'regulates',
+         'activity', 'was', 'observed', 'by', 'levels', 'human', 'mouse']
+
+# Number of distinct protein names (P1, P2, ...)
+PROTEIN_NAMES = 500
+
+DEFAULTS = {
+    'min_tokens': 300,
+    'max_tokens': 600,
+    'entity_density': 0.2,
+    'nested_rate': 0.5,
+    'discontinuous_rate': 0.1,
+    'event_density': 0.3,
+    'relation_density': 0.2,
+    'equiv_density': 0.05,
+    }
+
+def argparser():
+    import argparse
+
+    ap = argparse.ArgumentParser(description='Generate a synthetic brat ' +
+                                 'collection for benchmarking.')
+    add_arguments(ap)
+    ap.add_argument('-n', '--documents', type=int, default=200,
+                    help='Number of documents (default 200)')
+    ap.add_argument('--seed', type=int, default=0,
+                    help='Random seed (default 0)')
+    ap.add_argument('directory', metavar='DIR',
+                    help='Directory to write the collection into')
+    return ap
+
+def add_arguments(ap):
+    # the options of the collection, shared with replay.py
+    ap.add_argument('--min-tokens', type=int,
+                    default=DEFAULTS['min_tokens'],
+                    help='Minimum document length in tokens (default %d)' %
+                    DEFAULTS['min_tokens'])
+    ap.add_argument('--max-tokens', type=int,
+                    default=DEFAULTS['max_tokens'],
+                    help='Maximum document length in tokens (default %d)' %
+                    DEFAULTS['max_tokens'])
+    for name, help_text in (
+        ('entity_density', 'Fraction of tokens that are Protein mentions'),
+        ('nested_rate', 'Probability of a Protein being enclosed by ' +
+         'each of a Complex and a Cell span'),
+        ('discontinuous_rate', 'Fraction of Complex spans that are ' +
+         'discontinuous'),
+        ('event_density', 'Fraction of Proteins that are the Theme of ' +
+         'a Binding event'),
+        ('relation_density', 'Fraction of enclosed Proteins in Part-of ' +
+         'relations'),
+        ('equiv_density', 'Fraction of Proteins marked Equiv to an ' +
+         'earlier mention of the same Protein'),
+        ):
+        ap.add_argument('--' + name.replace('_', '-'), type=float,
+                        default=DEFAULTS[name],
+                        help='%s (default %s)' % (help_text, DEFAULTS[name]))
+
+def collection_options(args):
+    '''
+    Returns the options of write_synthetic_collection() from parsed
+    arguments (see add_arguments()).
+    '''
+    return dict((name, getattr(args, name)) for name in DEFAULTS)
+
+def synthetic_document(rnd, min_tokens, max_tokens, entity_density,
+                       nested_rate, discontinuous_rate, event_density,
+                       relation_density, equiv_density):
+    '''
+    Returns the text and annotation lines of a synthetic document.
+    '''
+    tokens, offsets, offset = [], [], 0
+    for i in xrange(rnd.randint(min_tokens, max_tokens)):
+        if rnd.random() < entity_density:
+            token = 'P%d' % rnd.randint(1, PROTEIN_NAMES)
+        else:
+            token = rnd.choice(WORDS)
+        tokens.append(token)
+        offsets.append(offset)
+        offset += len(token) + 1
+    text = ' '.join(tokens) + '\n'
+
+    def span(start, end):
+        # offsets and text of tokens start to end (exclusive)
+        return (offsets[start], offsets[end-1] + len(tokens[end-1]),
+                ' '.join(tokens[start:end]))
+
+    anns = []
+    ids = {'T': 0, 'E': 0, 'R': 0, 'A': 0}
+    def next_id(prefix):
+        ids[prefix] += 1
+        return '%s%d' % (prefix, ids[prefix])
+
+    proteins = []
+    for i, token in enumerate(tokens):
+        if token.startswith('P'):
+            tid = next_id('T')
+            anns.append('%s\tProtein %d %d\t%s' % ((tid, ) + span(i, i+1)))
+            proteins.append((i, tid))
+
+    first_mention = {}
+    events = []
+    for i, p_tid in proteins:
+        # enclosing spans, which may also nest in each other
+        enclosing = []
+        for ann_type, length in (('Complex', rnd.randint(1, 4)),
+                                 ('Cell', rnd.randint(5, 12))):
+            if rnd.random() >= nested_rate:
+                continue
+            start = max(0, i - rnd.randint(0, length))
+            end = min(len(tokens), start + length + 1)
+            tid = next_id('T')
+            if (ann_type == 'Complex' and end - start > 2 and
+                rnd.random() < discontinuous_rate):
+                # leave out a token in the middle
+                gap = rnd.randint(start + 1, end - 2)
+                s1, e1, t1 = span(start, gap)
+                s2, e2, t2 = span(gap + 1, end)
+                anns.append('%s\t%s %d %d;%d %d\t%s %s' % (
+                        tid, ann_type, s1, e1, s2, e2, t1, t2))
+            else:
+                anns.append('%s\t%s %d %d\t%s' % ((tid, ann_type) +
+                                                  span(start, end)))
+            enclosing.append(tid)
+
+        if enclosing and rnd.random() < relation_density:
+            anns.append('%s\tPart-of Arg1:%s Arg2:%s' % (
+                    next_id('R'), p_tid, rnd.choice(enclosing)))
+
+        token = tokens[i]
+        if token in first_mention and rnd.random() < equiv_density:
+            anns.append('*\tEquiv %s %s' % (first_mention[token], p_tid))
+        first_mention.setdefault(token, p_tid)
+
+        if i > 0 and rnd.random() < event_density:
+            # trigger on the preceding token
+            trigger = next_id('T')
+            anns.append('%s\tBinding %d %d\t%s' % ((trigger, ) +
+                                                   span(i-1, i)))
+            eid = next_id('E')
+            anns.append('%s\tBinding:%s Theme:%s' % (eid, trigger, p_tid))
+            events.append((i, eid))
+
+    # regulation of some of the events, with nested event arguments
+    for i, theme in events:
+        if i < 2 or rnd.random() >= 0.3:
+            continue
+        trigger = next_id('T')
+        anns.append('%s\tRegulation %d %d\t%s' % ((trigger, ) +
+                                                  span(i-2, i-1)))
+        eid = next_id('E')
+        anns.append('%s\tRegulation:%s Theme:%s' % (eid, trigger, theme))
+        if rnd.random() < 0.2:
+            anns.append('%s\tNegation %s' % (next_id('A'), eid))
+
+    return text, anns
+
+def write_synthetic_collection(directory, doc_num, seed=0, **options):
+    '''
+    Writes doc_num synthetic documents and an annotation.conf for them
+    into the given directory. The options are those of DEFAULTS.
+    '''
+    unknown = set(options) - set(DEFAULTS)
+    assert not unknown, 'unknown options %s' % ', '.join(sorted(unknown))
+    doc_options = dict(DEFAULTS)
+    doc_options.update(options)
+
+    if not exists(directory):
+        makedirs(directory)
+    with open(path_join(directory, 'annotation.conf'), 'wb') as conf_file:
+        conf_file.write(ANNOTATION_CONF)
+
+    rnd = random.Random(seed)
+    for d in xrange(doc_num):
+        text, anns = synthetic_document(rnd, **doc_options)
+        base = path_join(directory, 'doc-%d' % d)
+        with open(base + '.txt', 'wb') as txt_file:
+            txt_file.write(text)
+        with open(base + '.ann', 'wb') as ann_file:
+            ann_file.write('\n'.join(anns) + '\n')
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    write_synthetic_collection(args.directory, args.documents, args.seed,
+                               **collection_options(args))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -7,6 +7,32 @@ var Ajax = (function($, window, undefined) {
       var pending = 0;
       var count = 0;
       var pendingList = {};
+      // type configurations received, by the validator the server sends
+      // with them (see _inject_annotation_type_conf in
+      // server/src/document.py); the server leaves the configuration
+      // out if the client sends back the validator of an unchanged one
+      var typeConfigs = {};
+      var typeConfigValidator = null;
+      var typeConfigKeys = ['event_types', 'entity_types', 'relation_types',
+          'event_attribute_types', 'relation_attribute_types',
+          'entity_attribute_types', 'unconfigured_types', 'ui_names',
+          'visual_options'];
+      var typeConfigActions = ['getCollectionInformation', 'getConfiguration'];
+
+      var rememberTypeConfig = function(response) {
+        var validator = response.type_config_validator;
+        if (response.type_config_unchanged) {
+          $.extend(response, typeConfigs[validator]);
+          delete response.type_config_unchanged;
+        } else {
+          var config = {};
+          $.each(typeConfigKeys, function(keyNo, key) {
+            config[key] = response[key];
+          });
+          typeConfigs[validator] = config;
+        }
+        typeConfigValidator = validator;
+      };
 
       // merge data will get merged into the response data
       // before calling the callback
@@ -27,6 +53,11 @@ var Ajax = (function($, window, undefined) {
           // TODO: Extract the protocol version somewhere global
           data['protocol'] = PROTOCOL_VERSION;
         }
+        if (typeConfigValidator !== null &&
+            data.toString() != '[object FormData]' &&
+            $.inArray(data.action, typeConfigActions) != -1) {
+          data['type_config_validator'] = typeConfigValidator;
+        }
 
         options = {
             url: 'ajax.cgi',
@@ -42,6 +73,10 @@ var Ajax = (function($, window, undefined) {
                 dispatcher.post('messages', [[['Protocol error: Action' + data.action + ' returned the results of action ' + response.action + ' maybe the server is unable to run, please run tools/troubleshooting.sh from your installation to diagnose it', 'error', -1]]]);
               }
 
+              if (response.type_config_validator !== undefined) {
+                rememberTypeConfig(response);
+              }
+
               // If the request is obsolete, do nothing; if not...
               if (pendingList.hasOwnProperty(id)) {
                 dispatcher.post('messages', [response.messages]);
@@ -12,6 +12,8 @@ var VisualizerUI = (function($, window, undefined) {
       var selectorData = null;    // can be search results when available
       var searchActive = false;   // whether search results received and in use
       var loadedSearchData = null;
+      var searchOpts = null;      // last search request, for paging
+      var searchPageStart = 0;    // number of results before this page
 
       var currentForm;
       var spanTypes = null;
@@ -39,7 +41,7 @@ var VisualizerUI = (function($, window, undefined) {
       var normServerDbByNormDbName = {};
       var normInfoCache = {};
       var normInfoCacheSize = 0;
-      var normInfoCacheMaxSize = 100;
+      var normInfoCacheMaxSize = 1000;
 
       var matchFocus = '';
       var matches = '';
@@ -901,6 +903,26 @@ var VisualizerUI = (function($, window, undefined) {
           $('#more_info_readme').text('');
         }
 
+        if (selectorData.count_estimate !== undefined) {
+          // a page of search results; the total is known on the last page
+          var pageEnd = searchPageStart + selectorData.items.length;
+          var total = pageEnd;
+          var exact = true;
+          if (selectorData.cursor) {
+            total = Math.max(selectorData.count_estimate, pageEnd);
+            exact = selectorData.count_exact;
+          }
+          $('#search_page_info').text('Results ' + (searchPageStart + 1) +
+              '-' + pageEnd + ' of ' + (exact ? '' : 'about ') + total);
+          $('#search_first_page_button').toggle(searchPageStart > 0 &&
+              searchOpts !== null);
+          $('#search_next_page_button').toggle(!!selectorData.cursor &&
+              searchOpts !== null);
+          $('#search_page').show();
+        } else {
+          $('#search_page').hide();
+        }
+
         selectElementInTable($('#document_select'), doc, args.matchfocus);
         setTimeout(function() {
           $('#document_input').focus().select();
@@ -1205,6 +1227,43 @@ var VisualizerUI = (function($, window, undefined) {
 
       var searchForm = $('#search_form');
 
+      // requests the page of results of the last search starting from
+      // the given cursor (the first page if null)
+      var requestSearchPage = function(cursor, pageStart) {
+        var opts = $.extend({}, searchOpts);
+        if (cursor) {
+          opts.cursor = cursor;
+          opts.page_size = selectorData.page_size;
+        }
+        dispatcher.post('ajax', [opts, function(response) {
+          if(response && response.items && response.items.length == 0) {
+            if (pageStart > 0) {
+              // the estimate promised more than there was
+              dispatcher.post('messages', [[['No further matches.', 'comment']]]);
+              selectorData.cursor = null;
+              showFileBrowser();
+            } else {
+              // TODO: might consider having this message come from the
+              // server instead
+              dispatcher.post('messages', [[['No matches to search.', 'comment']]]);
+              dispatcher.post('clearSearch', [true]);
+            }
+          } else {
+            searchPageStart = pageStart;
+            docScroll = 0;
+            applySearchResults(response);
+          }
+        }]);
+      };
+
+      $('#search_first_page_button').button().click(function(evt) {
+        requestSearchPage(null, 0);
+      });
+      $('#search_next_page_button').button().click(function(evt) {
+        requestSearchPage(selectorData.cursor,
+            searchPageStart + selectorData.items.length);
+      });
+
       var searchFormSubmit = function(evt) {
         // hack around empty document; "" would be interpreted as
         // missing argument by server dispatcher (issue #513)
@@ -1258,6 +1317,9 @@ var VisualizerUI = (function($, window, undefined) {
             opts.text = $('#search_form_note_text').val() || '';
             break;
           case 'searchLoad':
+            // a saved page can't be continued
+            searchOpts = null;
+            searchPageStart = 0;
             applySearchResults(loadedSearchData);
             return false;
         }
@@ -1282,16 +1344,8 @@ var VisualizerUI = (function($, window, undefined) {
         opts.match_case = $('#match_case_on').is(':checked');
 
         dispatcher.post('hideForm');
-        dispatcher.post('ajax', [opts, function(response) {
-          if(response && response.items && response.items.length == 0) {
-            // TODO: might consider having this message come from the
-            // server instead
-            dispatcher.post('messages', [[['No matches to search.', 'comment']]]);
-            dispatcher.post('clearSearch', [true]);
-          } else {
-            applySearchResults(response);
-          }
-        }]);
+        searchOpts = opts;
+        requestSearchPage(null, 0);
         return false;
       };
 
@@ -1729,8 +1783,49 @@ var VisualizerUI = (function($, window, undefined) {
           //$('#document_ctime').css("display", "none");
           $('#document_mtime').hide();
         }
+
+        prefetchNormData(sourceData.normalizations || []);
       }
 
+      var prefetchNormData = function(normalizations) {
+        // fetch the data for the normalizations of a newly loaded
+        // document in a single request so that the comment popups
+        // find it in the cache.
+        var keys = [];
+        var seen = {};
+        $.each(normalizations, function(normNo, norm) {
+          var dbName = norm[3], dbKey = norm[4];
+          if (!(dbName in normServerDbByNormDbName) ||
+              normServerDbByNormDbName[dbName] == '<NONE>' ||
+              normCacheGet(dbName, dbKey) || seen[dbName+':'+dbKey]) {
+            return;
+          }
+          seen[dbName+':'+dbKey] = true;
+          keys.push([dbName, dbKey]);
+        });
+        // don't fetch more than the cache can hold
+        keys = keys.slice(0, normInfoCacheMaxSize);
+        if (!keys.length) {
+          return;
+        }
+        dispatcher.post('ajax', [{
+          action: 'normGetNames',
+          keys: JSON.stringify(keys),
+          collection: coll,
+        },
+        function(response) {
+          if (response.exception) {
+            return; // popups will query individually
+          }
+          $.each(response.values, function(valueNo, value) {
+            var dbName = value[0], dbKey = value[1], data = value[3];
+            if (data) {
+              normCachePut(dbName, dbKey, data);
+            }
+          });
+        }]);
+      };
+
       $('#source_collection_conf').buttonset();
 
       var gotCurrent = function(_coll, _doc, _args) {
@@ -77,6 +77,102 @@ USER_PASSWORD = {
 MAX_SEARCH_RESULT_NUMBER = 1000
 
 
+### SEARCH_CACHE_SIZE, SEARCH_CACHE_PERSIST
+# Results of repeated searches are cached until the searched documents
+# change. SEARCH_CACHE_SIZE is the number of cached result pages (no
+# caching if <= 0, default 100). Set SEARCH_CACHE_PERSIST to True to
+# also store cached results under WORK_DIR; this is mainly useful when
+# the server is run as a CGI script.
+
+#SEARCH_CACHE_SIZE = 100
+#SEARCH_CACHE_PERSIST = False
+
+
+### NORM_CACHE_SIZE, NORM_SEARCH_CACHE_SIZE, NORM_SCORE_CACHE_SIZE
+# Normalization DB entries, searches and alignment scores are cached
+# in memory, with entries for a DB dropped when it is rebuilt. The
+# settings are the maximum numbers of cached DB entries (default
+# 10000), search results (default 100) and alignment scores (default
+# 100000), with no caching if <= 0.
+
+#NORM_CACHE_SIZE = 10000
+#NORM_SEARCH_CACHE_SIZE = 100
+#NORM_SCORE_CACHE_SIZE = 100000
+
+
+### NGRAM_CACHE_SIZE
+# The n-gram sets of the strings found in approximate string lookups
+# in normalization DBs are cached in memory for filtering the results
+# of later lookups. NGRAM_CACHE_SIZE is the maximum number of cached
+# sets (no caching if <= 0, default 2000). Each set takes roughly a
+# few kilobytes, in every server process.
+
+#NGRAM_CACHE_SIZE = 2000
+
+
+### STANDALONE_WORKERS, STANDALONE_MAX_REQUESTS
+# By default, the standalone server (standalone.py) forks a new process
+# for each connection. Set STANDALONE_WORKERS to a positive number to
+# instead serve with that many processes forked at startup, which keep
+# their caches between requests. Each worker is replaced by a fresh one
+# after STANDALONE_MAX_REQUESTS requests (never if 0, default 1000).
+# Each worker serves any number of connections, in a thread each.
+
+#STANDALONE_WORKERS = 4
+#STANDALONE_MAX_REQUESTS = 1000
+
+
+### SLOW_ACTION_THREADS
+# Multi-threaded servers (ajax.fcgi, ajax.wsgi) serve at most this many
+# slow requests, such as automatic tagging and collection searches, at
+# the same time so that other requests are not held up behind them (no
+# limit if <= 0, default 2).
+
+#SLOW_ACTION_THREADS = 2
+
+
+### METRICS_ENDPOINT, METRICS_LOG
+# The standalone server (standalone.py) and WSGI servers (ajax.fcgi,
+# ajax.wsgi) report per-action request counts, errors, latencies and
+# response sizes in the Prometheus text format at the path /metrics
+# (disable by setting METRICS_ENDPOINT to False). The WSGI servers
+# report the requests served by the responding process, the standalone
+# server those of all its processes, which add theirs to metrics.db in
+# WORK_DIR every few seconds. Set METRICS_LOG to True to also log each request as a line
+# of JSON in requests.log in WORK_DIR, e.g. when serving through CGI.
+
+#METRICS_ENDPOINT = True
+#METRICS_LOG = False
+
+
+### PROFILE_SAMPLE_RATE, PROFILE_ACTIONS, PROFILE_COLLECTIONS
+# Actions can be profiled with cProfile to find out why they are slow.
+# A random PROFILE_SAMPLE_RATE fraction of requests (none if 0, the
+# default) and all requests for actions in PROFILE_ACTIONS or for
+# collections under paths in PROFILE_COLLECTIONS are profiled. Profiles
+# are stored in profiles/ in WORK_DIR, up to PROFILE_MAX_PROFILES
+# (unlimited if <= 0, default 1000), and can be summarised with
+# tools/profile_summary.py.
+
+#PROFILE_SAMPLE_RATE = 0.01
+#PROFILE_ACTIONS = ['searchEntityInCollection']
+#PROFILE_COLLECTIONS = ['/large-corpus/']
+#PROFILE_MAX_PROFILES = 1000
+
+
+### SESSION_STORE
+# Where the sessions of the users are kept: "file" (the default) for a
+# pickle file per session in sessions/ in WORK_DIR, as in earlier
+# versions, "sqlite" for an SQLite database in the same directory, shared
+# by all server processes and faster with many sessions, or "memory" for
+# the memory of the server process. The latter is only for servers
+# running a single multi-threaded process (e.g. ajax.wsgi), and loses
+# the sessions when it exits. Changing SESSION_STORE does not carry the
+# existing sessions over, logging out all users.
+
+#SESSION_STORE = 'file'
+
+
 ### DEBUG
 # Set to True to enable additional debug output
 
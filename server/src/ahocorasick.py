@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Aho-Corasick automaton for finding all occurrences of a set of
+strings in a text in a single pass.
+'''
+
+
+class AhoCorasick(object):
+    '''
+    Multiple string matcher. Keys are added with add(), after which
+    finditer() returns the offsets of all (possibly overlapping)
+    occurrences of any key in a given text. Keys must be non-empty.
+    '''
+
+    def __init__(self, keys=None):
+        # per state: transitions, failure state, length of the key
+        # ending in the state (0 if none) and the closest state
+        # reachable by failure transitions that ends a key (0 if none)
+        self._goto = [{}]
+        self._fail = [0]
+        self._key_length = [0]
+        self._output_link = [0]
+        self._built = True
+
+        if keys is not None:
+            for key in keys:
+                self.add(key)
+
+    def add(self, key):
+        if not key:
+            raise ValueError('empty key')
+
+        state = 0
+        for c in key:
+            next_state = self._goto[state].get(c)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][c] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._key_length.append(0)
+                self._output_link.append(0)
+            state = next_state
+        self._key_length[state] = len(key)
+        self._built = False
+
+    def _build(self):
+        # breadth-first, so that failure states are complete before
+        # they are used
+        goto, fail = self._goto, self._fail
+        key_length, output_link = self._key_length, self._output_link
+
+        queue = []
+        for state in goto[0].itervalues():
+            fail[state] = 0
+            output_link[state] = 0
+            queue.append(state)
+
+        i = 0
+        while i < len(queue):
+            state = queue[i]
+            i += 1
+            for c, next_state in goto[state].iteritems():
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(c, 0)
+                fail[next_state] = f
+                if key_length[f]:
+                    output_link[next_state] = f
+                else:
+                    output_link[next_state] = output_link[f]
+                queue.append(next_state)
+
+        self._built = True
+
+    def finditer(self, text):
+        '''
+        Generates (start, end) offsets of the occurrences of the keys
+        in the given text, ordered by end offset and, for the same end
+        offset, from the longest key to the shortest.
+        '''
+        if not self._built:
+            self._build()
+
+        goto, fail = self._goto, self._fail
+        key_length, output_link = self._key_length, self._output_link
+
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+
+            end = i + 1
+            if key_length[state]:
+                yield end - key_length[state], end
+            out = output_link[state]
+            while out:
+                yield end - key_length[out], end
+                out = output_link[out]
+
+    def __len__(self):
+        return len(self._goto) - 1
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    def naive_find(keys, text):
+        found = []
+        for end in xrange(1, len(text) + 1):
+            for start in xrange(end):
+                if text[start:end] in keys:
+                    found.append((start, end))
+        return found
+
+    class AhoCorasickTest(TestCase):
+        def test_overlapping(self):
+            keys = ['he', 'she', 'his', 'hers']
+            ac = AhoCorasick(keys)
+            text = 'ushers and his hershey'
+            self.assertEqual(list(ac.finditer(text)),
+                             naive_find(set(keys), text))
+
+        def test_unicode(self):
+            keys = [u'ää', u'aä', u'ä']
+            ac = AhoCorasick(keys)
+            text = u'aaäääb'
+            self.assertEqual(list(ac.finditer(text)),
+                             naive_find(set(keys), text))
+
+        def test_add_after_search(self):
+            ac = AhoCorasick(['ab'])
+            self.assertEqual(list(ac.finditer('abc')), [(0, 2)])
+            ac.add('bc')
+            self.assertEqual(list(ac.finditer('abc')), [(0, 2), (1, 3)])
+
+        def test_empty_key(self):
+            self.assertRaises(ValueError, AhoCorasick, [''])
+
+    unittest.main()
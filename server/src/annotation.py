@@ -27,6 +27,7 @@ from re import compile as re_compile
 from common import ProtocolError
 from filelock import file_lock
 from message import Messager
+from metrics import add_time
 
 
 ### Constants
@@ -957,10 +958,12 @@ class Annotations(object):
             from config import WORK_DIR
             
             # Protect the write so we don't corrupt the file
+            lock_start = time()
             with file_lock(path_join(WORK_DIR,
                     str(hash(self._input_files[0].replace('/', '_')))
                         + '.lock')
                     ) as lock_file:
+                add_time('lock_wait', time() - lock_start)
                 #from tempfile import NamedTemporaryFile
                 from tempfile import mkstemp
                 # TODO: XXX: Is copyfile really atomic?
@@ -10,6 +10,12 @@ Version:    2011-04-21
 '''
 
 
+# Request arguments, None for those not sent by the client
+class DefaultNoneDict(dict):
+    def __missing__(self, key):
+        return None
+
+
 class ProtocolError(Exception):
     def __init__(self):
         pass
@@ -29,7 +35,8 @@ class ProtocolArgumentError(ProtocolError):
     def json(self, json_dic):
         json_dic['exception'] = 'protocolArgumentError'
 
-# If received by ajax.cgi, no JSON will be sent
+# If received by ajax.cgi, no JSON will be sent; data is either a string or
+#   an open file, which is streamed to the client
 # XXX: This is an ugly hack to circumvent protocol flaws
 class NoPrintJSONError(Exception):
     def __init__(self, hdrs, data):
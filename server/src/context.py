@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Per-request server state: the session, the messages pending for the
+client, the user, collection, document and action of the request and
+its timings (see metrics.py).
+The state is kept per thread, so that requests served concurrently by
+the threads of a single process (e.g. under a multi-threaded WSGI
+server) do not see each other's state, while sharing the caches of
+the process.
+'''
+
+from threading import local
+from time import time
+
+__state = local()
+
+
+class RequestContext(object):
+    def __init__(self, client_ip=None, client_hostname=None):
+        self.client_ip = client_ip
+        self.client_hostname = client_hostname
+        self.session = None
+        self.messages = []
+        self.user = None
+        self.collection = None
+        self.document = None
+        self.action = None
+        self.started = time()
+        # phase -> seconds, and the exception reported to the client
+        self.timings = {}
+        self.error = None
+        # directories whose project configuration has been validated
+        # (see projectconfig.validate_configs)
+        self.validated_configs = set()
+
+
+def begin_request(client_ip=None, client_hostname=None):
+    '''
+    Starts a new request in the current thread, replacing the state of
+    any previous one. Returns the new context.
+    '''
+    context = RequestContext(client_ip, client_hostname)
+    __state.context = context
+    return context
+
+def end_request():
+    '''
+    Discards the state of the request of the current thread.
+    '''
+    __state.context = None
+
+def get_context():
+    '''
+    Returns the context of the request of the current thread. Outside
+    of requests (e.g. in command-line tools) a context is started on
+    first use.
+    '''
+    context = getattr(__state, 'context', None)
+    if context is None:
+        context = begin_request()
+    return context
+
+
+if __name__ == '__main__':
+    from threading import Thread
+    from unittest import TestCase
+    import unittest
+
+    class RequestContextTest(TestCase):
+        def test_per_thread(self):
+            begin_request('127.0.0.1').messages.append('main')
+            seen = []
+            def request():
+                seen.append(list(get_context().messages))
+                get_context().messages.append('thread')
+            thread = Thread(target=request)
+            thread.start()
+            thread.join()
+            self.assertEqual(seen, [[]])
+            self.assertEqual(get_context().messages, ['main'])
+
+        def test_end_request(self):
+            begin_request().user = 'user'
+            end_request()
+            self.assertEqual(get_context().user, None)
+
+    unittest.main()
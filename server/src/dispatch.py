@@ -9,6 +9,8 @@ Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Version:    2011-04-21
 '''
 
+from __future__ import with_statement
+
 from os.path import abspath, normpath
 from os.path import join as path_join
 
@@ -16,8 +18,9 @@ from annotator import create_arc, delete_arc, reverse_arc
 from annotator import create_span, delete_span
 from annotator import split_span
 from auth import login, logout, whoami, NotAuthorisedError
-from common import ProtocolError
+from common import ProtocolError, DefaultNoneDict
 from config import DATA_DIR
+from context import get_context
 from convert.convert import convert
 from docimport import save_import
 from document import (get_directory_information, get_document,
@@ -25,18 +28,21 @@ from document import (get_directory_information, get_document,
 from download import download_file, download_collection
 from inspect import getargspec
 from itertools import izip
-from jsonwrap import dumps
-from logging import info as log_info
+from jsonwrap import dumps, loads
+from logging import getLogger, INFO, info as log_info
 from annlog import log_annotation
 from message import Messager
+from metrics import timer
 from svg import store_svg, retrieve_stored
-from session import get_session, load_conf, save_conf
+from session import get_session, load_conf, save_conf, NoSessionError
 from search import search_text, search_entity, search_event, search_relation, search_note
 from predict import suggest_span_types
+from profiling import should_profile, profile_call
 from undo import undo
 from tag import tag
 from delete import delete_document, delete_collection
-from norm import norm_get_name, norm_search, norm_get_data
+from norm import (norm_get_name, norm_get_names, norm_search, norm_get_data,
+        norm_auto)
 
 # no-op function that can be invoked by client to log a user action
 def logging_no_op(collection, document, log):
@@ -96,8 +102,10 @@ DISPATCHER = {
 
         # normalization support
         'normGetName': norm_get_name,
+        'normGetNames': norm_get_names,
         'normSearch': norm_search,
         'normData' : norm_get_data,
+        'normAuto' : norm_auto,
 
         # Visualisation support
         'getConfiguration': get_configuration,
@@ -113,6 +121,7 @@ ANNOTATION_ACTION = set((
         'splitSpan',
         'suggestSpanTypes',
         'undo',
+        'normAuto',
         ))
 
 # Actions that will be logged as annotator actions (if so configured)
@@ -140,6 +149,52 @@ REQUIRES_AUTHENTICATION = ANNOTATION_ACTION | set((
 for req_action in REQUIRES_AUTHENTICATION:
     assert req_action in DISPATCHER, (
             'INTERNAL ERROR: undefined action in REQUIRES_AUTHENTICATION set')
+
+# Action executing a list of other actions in a single request
+MULTI_ACTION = 'multi'
+MAX_MULTI_REQUESTS = 100
+# Actions not returning JSON, which can not be part of a multi request
+NO_JSON_ACTION = set((
+        'downloadFile',
+        'downloadCollection',
+        'retrieveStored',
+        ))
+
+def _one_of(*values):
+    def validate(value):
+        if value not in values:
+            raise ValueError('expected one of %s' % ', '.join(values))
+        return value
+    return validate
+
+# Validation and type conversion of argument values sent by the client,
+# by argument name; raise ValueError for invalid values
+ARG_VALIDATORS = {
+        'context_length': int,
+        'threshold': int,
+        'scope': _one_of('collection', 'document'),
+        }
+
+# Marks arguments that the client has to supply
+_REQUIRED = object()
+
+def _action_args(action_function):
+    # The arguments of the action function as (name, default value,
+    # validator) tuples, the default value _REQUIRED if there is none
+    args, varargs, keywords, defaults = getargspec(action_function)
+    # We will not allow this for now, there is most likely no need for it
+    assert varargs is None, 'no varargs for action functions'
+    assert keywords is None, 'no keywords for action functions'
+
+    if defaults is None:
+        defaults = ()
+    required = [_REQUIRED] * (len(args) - len(defaults))
+    return tuple((arg, default, ARG_VALIDATORS.get(arg))
+            for arg, default in izip(args, required + list(defaults)))
+
+# Arguments of the action functions by action, determined once
+ACTION_ARGS = dict((action, _action_args(action_function))
+        for action, action_function in DISPATCHER.iteritems())
 ###
 
 
@@ -163,7 +218,7 @@ class InvalidActionError(ProtocolError):
         return 'Client sent an invalid action "%s"' % self.attempted_action
 
     def json(self, json_dic):
-        json_dic['exception'] = 'invalidAction',
+        json_dic['exception'] = 'invalidAction'
         return json_dic
 
 
@@ -176,7 +231,22 @@ class InvalidActionArgsError(ProtocolError):
         return 'Client did not supply argument "%s" for action "%s"' % (self.missing_arg, self.attempted_action)
 
     def json(self, json_dic):
-        json_dic['exception'] = 'invalidActionArgs',
+        json_dic['exception'] = 'invalidActionArgs'
+        return json_dic
+
+
+class InvalidActionArgValueError(ProtocolError):
+    def __init__(self, attempted_action, arg, value, reason):
+        self.attempted_action = attempted_action
+        self.arg = arg
+        self.value = value
+        self.reason = reason
+
+    def __str__(self):
+        return 'Client sent invalid value "%s" for argument "%s" of action "%s" (%s)' % (self.value, self.arg, self.attempted_action, self.reason)
+
+    def json(self, json_dic):
+        json_dic['exception'] = 'invalidActionArgs'
         return json_dic
 
 
@@ -188,7 +258,7 @@ class DirectorySecurityError(ProtocolError):
         return 'Client sent request for bad directory: ' + self.requested
 
     def json(self, json_dic):
-        json_dic['exception'] = 'directorySecurity',
+        json_dic['exception'] = 'directorySecurity'
         return json_dic
 
 
@@ -207,7 +277,7 @@ class ProtocolVersionMismatchError(ProtocolError):
             ))
 
     def json(self, json_dic):
-        json_dic['exception'] = 'protocolVersionMismatch',
+        json_dic['exception'] = 'protocolVersionMismatch'
         return json_dic
 
 
@@ -224,7 +294,7 @@ def _directory_is_safe(dir_path):
 def dispatch(http_args, client_ip, client_hostname):
     action = http_args['action']
 
-    log_info('dispatcher handling action: %s' % (action, ));
+    log_info('dispatcher handling action: %s', action)
 
     # Verify that we don't have a protocol version mismatch
     PROTOCOL_VERSION = 1
@@ -243,59 +313,70 @@ def dispatch(http_args, client_ip, client_hostname):
     if action is None:
         raise NoActionError
 
+    if action == MULTI_ACTION:
+        json_dic = _dispatch_multi(http_args, client_ip, client_hostname)
+    else:
+        json_dic = _dispatch_action(action, http_args, client_ip,
+                client_hostname)
+
+    # Return the protocol version for symmetry
+    json_dic['protocol'] = PROTOCOL_VERSION
+    return json_dic
+
+def _dispatch_action(action, http_args, client_ip, client_hostname):
     # If we got a directory (collection), check it for security
     if http_args['collection'] is not None:
         if not _directory_is_safe(http_args['collection']):
             raise DirectorySecurityError(http_args['collection'])
 
+    # Note the request in its context for the action functions
+    context = get_context()
+    context.action = action
+    context.collection = http_args['collection']
+    context.document = http_args['document']
+    try:
+        context.user = get_session().get('user')
+    except NoSessionError:
+        context.user = None
+
     # Make sure that we are authenticated if we are to do certain actions
     if action in REQUIRES_AUTHENTICATION:
-        try:
-            user = get_session()['user']
-        except KeyError:
-            user = None
+        user = context.user
         if user is None:
-            log_info('Authorization failure for "%s" with hostname "%s"'
-                     % (client_ip, client_hostname))
+            log_info('Authorization failure for "%s" with hostname "%s"',
+                     client_ip, client_hostname)
             raise NotAuthorisedError(action)
 
     # Fetch the action function for this action (if any)
     try:
         action_function = DISPATCHER[action]
     except KeyError:
-        log_info('Invalid action "%s"' % action)
+        log_info('Invalid action "%s"', action)
+        # Not a label for the request metrics
+        context.action = None
         raise InvalidActionError(action)
 
-    # Determine what arguments the action function expects
-    args, varargs, keywords, defaults = getargspec(action_function)
-    # We will not allow this for now, there is most likely no need for it
-    assert varargs is None, 'no varargs for action functions'
-    assert keywords is None, 'no keywords for action functions'
-
-    # XXX: Quick hack
-    if defaults is None:
-        defaults = []
-
-    # These arguments already has default values
-    default_val_by_arg = {}
-    for arg, default_val in izip(args[-len(defaults):], defaults):
-        default_val_by_arg[arg] = default_val
-
     action_args = []
-    for arg_name in args:
+    for arg_name, default_val, validator in ACTION_ARGS[action]:
         arg_val = http_args[arg_name]
 
         # The client failed to provide this argument
         if arg_val is None:
-            try:
-                arg_val = default_val_by_arg[arg_name]
-            except KeyError:
+            if default_val is _REQUIRED:
                 raise InvalidActionArgsError(action, arg_name)
+            arg_val = default_val
+        elif validator is not None:
+            try:
+                arg_val = validator(arg_val)
+            except ValueError, e:
+                raise InvalidActionArgValueError(action, arg_name, arg_val,
+                        e)
 
         action_args.append(arg_val)
 
-    log_info('dispatcher will call %s(%s)' % (action,
-        ', '.join((repr(a) for a in action_args)), ))
+    if getLogger().isEnabledFor(INFO):
+        log_info('dispatcher will call %s(%s)', action,
+            ', '.join((repr(a) for a in action_args)))
 
     # Log annotation actions separately (if so configured)
     if action in LOGGED_ANNOTATOR_ACTION:
@@ -305,7 +386,11 @@ def dispatch(http_args, client_ip, client_hostname):
 
     # TODO: log_annotation for exceptions?
 
-    json_dic = action_function(*action_args)
+    with timer('action'):
+        if should_profile(action, http_args['collection']):
+            json_dic = profile_call(action_function, action_args)
+        else:
+            json_dic = action_function(*action_args)
 
     # Log annotation actions separately (if so configured)
     if action in LOGGED_ANNOTATOR_ACTION:
@@ -315,6 +400,60 @@ def dispatch(http_args, client_ip, client_hostname):
 
     # Assign which action that was performed to the json_dic
     json_dic['action'] = action
-    # Return the protocol version for symmetry
-    json_dic['protocol'] = PROTOCOL_VERSION
     return json_dic
+
+def _dispatch_multi(http_args, client_ip, client_hostname):
+    # Executes the actions of the requests given as a JSON list of
+    # objects of request arguments, in one request sharing the session.
+    # Returns the responses in the same order; messages for all of them
+    # are returned with the response to the multi request.
+    try:
+        requests = loads(http_args['requests'] or '')
+        if not isinstance(requests, list):
+            raise ValueError('expected a list of requests')
+        if len(requests) > MAX_MULTI_REQUESTS:
+            raise ValueError('at most %d requests allowed' % MAX_MULTI_REQUESTS)
+        for request in requests:
+            if not isinstance(request, dict):
+                raise ValueError('expected requests as objects')
+    except ValueError, e:
+        raise InvalidActionArgValueError(MULTI_ACTION, 'requests',
+                http_args['requests'], e)
+
+    responses = []
+    for request in requests:
+        # Arguments as if sent separately, with any non-string values
+        # (e.g. offsets) in JSON
+        sub_args = DefaultNoneDict()
+        for k, v in request.iteritems():
+            if isinstance(v, basestring):
+                sub_args[k] = unicode(v)
+            else:
+                sub_args[k] = unicode(dumps(v))
+
+        action = sub_args['action']
+        try:
+            if action is None:
+                raise NoActionError
+            if action == MULTI_ACTION or action in NO_JSON_ACTION:
+                raise InvalidActionError(action)
+            response = _dispatch_action(action, sub_args, client_ip,
+                    client_hostname)
+        except ProtocolError, e:
+            response = {'action': action}
+            e.json(response)
+            err_str = unicode(e)
+            if err_str != '':
+                Messager.error(err_str, duration=-1)
+        responses.append(response)
+
+    # The request as a whole
+    context = get_context()
+    context.action = MULTI_ACTION
+    context.collection = http_args['collection']
+    context.document = http_args['document']
+
+    return {
+            'action': MULTI_ACTION,
+            'responses': responses,
+            }
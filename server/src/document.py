@@ -36,7 +36,8 @@ from projectconfig import (ProjectConfiguration, SEPARATOR_STR,
         options_get_validation, options_get_tokenization,
         options_get_ssplitter, get_annotation_config_section_labels,
         visual_options_get_arc_bundle,
-        visual_options_get_text_direction)
+        visual_options_get_text_direction, get_config_generation,
+        ConfigCache)
 from stats import get_statistics
 from message import Messager
 from auth import allowed_to_read, AccessDeniedError
@@ -461,7 +462,7 @@ class InvalidConfiguration(ProtocolError):
 
 
 # TODO: Is this what we would call the configuration? It is minimal.
-def get_configuration(name):
+def get_configuration(name, type_config_validator=None):
     # TODO: Rip out this path somewhere
     config_dir = path_join(BASE_DIR, 'configurations')
     for conf_name in listdir(config_dir):
@@ -471,12 +472,34 @@ def get_configuration(name):
     else:
         raise InvalidConfiguration
 
-    return _inject_annotation_type_conf(config_path)
+    return _inject_annotation_type_conf(config_path,
+            type_config_validator=type_config_validator)
 
-def _inject_annotation_type_conf(dir_path, json_dic=None):
+def _inject_annotation_type_conf(dir_path, json_dic=None,
+        type_config_validator=None):
     if json_dic is None:
         json_dic = {}
 
+    # The client sends back the validator of the type configuration it
+    # has, which is only sent again if the configuration has changed
+    validator = get_config_generation(dir_path)
+    json_dic['type_config_validator'] = validator
+    if type_config_validator == validator:
+        json_dic['type_config_unchanged'] = True
+    else:
+        json_dic.update(_annotation_type_conf(dir_path))
+    return json_dic
+
+def _annotation_type_conf(dir_path):
+    cache = _annotation_type_conf.__cache
+    if dir_path not in cache:
+        cache[dir_path] = _build_annotation_type_conf(dir_path)
+    return cache[dir_path]
+_annotation_type_conf.__cache = ConfigCache()
+
+def _build_annotation_type_conf(dir_path):
+    json_dic = {}
+
     (event_types, entity_types, rel_types,
             unconf_types) = get_base_types(dir_path)
     (entity_attr_types, rel_attr_types,
@@ -506,7 +529,7 @@ def _inject_annotation_type_conf(dir_path, json_dic=None):
     return json_dic
 
 # TODO: This is not the prettiest of functions
-def get_directory_information(collection):
+def get_directory_information(collection, type_config_validator=None):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -597,7 +620,7 @@ def get_directory_information(collection):
             'normalization_config' : normalization_config,
             'annotation_logging': ann_logging,
             'ner_taggers': ner_taggers,
-            })
+            }, type_config_validator=type_config_validator)
 
 class UnableToReadTextFile(ProtocolError):
     def __init__(self, path):
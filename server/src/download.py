@@ -95,10 +95,11 @@ def download_collection(collection, include_conf=False):
 
         hdrs = [('Content-Type', 'application/octet-stream'), #'application/x-tgz'),
                 ('Content-Disposition', 'inline; filename=%s' % fname)]
-        with open(tmp_file_path, 'rb') as tmp_file:
-            tar_data = tmp_file.read()
+        # The open file is streamed to the client and stays readable
+        # after the file is removed below
+        tar_file = open(tmp_file_path, 'rb')
 
-        raise NoPrintJSONError(hdrs, tar_data)
+        raise NoPrintJSONError(hdrs, tar_file)
     finally:
         if tmp_file_path is not None:
             remove(tmp_file_path)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Size-bounded caches with least-recently-used eviction, safe to share
+between the threads of a long-running server.
+'''
+
+from __future__ import with_statement
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    '''
+    Maps keys to values, holding at most max_size entries. When full,
+    storing a new entry evicts the least recently used one. Keeps
+    counts of lookup hits and misses. A max_size <= 0 disables
+    caching: nothing is stored and every lookup misses.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        '''
+        Returns a dictionary with the size and hit/miss counts of the
+        cache.
+        '''
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            }
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    class LRUCacheTest(TestCase):
+        def test_get_put(self):
+            c = LRUCache(2)
+            self.assertEqual(c.get('a'), None)
+            c.put('a', 1)
+            self.assertEqual(c.get('a'), 1)
+            self.assertEqual((c.hits, c.misses), (1, 1))
+
+        def test_eviction(self):
+            c = LRUCache(2)
+            c.put('a', 1)
+            c.put('b', 2)
+            # touch 'a' so that 'b' is the least recently used
+            c.get('a')
+            c.put('c', 3)
+            self.assertTrue('a' in c)
+            self.assertFalse('b' in c)
+            self.assertTrue('c' in c)
+            self.assertEqual(len(c), 2)
+
+        def test_disabled(self):
+            c = LRUCache(0)
+            c.put('a', 1)
+            self.assertEqual(c.get('a', 'default'), 'default')
+            self.assertEqual(len(c), 0)
+
+    unittest.main()
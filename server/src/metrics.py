@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Per-action request metrics: counts, errors, latencies, response sizes
+and the time spent in the phases of a request (parsing the arguments,
+running the action, waiting for locks and serialising the response).
+
+Metrics are kept in the memory of the serving process and are available
+in the Prometheus text format from prometheus_text(). Servers serving
+requests from several processes (the standalone server) also add them
+to an SQLite DB in WORK_DIR shared by the processes, outside of the
+requests (see share_metrics() and flush_metrics()). With CGI, each
+request can be logged as a line of JSON (see METRICS_LOG in the config).
+'''
+
+from __future__ import with_statement
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import fstat, getpid
+from os.path import join as path_join
+from threading import Lock, Thread, local
+from time import sleep, time
+
+from context import get_context
+from jsonwrap import dumps
+
+try:
+    from config import METRICS_LOG
+except ImportError:
+    METRICS_LOG = False
+
+### Constants
+# Upper bounds of the histogram buckets, in seconds and bytes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0, 10.0)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760)
+# Label for requests failing before their action is known
+UNKNOWN_ACTION = 'unknown'
+METRICS_LOG_FNAME = 'requests.log'
+METRICS_DB_FNAME = 'metrics.db'
+# Seconds to wait for other processes writing the metrics DB
+SQLITE_TIMEOUT = 10
+# Seconds between the additions of the metrics of a process to the
+# metrics DB (see start_metrics_flusher())
+METRICS_FLUSH_INTERVAL = 5
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+###
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum, histogram.count = self.sum, self.count
+        return histogram
+
+    def add(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative_counts(self):
+        total = 0
+        for bucket, count in zip(self.buckets + ('+Inf', ), self.counts):
+            total += count
+            yield bucket, total
+
+
+class MemoryMetrics(object):
+    '''
+    Metrics of the requests served by this process.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        # (action, error) -> number of requests, error is None for
+        # successes
+        self._requests = {}
+        # action -> Histogram
+        self._latency = {}
+        self._size = {}
+        # (action, phase) -> total seconds
+        self._phase_seconds = {}
+
+    def record(self, action, error, duration, size, timings):
+        with self._lock:
+            key = (action, error)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if action not in self._latency:
+                self._latency[action] = Histogram(LATENCY_BUCKETS)
+                self._size[action] = Histogram(SIZE_BUCKETS)
+            self._latency[action].observe(duration)
+            self._size[action].observe(size)
+            for phase, seconds in timings.iteritems():
+                key = (action, phase)
+                self._phase_seconds[key] = (self._phase_seconds.get(key, 0)
+                        + seconds)
+
+    def snapshot(self):
+        '''
+        Returns copies of the request counts, the latency and size
+        histograms and the phase times, as kept by record().
+        '''
+        with self._lock:
+            return (dict(self._requests),
+                    dict((a, h.copy()) for a, h in self._latency.items()),
+                    dict((a, h.copy()) for a, h in self._size.items()),
+                    dict(self._phase_seconds))
+
+    def take(self):
+        '''
+        Returns the metrics as snapshot() does, starting again from
+        empty metrics.
+        '''
+        with self._lock:
+            taken = (self._requests, self._latency, self._size,
+                     self._phase_seconds)
+            self._reset()
+            return taken
+
+    def add(self, metrics):
+        '''
+        Adds metrics as returned by snapshot() to these.
+        '''
+        requests, latency, size, phase_seconds = metrics
+        with self._lock:
+            for key, count in requests.iteritems():
+                self._requests[key] = self._requests.get(key, 0) + count
+            for histograms, buckets, added in (
+                    (self._latency, LATENCY_BUCKETS, latency),
+                    (self._size, SIZE_BUCKETS, size)):
+                for action, histogram in added.iteritems():
+                    if action not in histograms:
+                        histograms[action] = Histogram(buckets)
+                    histograms[action].add(histogram)
+            for key, seconds in phase_seconds.iteritems():
+                self._phase_seconds[key] = (self._phase_seconds.get(key, 0)
+                        + seconds)
+
+
+class SQLiteMetrics(object):
+    '''
+    Metrics of the requests served by all processes adding theirs to
+    the given SQLite DB. Each thread (and process) uses its own
+    connection.
+    '''
+
+    # name of the histograms in the DB -> buckets
+    HISTOGRAMS = {'latency': LATENCY_BUCKETS, 'size': SIZE_BUCKETS}
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        # Connections must not be shared with forked processes
+        if connection is not None and self._local.pid == getpid():
+            return connection
+
+        import sqlite3 as sqlite
+        connection = sqlite.connect(self.path, timeout=SQLITE_TIMEOUT)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            # errors are stored as '' for successes, as NULLs are never
+            # equal in keys
+            connection.execute('CREATE TABLE IF NOT EXISTS requests ('
+                    'action TEXT, error TEXT, count INTEGER, '
+                    'PRIMARY KEY (action, error))')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                    'histogram TEXT, action TEXT, bucket INTEGER, '
+                    'count INTEGER, PRIMARY KEY (histogram, action, bucket))')
+            connection.execute('CREATE TABLE IF NOT EXISTS histograms ('
+                    'histogram TEXT, action TEXT, sum REAL, count INTEGER, '
+                    'PRIMARY KEY (histogram, action))')
+            connection.execute('CREATE TABLE IF NOT EXISTS phases ('
+                    'action TEXT, phase TEXT, seconds REAL, '
+                    'PRIMARY KEY (action, phase))')
+        self._local.connection = connection
+        self._local.pid = getpid()
+        return connection
+
+    def _add(self, connection, table, keys, values):
+        # adds the values to the columns of the row with the given key
+        # columns, creating it if missing
+        key_names, key_values = zip(*keys)
+        names, increments = zip(*values)
+        connection.execute('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join(key_names + names),
+                ', '.join('?' * (len(keys) + len(values)))),
+                key_values + (0, ) * len(values))
+        connection.execute('UPDATE %s SET %s WHERE %s' % (table,
+                ', '.join('%s = %s + ?' % (n, n) for n in names),
+                ' AND '.join('%s = ?' % n for n in key_names)),
+                increments + key_values)
+
+    def add(self, metrics):
+        '''
+        Adds metrics as returned by MemoryMetrics.snapshot() to the DB
+        in a single transaction.
+        '''
+        requests, latency, size, phase_seconds = metrics
+        connection = self._connection()
+        with connection:
+            for (action, error), count in requests.iteritems():
+                self._add(connection, 'requests',
+                        (('action', action), ('error', error or '')),
+                        (('count', count), ))
+            for name, histograms in (('latency', latency), ('size', size)):
+                for action, histogram in histograms.iteritems():
+                    for bucket, count in enumerate(histogram.counts):
+                        if count:
+                            self._add(connection, 'buckets',
+                                    (('histogram', name), ('action', action),
+                                     ('bucket', bucket)), (('count', count), ))
+                    self._add(connection, 'histograms', (('histogram', name),
+                            ('action', action)), (('sum', histogram.sum),
+                            ('count', histogram.count)))
+            for (action, phase), seconds in phase_seconds.iteritems():
+                self._add(connection, 'phases', (('action', action),
+                        ('phase', phase)), (('seconds', seconds), ))
+
+    def snapshot(self):
+        connection = self._connection()
+        requests = dict(((action, error or None), count)
+                for action, error, count in connection.execute(
+                    'SELECT action, error, count FROM requests'))
+        histograms = dict((name, {}) for name in self.HISTOGRAMS)
+        for name, action, total, count in connection.execute(
+                'SELECT histogram, action, sum, count FROM histograms'):
+            histogram = Histogram(self.HISTOGRAMS[name])
+            histogram.sum, histogram.count = total, count
+            histograms[name][action] = histogram
+        for name, action, bucket, count in connection.execute(
+                'SELECT histogram, action, bucket, count FROM buckets'):
+            if action in histograms[name]:
+                histograms[name][action].counts[bucket] = count
+        phase_seconds = dict(((action, phase), seconds)
+                for action, phase, seconds in connection.execute(
+                    'SELECT action, phase, seconds FROM phases'))
+        return (requests, histograms['latency'], histograms['size'],
+                phase_seconds)
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            for table in ('requests', 'buckets', 'histograms', 'phases'):
+                connection.execute('DELETE FROM %s' % table)
+
+
+__metrics = MemoryMetrics()
+# SQLiteMetrics shared with other processes (see share_metrics())
+__shared_metrics = None
+
+def share_metrics(path=None):
+    '''
+    Shares the metrics from now on through the given SQLite DB
+    (METRICS_DB_FNAME in WORK_DIR by default) with all processes doing
+    the same, starting from empty metrics. To be called by servers
+    before forking the processes serving requests, which then add
+    their metrics to the DB with flush_metrics().
+    '''
+    global __shared_metrics
+    if path is None:
+        from config import WORK_DIR
+        path = path_join(WORK_DIR, METRICS_DB_FNAME)
+    metrics = SQLiteMetrics(path)
+    metrics.clear()
+    __metrics.take()
+    __shared_metrics = metrics
+
+def flush_metrics():
+    '''
+    Adds the metrics recorded by this process since the last call to
+    the shared DB (see share_metrics()). Keeps them for the next call
+    if the DB can't be written.
+    '''
+    if __shared_metrics is None:
+        return
+    metrics = __metrics.take()
+    if not metrics[0]:
+        # no requests
+        return
+    import sqlite3 as sqlite
+    try:
+        __shared_metrics.add(metrics)
+    except sqlite.Error:
+        __metrics.add(metrics)
+
+def start_metrics_flusher(interval=METRICS_FLUSH_INTERVAL):
+    '''
+    Starts a thread calling flush_metrics() every interval seconds, for
+    long-running processes serving requests.
+    '''
+    def flush_periodically():
+        while True:
+            sleep(interval)
+            flush_metrics()
+    thread = Thread(target=flush_periodically, name='metrics flusher')
+    thread.daemon = True
+    thread.start()
+
+
+@contextmanager
+def timer(phase):
+    '''
+    Adds the time spent in the with-block to the given phase of the
+    current request.
+    '''
+    start = time()
+    try:
+        yield
+    finally:
+        add_time(phase, time() - start)
+
+def add_time(phase, seconds):
+    timings = get_context().timings
+    timings[phase] = timings.get(phase, 0) + seconds
+
+def response_size(body):
+    '''
+    Returns the size of a response body, either a string or an open
+    file to be streamed to the client.
+    '''
+    if isinstance(body, basestring):
+        return len(body)
+    else:
+        return fstat(body.fileno()).st_size - body.tell()
+
+def record_request(context, body):
+    '''
+    Records the metrics of the finished request of the given context.
+    '''
+    duration = time() - context.started
+    size = response_size(body)
+    action = context.action or UNKNOWN_ACTION
+
+    __metrics.record(action, context.error, duration, size, context.timings)
+
+    if METRICS_LOG:
+        _log_request(context, action, duration, size)
+
+def _log_request(context, action, duration, size):
+    from config import WORK_DIR
+
+    line = dumps({
+            'time': context.started,
+            'action': action,
+            'collection': context.collection,
+            'document': context.document,
+            'user': context.user,
+            'error': context.error,
+            'duration': duration,
+            'size': size,
+            'phases': context.timings,
+            })
+    # a single append of a line is not interleaved with those of other
+    # processes
+    with open(path_join(WORK_DIR, METRICS_LOG_FNAME), 'a') as log_file:
+        log_file.write(line + '\n')
+
+def _labels(**kwargs):
+    return '{%s}' % ','.join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\'
+        ).replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(kwargs.iteritems()))
+
+def _format_histogram(lines, name, histograms):
+    for action, histogram in sorted(histograms.iteritems()):
+        for bucket, count in histogram.cumulative_counts():
+            lines.append('%s_bucket%s %d' % (name,
+                _labels(action=action, le=bucket), count))
+        lines.append('%s_sum%s %r' % (name, _labels(action=action),
+            histogram.sum))
+        lines.append('%s_count%s %d' % (name, _labels(action=action),
+            histogram.count))
+
+def prometheus_text():
+    '''
+    Returns the metrics of this process, or of all processes sharing
+    them (see share_metrics()), in the Prometheus text format.
+    '''
+    if __shared_metrics is None:
+        requests, latency, size, phase_seconds = __metrics.snapshot()
+    else:
+        flush_metrics()
+        requests, latency, size, phase_seconds = \
+                __shared_metrics.snapshot()
+    lines = []
+    lines.append('# HELP brat_requests_total Requests served by action'
+            ' and error (empty if none).')
+    lines.append('# TYPE brat_requests_total counter')
+    for (action, error), count in sorted(requests.iteritems()):
+        lines.append('brat_requests_total%s %d' % (
+            _labels(action=action, error=error or ''), count))
+
+    lines.append('# HELP brat_request_duration_seconds Request latency'
+            ' by action.')
+    lines.append('# TYPE brat_request_duration_seconds histogram')
+    _format_histogram(lines, 'brat_request_duration_seconds', latency)
+
+    lines.append('# HELP brat_response_size_bytes Response size'
+            ' by action.')
+    lines.append('# TYPE brat_response_size_bytes histogram')
+    _format_histogram(lines, 'brat_response_size_bytes', size)
+
+    lines.append('# HELP brat_phase_seconds_total Time spent in the'
+            ' phases of requests by action.')
+    lines.append('# TYPE brat_phase_seconds_total counter')
+    for (action, phase), seconds in sorted(phase_seconds.iteritems()):
+        lines.append('brat_phase_seconds_total%s %r' % (
+            _labels(action=action, phase=phase), seconds))
+    return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+if __name__ == '__main__':
+    from context import begin_request, end_request
+    from unittest import TestCase
+    import unittest
+
+    class MetricsTest(TestCase):
+        def test_histogram(self):
+            histogram = Histogram((1, 10))
+            for value in (0.5, 1, 5, 50):
+                histogram.observe(value)
+            self.assertEqual(list(histogram.cumulative_counts()),
+                             [(1, 2), (10, 3), ('+Inf', 4)])
+            self.assertEqual(histogram.sum, 56.5)
+
+        def test_record(self):
+            context = begin_request()
+            context.action = 'getDocument'
+            with timer('action'):
+                pass
+            add_time('action', 1.0)
+            record_request(context, 'x' * 2000)
+            end_request()
+            text = prometheus_text()
+            self.assertTrue('brat_requests_total{action="getDocument",'
+                    'error=""} 1\n' in text)
+            self.assertTrue('brat_response_size_bytes_bucket{'
+                    'action="getDocument",le="10240"} 1\n' in text)
+            self.assertTrue('brat_phase_seconds_total{action="getDocument",'
+                    'phase="action"} 1.0' in text)
+
+        def test_shared_between_processes(self):
+            from os import fork, waitpid, _exit
+            from shutil import rmtree
+            from tempfile import mkdtemp
+            tmp_dir = mkdtemp()
+            try:
+                share_metrics(path_join(tmp_dir, METRICS_DB_FNAME))
+                pid = fork()
+                if pid == 0:
+                    # record a request in another process
+                    context = begin_request()
+                    context.action = 'getCollectionInformation'
+                    add_time('action', 0.5)
+                    record_request(context, 'x' * 2000)
+                    end_request()
+                    flush_metrics()
+                    _exit(0)
+                waitpid(pid, 0)
+                # and one in this one, not yet flushed
+                context = begin_request()
+                context.action = 'getCollectionInformation'
+                record_request(context, 'x')
+                end_request()
+                text = prometheus_text()
+                self.assertTrue('brat_requests_total{'
+                        'action="getCollectionInformation",error=""} 2\n'
+                        in text)
+                self.assertTrue('brat_response_size_bytes_bucket{'
+                        'action="getCollectionInformation",le="1024"} 1\n'
+                        in text)
+                self.assertTrue('brat_response_size_bytes_bucket{'
+                        'action="getCollectionInformation",le="10240"} 2\n'
+                        in text)
+                self.assertTrue('brat_phase_seconds_total{'
+                        'action="getCollectionInformation",phase="action"} 0.5'
+                        in text)
+            finally:
+                globals()['__shared_metrics'] = None
+                rmtree(tmp_dir)
+
+    unittest.main()
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Built-in approximate string matching index, an alternative to the
+simstring library requiring no native code.
+
+Provides writer and reader classes with the subset of the simstring
+interface used by brat, and implements the same retrieval semantics
+(n-gram sets as in ngrams(), cosine and overlap similarity
+measures). Strings are stored ordered by the size of their n-gram
+set, and each n-gram has a sorted array of the IDs of the strings
+containing it. Lookup memory-maps the index file and finds the
+strings sharing enough n-grams with the query using the CPMerge
+algorithm of Okazaki and Tsujii (2010).
+'''
+
+from __future__ import with_statement
+
+import mmap
+import struct
+import sys
+
+from array import array
+from bisect import bisect_left
+from math import ceil, floor, sqrt
+
+# Length of n-grams
+DEFAULT_NGRAM_LENGTH = 3
+
+# Whether to include marks for begins and ends of strings
+DEFAULT_INCLUDE_MARKS = False
+
+# Similarity measures (values of reader.measure)
+cosine = 'cosine'
+overlap = 'overlap'
+
+# Index file identifier and format version
+MAGIC = 'BRATNGDB'
+VERSION = 1
+
+# Header: magic, version, n-gram length, marks flag, counts of strings,
+# n-grams and n-gram set sizes, and byte offsets of the sections
+# following the header.
+HEADER_FORMAT = '<8s7I6Q'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+class ngramdbFormatError(Exception):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __str__(self):
+        return u'File "%s" is not a valid n-gram index' % self.fn
+
+def ngrams(s, out=None, n=DEFAULT_NGRAM_LENGTH, be=DEFAULT_INCLUDE_MARKS):
+    '''
+    Extracts n-grams from the given string s and adds them into the
+    given set out (or a new set if None). Returns the set. If be is
+    True, affixes begin and end markers to strings.
+    '''
+
+    if out is None:
+        out = set()
+
+    # implementation mirroring ngrams() in ngram.h in simstring-1.0
+    # distribution.
+
+    mark = '\x01'
+    src = ''
+    if be:
+        # affix begin/end marks
+        for i in range(n-1):
+            src += mark
+        src += s
+        for i in range(n-1):
+            src += mark
+    elif len(s) < n:
+        # pad strings shorter than n
+        src = s
+        for i in range(n-len(s)):
+            src += mark
+    else:
+        src = s
+
+    # count n-grams
+    stat = {}
+    for i in range(len(src)-n+1):
+        ngram = src[i:i+n]
+        stat[ngram] = stat.get(ngram, 0) + 1
+
+    # convert into a set
+    for ngram, count in stat.items():
+        out.add(ngram)
+        # add ngram affixed with number if it appears more than once
+        for i in range(1, count):
+            out.add(ngram+str(i+1))
+
+    return out
+
+def _size_range(measure, query_size, threshold, max_size):
+    # sizes of n-gram sets that can be similar enough to a query with
+    # the given n-gram set size (as in measure.h in simstring-1.0)
+    if measure == cosine:
+        min_size = int(ceil(threshold * threshold * query_size))
+        max_size = min(int(floor(query_size / (threshold * threshold))),
+                       max_size)
+    elif measure == overlap:
+        min_size = 1
+    else:
+        raise ValueError('unsupported similarity measure %s' % measure)
+    return max(min_size, 1), max_size
+
+def _min_match(measure, query_size, size, threshold):
+    # minimum number of shared n-grams for strings with the given
+    # n-gram set sizes to be similar enough
+    if measure == cosine:
+        return int(ceil(threshold * sqrt(query_size * size)))
+    else:
+        return int(ceil(threshold * min(query_size, size)))
+
+def _uint32_array(values=()):
+    a = array('I', values)
+    assert a.itemsize == 4, 'array typecode I not 32 bits'
+    return a
+
+def _to_little_endian(a):
+    if sys.byteorder != 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a
+
+class writer(object):
+    '''
+    Builds an n-gram index file from inserted UTF-8 byte strings.
+    The index is written when close() is called.
+    '''
+
+    def __init__(self, filename, n=DEFAULT_NGRAM_LENGTH,
+                 be=DEFAULT_INCLUDE_MARKS):
+        self.filename = filename
+        self.n = n
+        self.be = be
+        self._strings = []
+        self._ngrams = []
+        self._seen = set()
+
+    def insert(self, s):
+        # n-grams are extracted here rather than in close() so that
+        # the work overlaps with producing the strings when inserting
+        # from a separate process (see tools/norm_db_init.py --bulk)
+        if s not in self._seen:
+            self._seen.add(s)
+            self._strings.append(s)
+            self._ngrams.append(ngrams(s, n=self.n, be=self.be))
+
+    def close(self):
+        n, be = self.n, self.be
+
+        # number string IDs in order of n-gram set size
+        string_ngrams = self._ngrams
+        order = sorted(range(len(self._strings)),
+                       key=lambda i: len(string_ngrams[i]))
+        max_size = max([len(g) for g in string_ngrams] + [0])
+
+        # first ID for strings of each size (0 to max_size+1)
+        size_starts = _uint32_array()
+        postings = {}
+        string_offsets = _uint32_array([0])
+        string_data = []
+        offset = 0
+        for sid, i in enumerate(order):
+            size = len(string_ngrams[i])
+            while len(size_starts) <= size:
+                size_starts.append(sid)
+            for g in string_ngrams[i]:
+                postings.setdefault(g, _uint32_array()).append(sid)
+            string_data.append(self._strings[i])
+            offset += len(self._strings[i])
+            string_offsets.append(offset)
+        while len(size_starts) <= max_size + 1:
+            size_starts.append(len(order))
+
+        grams = sorted(postings)
+        gram_offsets = _uint32_array([0])
+        posting_offsets = _uint32_array([0])
+        offset, posting_count = 0, 0
+        for g in grams:
+            offset += len(g)
+            gram_offsets.append(offset)
+            posting_count += len(postings[g])
+            posting_offsets.append(posting_count)
+
+        with open(self.filename, 'wb') as out:
+            out.write('\0' * HEADER_SIZE)
+            section_offsets = []
+            for section in (size_starts, string_offsets, gram_offsets,
+                            posting_offsets):
+                section_offsets.append(out.tell())
+                out.write(_to_little_endian(section).tostring())
+            section_offsets.append(out.tell())
+            for g in grams:
+                _to_little_endian(postings[g]).tofile(out)
+            section_offsets.append(out.tell())
+            out.write(''.join(string_data))
+            for g in grams:
+                out.write(g)
+
+            out.seek(0)
+            out.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, n, int(be),
+                                  len(order), len(grams), max_size, 0,
+                                  *section_offsets))
+
+        self._strings = []
+        self._ngrams = []
+        self._seen = set()
+
+class _Postings(object):
+    '''
+    Sequence view of an array of 32-bit integers in a memory-mapped
+    index, supporting len() and indexing (and thus bisect).
+    '''
+    def __init__(self, mm, offset, length):
+        self._mm = mm
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<I', self._mm, self._offset + 4*i)[0]
+
+    def slice(self, start, end):
+        # copy a range of values into an array
+        a = array('I')
+        a.fromstring(self._mm[self._offset+4*start:self._offset+4*end])
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return a
+
+class reader(object):
+    '''
+    Retrieves the strings in an n-gram index file similar to a query
+    string by the similarity measure and threshold given as the
+    measure and threshold attributes.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.measure = cosine
+        self.threshold = 0.7
+
+        with open(filename, 'rb') as f:
+            try:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                raise ngramdbFormatError(filename)
+        if len(self._mm) < HEADER_SIZE:
+            raise ngramdbFormatError(filename)
+        header = struct.unpack_from(HEADER_FORMAT, self._mm, 0)
+        if header[0] != MAGIC or header[1] != VERSION:
+            raise ngramdbFormatError(filename)
+
+        (self.n, self.be, self._string_count, self._gram_count,
+         self._max_size) = header[2], bool(header[3]), header[4], header[5], header[6]
+        (size_offset, string_offset, gram_offset, posting_offset,
+         postings_offset, data_offset) = header[8:14]
+
+        mm = self._mm
+        # size index is small, read into memory
+        self._size_starts = _Postings(mm, size_offset,
+                                      self._max_size+2).slice(0, self._max_size+2)
+        self._string_offsets = _Postings(mm, string_offset,
+                                         self._string_count+1)
+        self._gram_offsets = _Postings(mm, gram_offset, self._gram_count+1)
+        self._posting_offsets = _Postings(mm, posting_offset,
+                                          self._gram_count+1)
+        self._postings_offset = postings_offset
+        self._string_data_offset = data_offset
+        self._gram_data_offset = data_offset + self._string_offsets[self._string_count]
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def _string(self, sid):
+        start = self._string_data_offset + self._string_offsets[sid]
+        end = self._string_data_offset + self._string_offsets[sid+1]
+        return self._mm[start:end]
+
+    def _gram_postings(self, gram):
+        # binary search for the n-gram, return its postings (or None)
+        base, offsets, mm = self._gram_data_offset, self._gram_offsets, self._mm
+        lo, hi = 0, self._gram_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            g = mm[base+offsets[mid]:base+offsets[mid+1]]
+            if g < gram:
+                lo = mid + 1
+            elif g > gram:
+                hi = mid
+            else:
+                start = self._posting_offsets[mid]
+                end = self._posting_offsets[mid+1]
+                return _Postings(mm, self._postings_offset + 4*start,
+                                 end - start)
+        return None
+
+    def _cpmerge(self, lists, tau, results):
+        # Adds to results the IDs appearing in at least tau of the
+        # given sorted ID arrays (CPMerge). Any such ID must appear in
+        # one of the len(lists)-tau+1 shortest lists; candidates from
+        # these are verified against the rest by binary search.
+        lists = sorted(lists, key=len)
+        split = len(lists) - tau + 1
+
+        counts = {}
+        for postings in lists[:split]:
+            for sid in postings:
+                counts[sid] = counts.get(sid, 0) + 1
+
+        remaining = len(lists) - split
+        for postings in lists[split:]:
+            remaining -= 1
+            end = len(postings)
+            for sid in counts.keys():
+                count = counts[sid]
+                if count >= tau:
+                    continue
+                i = bisect_left(postings, sid)
+                if i < end and postings[i] == sid:
+                    count += 1
+                    counts[sid] = count
+                if count + remaining < tau:
+                    del counts[sid]
+
+        for sid, count in counts.iteritems():
+            if count >= tau:
+                results.append(sid)
+
+    def retrieve(self, s):
+        '''
+        Returns the strings in the index similar to the given UTF-8
+        byte string.
+        '''
+        return self._retrieve(s, {})
+
+    def retrieve_many(self, strs):
+        '''
+        Returns a list with the result of retrieve() for each of the
+        given UTF-8 byte strings, looking up each n-gram shared by
+        the strings only once.
+        '''
+        gram_postings = {}
+        return [self._retrieve(s, gram_postings) for s in strs]
+
+    def _retrieve(self, s, gram_postings):
+        # retrieve(), with the postings of n-grams found earlier in the
+        # given dict
+        query = ngrams(s, n=self.n, be=self.be)
+        query_size = len(query)
+        min_size, max_size = _size_range(self.measure, query_size,
+                                         self.threshold, self._max_size)
+        if min_size > max_size:
+            return []
+        size_starts = self._size_starts
+        first_id = size_starts[min_size]
+        last_id = size_starts[max_size+1]
+
+        # postings of each query n-gram restricted to the ID range of
+        # strings of eligible sizes. Copying the range is cheap
+        # compared to binary searches on the mapped file.
+        lists = []
+        for gram in query:
+            try:
+                postings = gram_postings[gram]
+            except KeyError:
+                postings = gram_postings[gram] = self._gram_postings(gram)
+            if postings is None:
+                lists.append(array('I'))
+                continue
+            start = bisect_left(postings, first_id)
+            end = bisect_left(postings, last_id)
+            lists.append(postings.slice(start, end))
+
+        # The minimum number of matching n-grams depends on the size
+        # of the n-gram set of the string. Merge separately for each
+        # range of sizes with the same minimum, i.e. the same range
+        # of string IDs.
+        results = []
+        size = min_size
+        while size <= max_size:
+            tau = _min_match(self.measure, query_size, size, self.threshold)
+            next_size = size + 1
+            while (next_size <= max_size and
+                   _min_match(self.measure, query_size, next_size,
+                              self.threshold) == tau):
+                next_size += 1
+            if tau <= query_size:
+                range_first = size_starts[size]
+                range_last = size_starts[next_size]
+                if range_first != range_last:
+                    sublists = [l[bisect_left(l, range_first):
+                                  bisect_left(l, range_last)] for l in lists]
+                    self._cpmerge(sublists, max(tau, 1), results)
+            size = next_size
+
+        return [self._string(sid) for sid in sorted(results)]
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    from tempfile import mkstemp
+    import os
+    import random
+    import unittest
+
+    def naive_retrieve(strings, s, measure, threshold):
+        x = ngrams(s)
+        found = []
+        min_size, max_size = _size_range(measure, len(x), threshold,
+                                         sys.maxint)
+        for t in strings:
+            y = ngrams(t)
+            if len(y) < min_size or len(y) > max_size:
+                continue
+            if len(x & y) >= _min_match(measure, len(x), len(y), threshold):
+                found.append(t)
+        return sorted(found)
+
+    class NgramDBTest(TestCase):
+        def setUp(self):
+            fh, self.fn = mkstemp()
+            os.close(fh)
+            rnd = random.Random(0)
+            self.strings = sorted(set(
+                    ''.join(rnd.choice('abcde ') for i in range(rnd.randint(1, 12)))
+                    for j in range(500)))
+            w = writer(self.fn)
+            for s in self.strings:
+                w.insert(s)
+            w.close()
+
+        def tearDown(self):
+            os.remove(self.fn)
+
+        def test_retrieve(self):
+            r = reader(self.fn)
+            rnd = random.Random(1)
+            for measure in (cosine, overlap):
+                for threshold in (0.5, 0.7, 1.0):
+                    r.measure, r.threshold = measure, threshold
+                    for i in range(50):
+                        q = ''.join(rnd.choice('abcde ') for i in range(rnd.randint(1, 10)))
+                        self.assertEqual(sorted(r.retrieve(q)),
+                                         naive_retrieve(self.strings, q,
+                                                        measure, threshold))
+            r.close()
+
+        def test_retrieve_many(self):
+            r = reader(self.fn)
+            rnd = random.Random(2)
+            queries = [''.join(rnd.choice('abcde ') for i in range(rnd.randint(1, 10)))
+                       for j in range(50)]
+            for measure in (cosine, overlap):
+                r.measure = measure
+                self.assertEqual(r.retrieve_many(queries),
+                                 [r.retrieve(q) for q in queries])
+            r.close()
+
+        def test_exact(self):
+            r = reader(self.fn)
+            r.threshold = 1.0
+            for s in self.strings[:20]:
+                self.assertTrue(s in r.retrieve(s))
+            r.close()
+
+    unittest.main()
@@ -12,10 +12,30 @@ import sdistance
 from datetime import datetime
 from message import Messager
 
+from os.path import join as path_join
+
+from annotation import (TextAnnotations, NormalizationAnnotation,
+                        AnnotationsIsReadOnlyError, TEXT_FILE_SUFFIX)
+from annotator import ModificationTracker, _json_from_ann
 from normdb import string_norm_form
-from document import real_directory
+from document import real_directory, _listdir
+from jsonwrap import loads as json_loads
+from lrucache import LRUCache
 from projectconfig import ProjectConfiguration
 
+try:
+    from config import NORM_CACHE_SIZE
+except ImportError:
+    NORM_CACHE_SIZE = 10000
+try:
+    from config import NORM_SEARCH_CACHE_SIZE
+except ImportError:
+    NORM_SEARCH_CACHE_SIZE = 100
+try:
+    from config import NORM_SCORE_CACHE_SIZE
+except ImportError:
+    NORM_SCORE_CACHE_SIZE = 100000
+
 # whether to display alignment scores in search result table
 DISPLAY_SEARCH_SCORES = False
 
@@ -30,10 +50,45 @@ MAX_DIFF_TO_BEST_SCORE = 200
 # maximum number of search results to return
 MAX_SEARCH_RESULT_NUMBER = 1000
 
+# number of candidate names scored together (see _norm_score_batch)
+NORM_SCORE_BATCH_SIZE = 256
+
+# best alignment score (tsuruoka_local) below which a search also
+# tries parts of the query as attributes
+# TODO: reconsider arbitrary cutoff
+NORM_SEARCH_PARTS_SCORE = 900
+
+# minimum alignment score (tsuruoka_local) of the best match for
+# norm_auto() to normalize an entity
+NORM_AUTO_MIN_SCORE = 900
+
+# number of documents norm_auto() reads, and looks up the entities
+# of, together
+NORM_AUTO_DOCUMENT_BATCH_SIZE = 100
+
 NORM_LOOKUP_DEBUG = True
 
 REPORT_LOOKUP_TIMINGS = False
 
+# caches of DB entry data, search results and alignment scores, kept
+# apart so that the many scores computed for each search do not evict
+# the others. Keys of values read from a DB include the state of the
+# DB file so that entries are not used once the DB has been rebuilt.
+__data_cache = LRUCache(NORM_CACHE_SIZE)
+__search_cache = LRUCache(NORM_SEARCH_CACHE_SIZE)
+__score_cache = LRUCache(NORM_SCORE_CACHE_SIZE)
+
+def norm_cache_stats():
+    '''
+    Returns the size and hit/miss counts of each normalization cache,
+    by the kind of the cached values.
+    '''
+    return {
+        'data': __data_cache.stats(),
+        'search': __search_cache.stats(),
+        'score': __score_cache.stats(),
+        }
+
 # debugging
 def _check_DB_version(database):
     # TODO; not implemented yet for new-style SQL DBs.
@@ -47,28 +102,59 @@ def _report_timings(dbname, start, msg=None):
     Messager.info("Processed " + str(queries) + " queries in " + strdelta +
                   (msg if msg is not None else ""))
 
-def _get_db_path(database, collection):
+def _get_db_config(database, collection):
+    # returns (DB path, approximate string index type) for the given
+    # DB as configured for the collection, None for values not
+    # configured.
     if collection is None:
         # TODO: default to WORK_DIR config?
-        return None
+        return None, None
     else:
         try:
             conf_dir = real_directory(collection)
             projectconf = ProjectConfiguration(conf_dir)
             norm_conf = projectconf.get_normalization_config()
             for entry in norm_conf:
-                dbname, dbpath = entry[0], entry[3]
+                dbname, dbpath, dbindex = entry[0], entry[3], entry[4]
                 if dbname == database:                    
-                    return dbpath
+                    return dbpath, dbindex
             # not found in config.
             Messager.warning('DB '+database+' not defined in config for '+
                              collection+', falling back on default.')
-            return None
+            return None, None
         except Exception:
             # whatever goes wrong, just warn and fall back on the default.
             Messager.warning('Failed to get DB path from config for '+
                              collection+', falling back on default.')
-            return None
+            return None, None
+
+def _data_by_id(dbpath, key):
+    # normdb.data_by_id() through the data cache
+    cache_key = (dbpath, normdb.db_file_state(dbpath), key)
+    data = __data_cache.get(cache_key)
+    if data is None:
+        data = normdb.data_by_id(dbpath, key)
+        if data is not None:
+            __data_cache.put(cache_key, data)
+    return data
+
+def _datas_by_ids(dbpath, keys):
+    # normdb.datas_by_ids() through the data cache, returns a
+    # dict mapping each found key to its data
+    state = normdb.db_file_state(dbpath)
+    datas, missing = {}, []
+    for key in set(keys):
+        data = __data_cache.get((dbpath, state, key))
+        if data is None:
+            missing.append(key)
+        else:
+            datas[key] = data
+    if missing:
+        found = normdb.datas_by_ids(dbpath, missing)
+        for key, data in (found or {}).items():
+            __data_cache.put((dbpath, state, key), data)
+            datas[key] = data
+    return datas
 
 def norm_get_name(database, key, collection=None):
     if NORM_LOOKUP_DEBUG:
@@ -76,13 +162,13 @@ def norm_get_name(database, key, collection=None):
     if REPORT_LOOKUP_TIMINGS:
         lookup_start = datetime.now()
 
-    dbpath = _get_db_path(database, collection)
+    dbpath, _ = _get_db_config(database, collection)
     if dbpath is None:
         # full path not configured, fall back on name as default
         dbpath = database
 
     try:
-        data = normdb.data_by_id(dbpath, key)
+        data = _data_by_id(dbpath, key)
     except normdb.dbNotFoundError, e:
         Messager.warning(str(e))
         data = None
@@ -110,13 +196,13 @@ def norm_get_data(database, key, collection=None):
     if REPORT_LOOKUP_TIMINGS:
         lookup_start = datetime.now()
 
-    dbpath = _get_db_path(database, collection)
+    dbpath, _ = _get_db_config(database, collection)
     if dbpath is None:
         # full path not configured, fall back on name as default
         dbpath = database
 
     try:
-        data = normdb.data_by_id(dbpath, key)
+        data = _data_by_id(dbpath, key)
     except normdb.dbNotFoundError, e:
         Messager.warning(str(e))
         data = None
@@ -135,6 +221,47 @@ def norm_get_data(database, key, collection=None):
         }
     return json_dic    
 
+def norm_get_names(keys, collection=None):
+    # batch version of norm_get_name and norm_get_data: given a JSON
+    # list of [database, key] pairs, returns [database, key, name,
+    # data] for each, looking up all keys for a DB together.
+    if REPORT_LOOKUP_TIMINGS:
+        lookup_start = datetime.now()
+
+    pairs = json_loads(keys)
+
+    keys_by_db = {}
+    for database, key in pairs:
+        keys_by_db.setdefault(database, []).append(key)
+
+    datas_by_db = {}
+    for database, db_keys in keys_by_db.items():
+        dbpath, _ = _get_db_config(database, collection)
+        if dbpath is None:
+            # full path not configured, fall back on name as default
+            dbpath = database
+
+        try:
+            datas_by_db[database] = _datas_by_ids(dbpath, db_keys)
+        except normdb.dbNotFoundError, e:
+            Messager.warning(str(e))
+            datas_by_db[database] = {}
+
+        if REPORT_LOOKUP_TIMINGS:
+            _report_timings(database, lookup_start)
+
+    values = []
+    for database, key in pairs:
+        data = datas_by_db[database].get(key)
+        # first name, as in norm_get_name
+        name = data[0][0][1] if data is not None else None
+        values.append([database, key, name, data])
+
+    json_dic = {
+        'values' : values,
+        }
+    return json_dic
+
 # TODO: deprecated, confirm unnecessary and remove.
 # def norm_get_ids(database, name, collection=None):
 #     if NORM_LOOKUP_DEBUG:
@@ -142,7 +269,7 @@ def norm_get_data(database, key, collection=None):
 #     if REPORT_LOOKUP_TIMINGS:
 #         lookup_start = datetime.now()
 #
-#     dbpath = _get_db_path(database, collection)
+#     dbpath, _ = _get_db_config(database, collection)
 #     if dbpath is None:
 #         # full path not configured, fall back on name as default
 #         dbpath = database
@@ -247,21 +374,39 @@ def _norm_filter_score(score, best_score=MAX_SCORE):
 def _norm_score(substring, name, max_cost=500):
     # returns an integer score representing the similarity of the given
     # substring to the given name (larger is better).
-    cache = _norm_score.__cache
-    if (substring, name) not in cache:
+    cache_key = (substring, name)
+    score = __score_cache.get(cache_key)
+    if score is None:
         cost = sdistance.tsuruoka_local(substring, name, max_cost=max_cost)
         # debugging
         #Messager.info('%s --- %s: %d (max %d)' % (substring, name, cost, max_cost))
         score = MAX_SCORE - cost
-        cache[(substring, name)] = score
+        __score_cache.put(cache_key, score)
     # TODO: should we avoid exceeding max_cost? Cached values might.
-    return cache[(substring, name)]
-_norm_score.__cache = {}
+    return score
+
+def _norm_score_batch(substring, names, max_cost=500):
+    # returns a dict mapping each of the given names to its
+    # _norm_score() against the given substring, computing the
+    # scores missing from the cache at once.
+    scores, todo = {}, []
+    for name in set(names):
+        score = __score_cache.get((substring, name))
+        if score is None:
+            todo.append(name)
+        else:
+            scores[name] = score
+    costs = sdistance.tsuruoka_local_batch(substring, todo, max_cost=max_cost)
+    for name, cost in zip(todo, costs):
+        scores[name] = MAX_SCORE - cost
+        __score_cache.put((substring, name), scores[name])
+    return scores
 
 def _norm_search_name_attr(database, name, attr,
                            matched, score_by_id, score_by_str,
                            best_score=0, exactmatch=False,
-                           threshold=simstringdb.DEFAULT_THRESHOLD):
+                           threshold=simstringdb.DEFAULT_THRESHOLD,
+                           index=None):
     # helper for norm_search, searches for matches where given name
     # appears either in full or as an approximate substring of a full
     # name (if exactmatch is False) in given DB. If attr is not None,
@@ -269,16 +414,21 @@ def _norm_search_name_attr(database, name, attr,
     # the matched name. Updates matched, score_by_id, and
     # score_by_str, returns best_score.
 
+    # with an FTS5 index, candidate names are looked up together with
+    # their IDs (and attributes) in the normalization DB
+    use_fts = index == simstringdb.FTS5_INDEX
+
     # If there are no strict substring matches for a given attribute
     # in the simstring DB, we can be sure that no query can succeed,
     # and can fail early.
     # TODO: this would be more effective (as would some other things)
     # if the attributes were in a separate simstring DB from the
     # names.
-    if attr is not None:
+    if attr is not None and not use_fts:
         utfattr = attr.encode('UTF-8')
         normattr = string_norm_form(utfattr)
-        if not simstringdb.ssdb_supstring_exists(normattr, database, 1.0):
+        if not simstringdb.ssdb_supstring_exists(normattr, database, 1.0,
+                                                 index):
             # debugging
             #Messager.info('Early norm search fail on "%s"' % attr)
             return best_score
@@ -287,13 +437,22 @@ def _norm_search_name_attr(database, name, attr,
         # only candidate string is given name
         strs = [name]
         ss_norm_score = { string_norm_form(name): 1.0 }
+    elif use_fts:
+        # expand to names sharing trigrams and filter as for simstring
+        normname = string_norm_form(name)
+        fts_matches = normdb.ids_by_name_fts(database, name, attr)
+        str_scores = simstringdb.supstring_filter(normname,
+                                                  set([m[2] for m in fts_matches]),
+                                                  threshold, True)
+        ss_norm_score = dict(str_scores)
     else:
         # expand to substrings using simstring
         # simstring requires UTF-8
         utfname = name.encode('UTF-8')
         normname = string_norm_form(utfname)
         str_scores = simstringdb.ssdb_supstring_lookup(normname, database,
-                                                       threshold, True)
+                                                       threshold, True,
+                                                       index)
         strs = [s[0] for s in str_scores]
         ss_norm_score = dict(str_scores)
 
@@ -302,7 +461,10 @@ def _norm_search_name_attr(database, name, attr,
 #         strs = [s for s in strs if (normname, s) not in score_by_str]
 
     # look up IDs
-    if attr is None:
+    if use_fts and not exactmatch:
+        id_names = [(i, n) for i, n, normn in fts_matches
+                    if normn in ss_norm_score]
+    elif attr is None:
         id_names = normdb.ids_by_names(database, strs, False, True)
     else:
         id_names = normdb.ids_by_names_attr(database, strs, attr, False, True)
@@ -317,26 +479,34 @@ def _norm_search_name_attr(database, name, attr,
     id_names = [(i, n) for i, n, s in id_name_scores]
 
     # update matches and scores
-    for i, n in id_names:
+    normsub = string_norm_form(name)
+    for pos, (i, n) in enumerate(id_names):
         if n not in matched:
             matched[n] = set()
         matched[n].add(i)
 
         max_cost = MAX_SCORE - best_score + MAX_DIFF_TO_BEST_SCORE + 1
+        if pos % NORM_SCORE_BATCH_SIZE == 0:
+            # score the following names together. As max_cost only
+            # decreases, the scores that differ from ones computed one
+            # at a time are too low to pass _norm_filter_score either way.
+            batch = id_names[pos:pos+NORM_SCORE_BATCH_SIZE]
+            batch_scores = _norm_score_batch(normsub, [string_norm_form(m)
+                                                       for j, m in batch],
+                                             max_cost)
         if (name, n) not in score_by_str:
             # TODO: decide whether to use normalized or unnormalized strings
             # for scoring here.
             #score_by_str[(name, n)] = _norm_score(name, n, max_cost)
-            score_by_str[(name, n)] = _norm_score(string_norm_form(name), string_norm_form(n), max_cost)
+            score_by_str[(name, n)] = batch_scores[string_norm_form(n)]
         score = score_by_str[(name, n)]
         best_score = max(score, best_score)
 
         score_by_id[i] = max(score_by_id.get(i, -1),
                              score_by_str[(name, n)])
 
-        # stop if max count reached
+        # stop if max count reached (reported by _norm_search_impl)
         if len(score_by_id) > MAX_SEARCH_RESULT_NUMBER:
-            Messager.info('Note: more than %d search results, only retrieving top matches' % MAX_SEARCH_RESULT_NUMBER)
             break
 
     return best_score
@@ -347,11 +517,53 @@ def _norm_search_impl(database, name, collection=None, exactmatch=False):
     if REPORT_LOOKUP_TIMINGS:
         lookup_start = datetime.now()
 
-    dbpath = _get_db_path(database, collection)
+    dbpath, dbindex = _get_db_config(database, collection)
     if dbpath is None:
         # full path not configured, fall back on name as default
         dbpath = database
 
+    header, items, truncated, _ = _norm_search_cached(dbpath, dbindex, name,
+                                                      exactmatch)
+    if truncated:
+        Messager.info('Note: more than %d search results, only retrieving top matches' % MAX_SEARCH_RESULT_NUMBER)
+
+    if REPORT_LOOKUP_TIMINGS:
+        _report_timings(database, lookup_start, 
+                        ", retrieved " + str(len(items)) + " items")
+                        
+    # echo request for sync
+    json_dic = {
+        'database' : database,
+        'query'    : name,
+        'header'   : header,
+        'items'    : items,
+        }
+    return json_dic
+
+def _norm_search_cached(dbpath, dbindex, name, exactmatch):
+    # _norm_search_db() through the search cache, keyed by the state
+    # of both the DB and its index, which may be rebuilt separately
+    try:
+        cache_key = (dbpath, normdb.db_file_state(dbpath),
+                     simstringdb.ssdb_file_state(dbpath, dbindex), dbindex,
+                     name, exactmatch)
+        cached = __search_cache.get(cache_key)
+    except normdb.dbNotFoundError:
+        # not cached, let the lookups fail
+        cache_key, cached = None, None
+
+    if cached is None:
+        cached = _norm_search_db(dbpath, dbindex, name, exactmatch)
+        if cache_key is not None:
+            __search_cache.put(cache_key, cached)
+    return cached
+
+def _norm_search_db(dbpath, dbindex, name, exactmatch):
+    # helper for _norm_search_impl, searches the given DB. Returns
+    # the header and items of the result table, whether the results
+    # were truncated to MAX_SEARCH_RESULT_NUMBER and the scores of
+    # the items.
+
     # maintain map from searched names to matching IDs and scores for
     # ranking
     matched = {}
@@ -361,19 +573,18 @@ def _norm_search_impl(database, name, collection=None, exactmatch=False):
     # look up hits where name appears in full
     best_score = _norm_search_name_attr(dbpath, name, None,
                                         matched, score_by_id, score_by_str,
-                                        0, exactmatch)
+                                        0, exactmatch, index=dbindex)
 
     # if there are no hits and we only have a simple candidate string,
     # look up with a low threshold
     if best_score == 0 and len(name.split()) == 1:
         best_score = _norm_search_name_attr(dbpath, name, None,
                                             matched, score_by_id, score_by_str,
-                                            0, exactmatch, 0.5)
+                                            0, exactmatch, 0.5, dbindex)
 
     # if there are no good hits, also consider only part of the input
     # as name and the rest as an attribute.
-    # TODO: reconsider arbitrary cutoff
-    if best_score < 900 and not exactmatch:
+    if best_score < NORM_SEARCH_PARTS_SCORE and not exactmatch:
         parts = name.split()        
 
         # prioritize having the attribute after the name
@@ -391,11 +602,13 @@ def _norm_search_impl(database, name, collection=None, exactmatch=False):
             best_score = _norm_search_name_attr(dbpath, start, end,
                                                 matched, score_by_id, 
                                                 score_by_str,
-                                                best_score, exactmatch)
+                                                best_score, exactmatch,
+                                                index=dbindex)
             best_score = _norm_search_name_attr(dbpath, end, start,
                                                 matched, score_by_id, 
                                                 score_by_str,
-                                                best_score, exactmatch)
+                                                best_score, exactmatch,
+                                                index=dbindex)
 
     # flatten to single set of IDs
     ids = reduce(set.union, matched.values(), set())
@@ -410,24 +623,15 @@ def _norm_search_impl(database, name, collection=None, exactmatch=False):
     datas = normdb.datas_by_ids(dbpath, ids)
     
     header, items = _format_datas(datas, score_by_id, matched)
+    scores = [score_by_id.get(item[0], 0) for item in items]
 
-    if REPORT_LOOKUP_TIMINGS:
-        _report_timings(database, lookup_start, 
-                        ", retrieved " + str(len(items)) + " items")
-                        
-    # echo request for sync
-    json_dic = {
-        'database' : database,
-        'query'    : name,
-        'header'   : header,
-        'items'    : items,
-        }
-    return json_dic
+    return (header, items, len(score_by_id) > MAX_SEARCH_RESULT_NUMBER,
+            scores)
 
 def norm_search(database, name, collection=None, exactmatch=False):
     try:
         return _norm_search_impl(database, name, collection, exactmatch)
-    except simstringdb.ssdbNotFoundError, e:
+    except (simstringdb.ssdbNotFoundError, normdb.ftsNotFoundError), e:
         Messager.warning(str(e))
         return { 
             'database' : database,
@@ -436,6 +640,186 @@ def norm_search(database, name, collection=None, exactmatch=False):
             'items' : []
             }
 
+def _norm_best_matches(database, names, collection=None):
+    # helper for norm_auto, returns a dict mapping each of the given
+    # names to the (ID, name, score) of its best match in the given
+    # DB, None for names without matches or with several equally good
+    # ones. Names found well enough in full are looked up together;
+    # the others are searched for one at a time as by norm_search,
+    # which also tries parts of the name as attributes.
+    dbpath, dbindex = _get_db_config(database, collection)
+    if dbpath is None:
+        # full path not configured, fall back on name as default
+        dbpath = database
+
+    names = list(set(names))
+    if not names:
+        return {}
+    elif dbindex == simstringdb.FTS5_INDEX:
+        # no batch query for the FTS5 table
+        best, rest = {}, names
+    else:
+        best, rest = _norm_best_full_matches(dbpath, dbindex, names)
+
+    for name in rest:
+        header, items, truncated, scores = _norm_search_cached(dbpath, dbindex,
+                                                               name, False)
+        if not items or (len(items) > 1 and scores[1] == scores[0]):
+            best[name] = None
+        else:
+            # the first field after the ID is the name (see _format_datas)
+            best[name] = (items[0][0], items[0][1], scores[0])
+    return best
+
+def _norm_best_full_matches(dbpath, dbindex, names):
+    # helper for _norm_best_matches, looks up the given names in full
+    # as the first query of _norm_search_db does, with one index query
+    # and one DB query each for the IDs and the data of the matches.
+    # Returns the best matches of the names scoring at least
+    # NORM_SEARCH_PARTS_SCORE, as for _norm_best_matches, and a list
+    # of the other names.
+
+    # simstring requires UTF-8
+    normnames = dict([(name, string_norm_form(name.encode('UTF-8')))
+                      for name in names])
+    strs_by_name = simstringdb.ssdb_supstring_lookup_batch(normnames.values(),
+                                                           dbpath,
+                                                           index=dbindex)
+    strs = set([s for found in strs_by_name.values() for s in found])
+
+    id_names_by_str = {}
+    for i, n in normdb.ids_by_names(dbpath, list(strs), False, True):
+        id_names_by_str.setdefault(string_norm_form(n), []).append((i, n))
+
+    best, rest, best_ids = {}, [], {}
+    for name in names:
+        id_names = [id_name for s in strs_by_name[normnames[name]]
+                    for id_name in id_names_by_str.get(s, [])]
+        # as for the first batch of _norm_search_name_attr, so that the
+        # cached scores agree
+        scores = _norm_score_batch(string_norm_form(name),
+                                   [string_norm_form(n) for i, n in id_names],
+                                   MAX_SCORE + MAX_DIFF_TO_BEST_SCORE + 1)
+        score_by_id, matched = {}, {}
+        for i, n in id_names:
+            score_by_id[i] = max(score_by_id.get(i, -1),
+                                 scores[string_norm_form(n)])
+            matched.setdefault(i, set()).add(n)
+
+        ranked = sorted(score_by_id.values(), reverse=True)
+        if not ranked or ranked[0] < NORM_SEARCH_PARTS_SCORE:
+            rest.append(name)
+        elif len(ranked) > 1 and ranked[1] == ranked[0]:
+            best[name] = None
+        else:
+            i = [i for i in score_by_id if score_by_id[i] == ranked[0]][0]
+            best_ids[name] = (i, matched[i], ranked[0])
+
+    datas = _datas_by_ids(dbpath, [i for i, m, score in best_ids.values()])
+    for name, (i, matched, score) in best_ids.items():
+        best[name] = (i, _shown_name(datas[i], matched), score)
+    return best, rest
+
+def _shown_name(data, matched):
+    # returns the name shown for the given DB entry in search results,
+    # the value of its first label, preferring the given matched names
+    # (see _format_datas)
+    label, value = data[0][0]
+    for group in data[:2]:
+        for l, v in group:
+            if l == label and v in matched:
+                return v
+    return value
+
+def _norm_auto_documents(collection, document, scope):
+    real_dir = real_directory(collection)
+    if scope == "collection":
+        # sorted for a stable order of document IDs in the response
+        return sorted([fn[:-len(TEXT_FILE_SUFFIX)-1]
+                       for fn in _listdir(real_dir)
+                       if fn.endswith('.' + TEXT_FILE_SUFFIX)])
+    else:
+        return [document]
+
+def norm_auto(collection, document, database, scope="document",
+              threshold=NORM_AUTO_MIN_SCORE):
+    # normalizes the entities in the given document or, if scope is
+    # "collection", in all documents of the collection, to their
+    # best matches in the given DB that score at least threshold.
+    # Entities already normalized to the DB are left alone. Each
+    # distinct entity text is searched for only once, together with
+    # the other new texts of up to NORM_AUTO_DOCUMENT_BATCH_SIZE
+    # documents.
+    threshold = int(threshold)
+    real_dir = real_directory(collection)
+    documents = _norm_auto_documents(collection, document, scope)
+
+    json_dic = {
+        'database' : database,
+        'queries'  : 0,
+        'normalized' : {},
+        }
+    best = {}
+    for start in range(0, len(documents), NORM_AUTO_DOCUMENT_BATCH_SIZE):
+        _norm_auto_batch(collection, real_dir,
+                         documents[start:start+NORM_AUTO_DOCUMENT_BATCH_SIZE],
+                         database, scope, threshold, best, json_dic)
+    json_dic['queries'] = len(best)
+
+    Messager.info('Normalized %d entities in %d documents' %
+                  (sum(json_dic['normalized'].values()),
+                   len(json_dic['normalized'])))
+    return json_dic
+
+def _norm_auto_batch(collection, real_dir, documents, database, scope,
+                     threshold, best, json_dic):
+    # helper for norm_auto, normalizes the entities of the given
+    # documents, reading each once. best maps the texts searched for
+    # so far to their matches (see _norm_best_matches) and is updated.
+    ann_objs, texts_by_doc = [], {}
+    for doc in documents:
+        ann_obj = TextAnnotations(path_join(real_dir, doc))
+        normalized = set([n.target for n in ann_obj.get_normalizations()
+                          if n.refdb == database])
+        texts_by_doc[doc] = [(e.id, e.get_text()) for e in
+                             ann_obj.get_entities() if e.id not in normalized]
+        ann_objs.append((doc, ann_obj))
+
+    new_texts = set([t for texts in texts_by_doc.values()
+                     for i, t in texts if t not in best])
+    try:
+        best.update(_norm_best_matches(database, new_texts, collection))
+    except (simstringdb.ssdbNotFoundError, normdb.ftsNotFoundError), e:
+        Messager.warning(str(e))
+        best.update(dict.fromkeys(new_texts))
+
+    for doc, ann_obj in ann_objs:
+        matches = [(i, best[t]) for i, t in texts_by_doc[doc]
+                   if best.get(t) is not None and best[t][2] >= threshold]
+        if not matches:
+            continue
+
+        with ann_obj:
+            if ann_obj._read_only:
+                if scope == "collection":
+                    Messager.warning('Document %s is read-only, not normalized' % doc)
+                    continue
+                raise AnnotationsIsReadOnlyError(ann_obj.get_document())
+
+            mods = ModificationTracker()
+            for target, (refid, reftext, score) in matches:
+                # TODO: avoid magic string value (as in annotator)
+                norm = NormalizationAnnotation(ann_obj.get_new_id('N'),
+                                               u'Reference', target, database,
+                                               refid, u'\t' + reftext)
+                ann_obj.add_annotation(norm)
+                mods.addition(norm)
+            json_dic['normalized'][doc] = len(mods)
+
+            if scope != "collection":
+                mods.json_response(json_dic)
+                json_dic['annotations'] = _json_from_ann(ann_obj)
+
 def _test():
     # test
     test_cases = {
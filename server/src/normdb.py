@@ -7,7 +7,10 @@ Functionality for normalization SQL database access.
 '''
 
 import sys
-from os.path import join as path_join, exists, sep as path_sep
+from os import stat
+from os.path import join as path_join, sep as path_sep
+from threading import local
+from urllib import pathname2url
 import sqlite3 as sqlite
 
 try:
@@ -31,8 +34,30 @@ NON_EMPTY_TABLES = set(["names"])
 # Maximum number of variables in one SQL query (TODO: get from lib!)
 MAX_SQL_VARIABLE_COUNT = 999
 
+# Name of the optional FTS5 trigram table of normalized names (created
+# by tools/norm_db_init.py --fts5)
+FTS_TABLE = 'names_fts'
+
+# Maximum number of distinct names retrieved by ids_by_name_fts
+FTS_CANDIDATE_LIMIT = 1000
+
+# Number of prepared statements cached per DB connection
+CACHED_STATEMENTS = 256
+
+# PRAGMAs applied to each new DB connection: map (part of) the DB file
+# to memory and use a larger page cache (negative values are in KiB).
+CONNECTION_PRAGMAS = [
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+]
+
 __query_count = {}
 
+# Open DB connections, reused across lookups. Connections can't be
+# shared between threads, so each thread has its own pool, mapping DB
+# file path to (connection, file state when connected).
+__connection_pool = local()
+
 class dbNotFoundError(Exception):
     def __init__(self, fn):
         self.fn = fn
@@ -40,6 +65,11 @@ class dbNotFoundError(Exception):
     def __str__(self):
         return u'Database file "%s" not found' % self.fn
 
+class ftsNotFoundError(dbNotFoundError):
+    def __str__(self):
+        return (u'Database file "%s" has no full-text index, create it '
+                u'with norm_db_init.py --fts5' % self.fn)
+
 # Normalizes a given string for search. Used to implement
 # case-insensitivity and similar in search.
 # NOTE: this is a different sense of "normalization" than that
@@ -78,18 +108,76 @@ def __increment_query_count(dbname):
     global __query_count
     __query_count[dbname] = __query_count.get(dbname, 0) + 1
 
+def __connect_read_only(dbfn):
+    # open DB for reading only, preferring a read-only connection
+    # (URI filenames) where supported by the python sqlite3 module
+    # and falling back to denying writes with PRAGMA query_only.
+    try:
+        connection = sqlite.connect('file:%s?mode=ro' % pathname2url(dbfn),
+                                    uri=True,
+                                    cached_statements=CACHED_STATEMENTS)
+    except TypeError:
+        # no URI support in this version of the library
+        connection = sqlite.connect(dbfn,
+                                    cached_statements=CACHED_STATEMENTS)
+        try:
+            connection.execute('PRAGMA query_only=ON')
+        except sqlite.OperationalError:
+            pass # old SQLite; not critical
+    for pragma in CONNECTION_PRAGMAS:
+        try:
+            connection.execute(pragma)
+        except sqlite.OperationalError:
+            pass # unsupported by SQLite version; not critical
+    return connection
+
+def db_file_state(dbname):
+    '''
+    Returns a value identifying the current version of the file
+    containing the given DB, changing whenever the file is replaced
+    or modified (e.g. rebuilt by norm_db_init.py).
+    '''
+    dbfn = __db_path(dbname)
+    try:
+        st = stat(dbfn)
+    except OSError:
+        raise dbNotFoundError(dbfn)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
 def _get_connection_cursor(dbname):
     # helper for DB access functions
     dbfn = __db_path(dbname)
 
-    # open DB
-    if not exists(dbfn):
-        raise dbNotFoundError(dbfn)
-    connection = sqlite.connect(dbfn)
+    # connections to a file that has since been replaced or modified
+    # are discarded
+    file_state = db_file_state(dbname)
+
+    try:
+        pool = __connection_pool.connections
+    except AttributeError:
+        pool = __connection_pool.connections = {}
+
+    connection, connected_state = pool.get(dbfn, (None, None))
+    if connection is not None and connected_state != file_state:
+        connection.close()
+        connection = None
+    if connection is None:
+        connection = __connect_read_only(dbfn)
+        pool[dbfn] = (connection, file_state)
+
     cursor = connection.cursor()
 
     return connection, cursor
 
+def close_connections():
+    '''
+    Closes the DB connections opened by the current thread.
+    '''
+    pool = getattr(__connection_pool, 'connections', {})
+    for connection, _ in pool.values():
+        connection.close()
+    pool.clear()
+
 def _execute_fetchall(cursor, command, args, dbname):
     # helper for DB access functions
     cursor.execute(command, args)
@@ -185,6 +273,61 @@ JOIN names N
     else:
         return [(r[0],r[1]) for r in responses]
 
+def _fts_match_expression(s):
+    # FTS5 query matching strings sharing any trigram with s
+    grams = sorted(set([s[i:i+3] for i in range(len(s)-2)]))
+    return ' OR '.join(['"%s"' % g.replace('"', '""') for g in grams])
+
+def ids_by_name_fts(dbname, name, attr=None, limit=FTS_CANDIDATE_LIMIT):
+    '''
+    Given a DB name, an entity name and optionally an attribute text,
+    returns (id, matched name, normalized matched name) for entities
+    with names sharing trigrams with the given name and, if given, an
+    attribute containing the given attribute. Names are looked up in
+    the FTS5 table of the DB, retrieving at most limit distinct names
+    ordered from the best match.
+    '''
+    connection, cursor = _get_connection_cursor(dbname)
+
+    normname = string_norm_form(name)
+    if len(normname) >= 3:
+        names = ('SELECT normvalue, rank FROM %s WHERE %s MATCH ? '
+                 'ORDER BY rank LIMIT ?' % (FTS_TABLE, FTS_TABLE))
+        args = [_fts_match_expression(normname), limit]
+    else:
+        # too short for trigrams
+        names = ('SELECT normvalue, 0 AS rank FROM %s WHERE normvalue '
+                 'LIKE ? LIMIT ?' % FTS_TABLE)
+        args = ['%'+normname+'%', limit]
+
+    command = '''
+SELECT E.uid, N.value, N.normvalue
+FROM (%s) S
+JOIN names N
+  ON N.normvalue = S.normvalue
+JOIN entities E
+  ON E.id = N.entity_id
+''' % names
+    if attr is not None:
+        # NOTE: using 'LIKE' as in _ids_by_names_attr
+        command += '''JOIN attributes A
+  ON E.id = A.entity_id
+WHERE A.normvalue LIKE ?
+'''
+        args.append('%'+string_norm_form(attr)+'%')
+    command += 'ORDER BY S.rank'
+
+    try:
+        responses = _execute_fetchall(cursor, command, args, dbname)
+    except sqlite.OperationalError, e:
+        if 'no such table' in str(e):
+            raise ftsNotFoundError(__db_path(dbname))
+        raise
+
+    cursor.close()
+
+    return [(r[0], r[1], r[2]) for r in responses]
+
 def ids_by_name_attr(dbname, name, attr, exactmatch=False, return_match=False):
     return ids_by_names_attr(dbname, [name], attr, exactmatch, return_match)
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Opt-in profiling of dispatched actions. A sample of requests, and all
+requests for the configured actions and collections, are run under
+cProfile and their profiles stored in the "profiles" directory of
+WORK_DIR together with a description of the request and its hottest
+functions. See tools/profile_summary.py for aggregating the profiles.
+'''
+
+from __future__ import with_statement
+
+from cProfile import Profile
+from os import getpid, listdir, makedirs
+from os.path import exists, join as path_join
+from pstats import Stats
+from random import random
+from time import time
+
+from context import get_context
+from jsonwrap import dumps
+
+try:
+    from config import PROFILE_SAMPLE_RATE
+except ImportError:
+    PROFILE_SAMPLE_RATE = 0
+try:
+    from config import PROFILE_ACTIONS
+except ImportError:
+    PROFILE_ACTIONS = ()
+try:
+    from config import PROFILE_COLLECTIONS
+except ImportError:
+    PROFILE_COLLECTIONS = ()
+try:
+    from config import PROFILE_MAX_PROFILES
+except ImportError:
+    PROFILE_MAX_PROFILES = 1000
+
+### Constants
+PROFILE_DIR_NAME = 'profiles'
+PROFILE_SUFFIX = '.prof'
+META_SUFFIX = '.json'
+# Number of functions listed in the description of each profile
+TOP_N = 20
+###
+
+
+def profile_dir():
+    from config import WORK_DIR
+    return path_join(WORK_DIR, PROFILE_DIR_NAME)
+
+def should_profile(action, collection):
+    if action in PROFILE_ACTIONS:
+        return True
+    if collection is not None:
+        for profiled in PROFILE_COLLECTIONS:
+            if collection.startswith(profiled):
+                return True
+    return PROFILE_SAMPLE_RATE > 0 and random() < PROFILE_SAMPLE_RATE
+
+def hot_functions(stats, n=TOP_N, sort='tottime'):
+    '''
+    Returns the n functions of the given pstats.Stats taking the most
+    time, as (function, calls, tottime, cumtime) tuples with functions
+    as "file:line(name)" strings.
+    '''
+    functions = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _
+            ) in stats.stats.iteritems():
+        functions.append(('%s:%d(%s)' % (filename, line, name), calls,
+            tottime, cumtime))
+    key = {'tottime': lambda f: f[2], 'cumtime': lambda f: f[3]}[sort]
+    functions.sort(key=key, reverse=True)
+    return functions[:n]
+
+def profile_call(function, args):
+    '''
+    Calls the function with the given arguments under cProfile, storing
+    the profile unless PROFILE_MAX_PROFILES profiles have already been
+    stored.
+    '''
+    profile = Profile()
+    start = time()
+    try:
+        return profile.runcall(function, *args)
+    finally:
+        duration = time() - start
+        try:
+            _store_profile(profile, duration)
+        except (IOError, OSError), e:
+            # Profiles are for the administrators, not the client
+            from logging import warning as log_warning
+            log_warning('Failed to store profile: %s' % (e, ))
+
+def _store_profile(profile, duration):
+    directory = profile_dir()
+    if not exists(directory):
+        makedirs(directory)
+    elif (PROFILE_MAX_PROFILES > 0 and len(listdir(directory)) >=
+            2 * PROFILE_MAX_PROFILES):
+        return
+
+    context = get_context()
+    action = context.action
+    base = path_join(directory, '%.6f-%d-%s' % (context.started, getpid(),
+        action))
+
+    stats = Stats(profile)
+    stats.dump_stats(base + PROFILE_SUFFIX)
+    with open(base + META_SUFFIX, 'w') as meta_file:
+        meta_file.write(dumps({
+                'time': context.started,
+                'action': action,
+                'collection': context.collection,
+                'document': context.document,
+                'user': context.user,
+                'duration': duration,
+                'hot': hot_functions(stats),
+                }))
+
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    import unittest
+
+    class ProfilingTest(TestCase):
+        def test_hot_functions(self):
+            def busy():
+                return sum(xrange(100000))
+            profile = Profile()
+            profile.runcall(busy)
+            hot = hot_functions(Stats(profile), n=1, sort='cumtime')
+            self.assertEqual(len(hot), 1)
+            self.assertTrue(hot[0][0].endswith('(busy)'))
+
+        def test_should_profile(self):
+            self.assertFalse(should_profile('getDocument', '/'))
+
+    unittest.main()
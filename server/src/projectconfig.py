@@ -13,12 +13,24 @@ Author:     Illes Solt          <solt tmit bme hu>
 Version:    2011-08-15
 '''
 
+from __future__ import with_statement
+
 import re
 import robotparser # TODO reduce scope
 import urlparse # TODO reduce scope
 import sys
 
+from hashlib import sha1
+from itertools import chain
+from os import stat
+
+try:
+    from cPickle import dump as pickle_dump, load as pickle_load, HIGHEST_PROTOCOL
+except ImportError:
+    from pickle import dump as pickle_dump, load as pickle_load, HIGHEST_PROTOCOL
+
 from annotation import open_textfile
+from context import get_context
 from message import Messager
 
 ENTITY_CATEGORY, EVENT_CATEGORY, RELATION_CATEGORY, UNKNOWN_CATEGORY = xrange(4)
@@ -32,6 +44,14 @@ __annotation_config_filename  = 'annotation.conf'
 __visual_config_filename      = 'visual.conf'
 __tools_config_filename       = 'tools.conf'
 __kb_shortcut_filename        = 'kb_shortcuts.conf'
+__config_filenames = (__access_control_filename, __annotation_config_filename,
+                      __visual_config_filename, __tools_config_filename,
+                      __kb_shortcut_filename)
+
+# compiled (parsed) configs are stored in this directory in WORK_DIR;
+# increase the version when the parsed form changes
+COMPILED_CONFIG_DIR_NAME = 'configs'
+COMPILED_CONFIG_VERSION = 1
 
 # annotation config section name constants
 ENTITY_SECTION    = "entities"
@@ -532,7 +552,7 @@ def __parse_access_control(acstr, source):
 def get_config_path(directory):
     return __read_first_in_directory_tree(directory, __annotation_config_filename)[1]
 
-def __read_first_in_directory_tree(directory, filename):
+def __directory_tree_paths(directory, filename):
     # config will not be available command-line invocations;
     # in these cases search whole tree
     try:
@@ -541,17 +561,23 @@ def __read_first_in_directory_tree(directory, filename):
         BASE_DIR = "/"
     from os.path import split, join
 
-    source, result = None, None
-
-    # check from the given directory and parents, but not above BASE_DIR
+    # paths in the given directory and parents, but not above BASE_DIR
     if directory is not None:
         # TODO: this check may fail; consider "foo//bar/data"
         while BASE_DIR in directory:
-            source = join(directory, filename)
-            result = __read_or_default(source, None)
-            if result is not None:
+            yield join(directory, filename)
+            parent = split(directory)[0]
+            if parent == directory:
                 break
-            directory = split(directory)[0]
+            directory = parent
+
+def __read_first_in_directory_tree(directory, filename):
+    source, result = None, None
+
+    for source in __directory_tree_paths(directory, filename):
+        result = __read_or_default(source, None)
+        if result is not None:
+            break
 
     return (result, source)
 
@@ -601,8 +627,132 @@ def __parse_configs(configstr, source, expected_sections, optional_sections):
 
     return (configs, section_labels)
             
+def __config_file_stamp(directory, filename):
+    # (path, mtime, size) of the config file used for the directory: the
+    # first found in the directory tree, or the default one
+    for path in chain(__directory_tree_paths(directory, filename), [filename]):
+        try:
+            st = stat(path)
+        except OSError:
+            continue
+        return (path, st.st_mtime, st.st_size)
+    return (None, None, None)
+
+__config_stamps = {}
+
+def validate_configs(directory):
+    '''
+    Drops everything cached for the configuration of the given directory
+    if any of its config files has been added, removed or modified since
+    it was cached. The files are checked at most once per request.
+    '''
+    validated = get_context().validated_configs
+    if directory in validated:
+        return
+    validated.add(directory)
+
+    stamps = dict((fn, __config_file_stamp(directory, fn))
+                  for fn in __config_filenames)
+    if __config_stamps.get(directory, stamps) != stamps:
+        for cache in ConfigCache.instances:
+            for key in cache.keys():
+                if (key == directory or
+                    (isinstance(key, tuple) and key[0] == directory)):
+                    dict.pop(cache, key, None)
+    __config_stamps[directory] = stamps
+
+def get_config_generation(directory):
+    '''
+    Returns a string identifying the current configuration of the given
+    directory, which changes whenever any of its config files changes.
+    Directories sharing their config files share the generation.
+    '''
+    validate_configs(directory)
+    return sha1(repr((COMPILED_CONFIG_VERSION,
+                      sorted(__config_stamps[directory].items())))).hexdigest()
+
+class ConfigCache(dict):
+    '''
+    Cache of values derived from the configuration of directories, keyed
+    by the directory or by tuples starting with it. Looking up a
+    directory first validates its cached configuration (see
+    validate_configs()), so that changes to config files take effect
+    without a restart.
+    '''
+    instances = []
+
+    def __init__(self):
+        dict.__init__(self)
+        ConfigCache.instances.append(self)
+
+    def __contains__(self, key):
+        validate_configs(key[0] if isinstance(key, tuple) else key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        validate_configs(key[0] if isinstance(key, tuple) else key)
+        return dict.get(self, key, default)
+
+def __compiled_config_path(directory, filename):
+    try:
+        from config import WORK_DIR
+    except ImportError:
+        return None
+    from os.path import join
+    return join(WORK_DIR, COMPILED_CONFIG_DIR_NAME, '%s.pickle' %
+                sha1(repr((directory, filename))).hexdigest())
+
+def __load_compiled_config(path, key):
+    try:
+        with open(path, 'rb') as compiled_file:
+            compiled_key, compiled = pickle_load(compiled_file)
+    except Exception:
+        # missing or unreadable, compile again
+        return None
+    if compiled_key != key:
+        return None
+    return compiled
+
+def __store_compiled_config(path, key, compiled):
+    from os import close as os_close, makedirs, remove, rename
+    from os.path import dirname, exists
+    from tempfile import mkstemp
+    try:
+        if not exists(dirname(path)):
+            makedirs(dirname(path))
+        # write to a temporary file and move it in place, as other
+        # processes may be reading it
+        tmp_fh, tmp_path = mkstemp(dir=dirname(path), suffix='.tmp')
+        try:
+            os_close(tmp_fh)
+            with open(tmp_path, 'wb') as compiled_file:
+                pickle_dump((key, compiled), compiled_file, HIGHEST_PROTOCOL)
+            rename(tmp_path, path)
+        except:
+            remove(tmp_path)
+            raise
+    except (IOError, OSError), e:
+        from logging import warning as log_warning
+        log_warning('Failed to store compiled configuration: %s' % (e, ))
+
 def get_configs(directory, filename, defaultstr, minconf, sections, optional_sections):
     if (directory, filename) not in get_configs.__cache:
+        # the compiled config stored by this or another process is used
+        # if the config file and the default are those it was parsed from
+        compiled_path = __compiled_config_path(directory, filename)
+        compiled_key = (COMPILED_CONFIG_VERSION,
+                        __config_stamps[directory][filename], defaultstr)
+        compiled = None
+        if compiled_path is not None:
+            compiled = __load_compiled_config(compiled_path, compiled_key)
+        if compiled is not None:
+            configs, section_labels, messages = compiled
+            # repeat the warnings of parsing the config
+            get_context().messages.extend(messages)
+            get_configs.__cache[(directory, filename)] = (configs, section_labels)
+            return get_configs.__cache[(directory, filename)]
+        messages_before = len(get_context().messages)
+
         configstr, source =  __read_first_in_directory_tree(directory, filename)
 
         if configstr is None:
@@ -640,9 +790,13 @@ def get_configs(directory, filename, defaultstr, minconf, sections, optional_sec
                     r.special_arguments["<REL-TYPE>"] = ["symmetric", "transitive"]
 
         get_configs.__cache[(directory, filename)] = (configs, section_labels)
+        if compiled_path is not None:
+            messages = get_context().messages[messages_before:]
+            __store_compiled_config(compiled_path, compiled_key,
+                                    (configs, section_labels, messages))
 
     return get_configs.__cache[(directory, filename)]
-get_configs.__cache = {}
+get_configs.__cache = ConfigCache()
 
 def __get_access_control(directory, filename, default_rules):
 
@@ -750,7 +904,7 @@ def get_labels(directory):
             l[t.storage_form()] = t.terms[1:]
         cache[directory] = l
     return cache[directory]
-get_labels.__cache = {}
+get_labels.__cache = ConfigCache()
 
 # TODO: too much caching?
 def get_drawing_types(directory):
@@ -761,7 +915,7 @@ def get_drawing_types(directory):
             l.add(n.storage_form())
         cache[directory] = list(l)
     return cache[directory]
-get_drawing_types.__cache = {}
+get_drawing_types.__cache = ConfigCache()
 
 def get_option_config(directory):
     return get_tools_configs(directory)[0][OPTIONS_SECTION]
@@ -799,7 +953,7 @@ def get_access_control(directory):
         cache[directory] = a
 
     return cache[directory]
-get_access_control.__cache = {}
+get_access_control.__cache = ConfigCache()
 
 def get_kb_shortcuts(directory):
     cache = get_kb_shortcuts.__cache
@@ -811,7 +965,7 @@ def get_kb_shortcuts(directory):
         cache[directory] = a
 
     return cache[directory]
-get_kb_shortcuts.__cache = {}
+get_kb_shortcuts.__cache = ConfigCache()
 
 def __collect_type_list(node, collected):
     if node == SEPARATOR_STR:
@@ -840,56 +994,56 @@ def get_entity_type_list(directory):
     if directory not in cache:
         cache[directory] = __type_hierarchy_to_list(get_entity_type_hierarchy(directory))
     return cache[directory]
-get_entity_type_list.__cache = {}
+get_entity_type_list.__cache = ConfigCache()
 
 def get_event_type_list(directory):
     cache = get_event_type_list.__cache
     if directory not in cache:
         cache[directory] = __type_hierarchy_to_list(get_event_type_hierarchy(directory))
     return cache[directory]
-get_event_type_list.__cache = {}
+get_event_type_list.__cache = ConfigCache()
 
 def get_relation_type_list(directory):
     cache = get_relation_type_list.__cache
     if directory not in cache:
         cache[directory] = __type_hierarchy_to_list(get_relation_type_hierarchy(directory))
     return cache[directory]
-get_relation_type_list.__cache = {}
+get_relation_type_list.__cache = ConfigCache()
 
 def get_attribute_type_list(directory):
     cache = get_attribute_type_list.__cache
     if directory not in cache:
         cache[directory] = __type_hierarchy_to_list(get_attribute_type_hierarchy(directory))
     return cache[directory]
-get_attribute_type_list.__cache = {}    
+get_attribute_type_list.__cache = ConfigCache()    
 
 def get_search_config_list(directory):
     cache = get_search_config_list.__cache
     if directory not in cache:
         cache[directory] = __type_hierarchy_to_list(get_search_config(directory))
     return cache[directory]
-get_search_config_list.__cache = {}    
+get_search_config_list.__cache = ConfigCache()    
 
 def get_annotator_config_list(directory):
     cache = get_annotator_config_list.__cache
     if directory not in cache:
         cache[directory] = __type_hierarchy_to_list(get_annotator_config(directory))
     return cache[directory]
-get_annotator_config_list.__cache = {}    
+get_annotator_config_list.__cache = ConfigCache()    
 
 def get_disambiguator_config_list(directory):
     cache = get_disambiguator_config_list.__cache
     if directory not in cache:
         cache[directory] = __type_hierarchy_to_list(get_disambiguator_config(directory))
     return cache[directory]
-get_disambiguator_config_list.__cache = {}    
+get_disambiguator_config_list.__cache = ConfigCache()    
 
 def get_normalization_config_list(directory):
     cache = get_normalization_config_list.__cache
     if directory not in cache:
         cache[directory] = __type_hierarchy_to_list(get_normalization_config(directory))
     return cache[directory]
-get_normalization_config_list.__cache = {}    
+get_normalization_config_list.__cache = ConfigCache()    
 
 def get_node_by_storage_form(directory, term):
     cache = get_node_by_storage_form.__cache
@@ -903,7 +1057,7 @@ def get_node_by_storage_form(directory, term):
         cache[directory] = d
 
     return cache[directory].get(term, None)
-get_node_by_storage_form.__cache = {}
+get_node_by_storage_form.__cache = ConfigCache()
 
 def _get_option_by_storage_form(directory, term, config, cache):
     if directory not in cache:
@@ -926,13 +1080,13 @@ def get_option_config_by_storage_form(directory, term):
     cache = get_option_config_by_storage_form.__cache
     config = get_option_config(directory)
     return _get_option_by_storage_form(directory, term, config, cache)
-get_option_config_by_storage_form.__cache = {}    
+get_option_config_by_storage_form.__cache = ConfigCache()    
 
 def get_visual_option_config_by_storage_form(directory, term):
     cache = get_visual_option_config_by_storage_form.__cache
     config = get_visual_option_config(directory)
     return _get_option_by_storage_form(directory, term, config, cache)
-get_visual_option_config_by_storage_form.__cache = {}    
+get_visual_option_config_by_storage_form.__cache = ConfigCache()    
 
 # access for settings for specific options in tools.conf
 # TODO: avoid fixed string values here, define vars earlier
@@ -1021,7 +1175,7 @@ def get_drawing_config_by_storage_form(directory, term):
         cache[directory] = d
 
     return cache[directory].get(term, None)
-get_drawing_config_by_storage_form.__cache = {}    
+get_drawing_config_by_storage_form.__cache = ConfigCache()    
 
 def __directory_relations_by_arg_num(directory, num, atype, include_special=False):
     assert num >= 0 and num < 2, "INTERNAL ERROR"
@@ -1065,7 +1219,7 @@ def get_relations_by_arg1(directory, atype, include_special=False):
     if (atype, include_special) not in cache[directory]:
         cache[directory][(atype, include_special)] = __directory_relations_by_arg_num(directory, 0, atype, include_special)
     return cache[directory][(atype, include_special)]
-get_relations_by_arg1.__cache = {}
+get_relations_by_arg1.__cache = ConfigCache()
 
 def get_relations_by_arg2(directory, atype, include_special=False):
     cache = get_relations_by_arg2.__cache
@@ -1073,7 +1227,7 @@ def get_relations_by_arg2(directory, atype, include_special=False):
     if (atype, include_special) not in cache[directory]:
         cache[directory][(atype, include_special)] = __directory_relations_by_arg_num(directory, 1, atype, include_special)
     return cache[directory][(atype, include_special)]
-get_relations_by_arg2.__cache = {}
+get_relations_by_arg2.__cache = ConfigCache()
 
 def get_relations_by_storage_form(directory, rtype, include_special=False):
     cache = get_relations_by_storage_form.__cache
@@ -1090,7 +1244,7 @@ def get_relations_by_storage_form(directory, rtype, include_special=False):
                 cache[directory][include_special][r.storage_form()] = []
             cache[directory][include_special][r.storage_form()].append(r)
     return cache[directory][include_special].get(rtype, [])
-get_relations_by_storage_form.__cache = {}
+get_relations_by_storage_form.__cache = ConfigCache()
 
 def get_labels_by_storage_form(directory, term):
     cache = get_labels_by_storage_form.__cache
@@ -1102,7 +1256,7 @@ def get_labels_by_storage_form(directory, term):
             labels = [lab if lab != '<EMPTY>' else ' ' for lab in labels]
             cache[directory][l] = labels
     return cache[directory].get(term, None)
-get_labels_by_storage_form.__cache = {}
+get_labels_by_storage_form.__cache = ConfigCache()
 
 # fallback for missing or partial config: these are highly likely to
 # be entity (as opposed to an event or relation) types.
@@ -1549,10 +1703,15 @@ class ProjectConfiguration(object):
             if '<URLBASE>' not in n.special_arguments:
                 # now optional, client skips link generation if None
                 n.special_arguments['<URLBASE>'] = [None]
+            if 'INDEX' not in n.arguments:
+                # optional, approximate string index type of the DB
+                # (see simstringdb.py), server default if None
+                n.arguments['INDEX'] = [None]
             norm_config.append((n.storage_form(),
                                 n.special_arguments['<URL>'][0],
                                 n.special_arguments['<URLBASE>'][0],
-                                n.arguments['DB'][0]))
+                                n.arguments['DB'][0],
+                                n.arguments['INDEX'][0]))
         return norm_config
         
     def get_entity_types(self):
@@ -18,6 +18,8 @@ Version:    2011-05-31
 
 import re
 
+from context import get_context
+
 # for cleaning up control chars from a string, from 
 # http://stackoverflow.com/questions/92438/stripping-non-printable-characters-from-a-string-in-python
 # allow tab (9) and [unix] newline (10)
@@ -27,7 +29,8 @@ def remove_control_chars(s):
     return __control_char_re.sub('', s)
 
 class Messager:
-    __pending_messages = []
+    # the pending messages are those of the current request, see
+    # context.py
 
     def info(msg, duration=3, escaped=False):
         Messager.__message(msg, 'comment', duration, escaped)
@@ -47,7 +50,7 @@ class Messager:
     debug = staticmethod(debug)    
 
     def output(o):
-        for m, c, d in Messager.__pending_messages:
+        for m, c, d in get_context().messages:
             print >> o, c, ":", m
     output = staticmethod(output)
 
@@ -61,33 +64,35 @@ class Messager:
     output_json = staticmethod(output_json)
 
     def __output_json(json_dict):
+        context = get_context()
+
         # protect against non-unicode inputs
         convertable_messages = []
-        for m in Messager.__pending_messages:
+        for m in context.messages:
             try:
                 encoded = m[0].encode('utf-8')
                 convertable_messages.append(m)
             except UnicodeDecodeError:
                 convertable_messages.append((u'[ERROR: MESSAGE THAT CANNOT BE ENCODED AS UTF-8 OMITTED]', 'error', 5))
-        Messager.__pending_messages = convertable_messages
+        context.messages = convertable_messages
 
         # clean up messages by removing possible control characters
         # that may cause trouble clientside
         cleaned_messages = []
-        for s, t, r in Messager.__pending_messages:
+        for s, t, r in context.messages:
             cs = remove_control_chars(s)
             if cs != s:
                 s = cs + u'[NOTE: SOME NONPRINTABLE CHARACTERS REMOVED FROM MESSAGE]'
             cleaned_messages.append((s,t,r))
-        Messager.__pending_messages = cleaned_messages
+        context.messages = cleaned_messages
         
         # to avoid crowding the interface, combine messages with identical content
         msgcount = {}
-        for m in Messager.__pending_messages:
+        for m in context.messages:
             msgcount[m] = msgcount.get(m, 0) + 1
 
         merged_messages = []
-        for m in Messager.__pending_messages:
+        for m in context.messages:
             if m in msgcount:
                 count = msgcount[m]
                 del msgcount[m]
@@ -99,7 +104,7 @@ class Messager:
         if 'messages' not in json_dict:
             json_dict['messages'] = []
         json_dict['messages'] += merged_messages
-        Messager.__pending_messages = []
+        context.messages = []
         return json_dict
     __output_json = staticmethod(__output_json)
 
@@ -113,7 +118,7 @@ class Messager:
             msg = str(msg)
         if not escaped:
             msg = Messager.__escape(msg)
-        Messager.__pending_messages.append((msg, type, duration))
+        get_context().messages.append((msg, type, duration))
     __message = staticmethod(__message)
 
 if __name__ == '__main__':
@@ -10,6 +10,11 @@ Version:    2011-08-09
 from string import digits, lowercase
 from sys import maxint
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DIGITS = set(digits)
 LOWERCASE = set(lowercase)
 TSURUOKA_2004_INS_CHEAP = set((' ', '-', ))
@@ -28,6 +33,15 @@ TSURUOKA_DEL  = dict([(c, 10) for c in TSURUOKA_2004_DEL_CHEAP])
 #TSURUOKA_REPL = dict([(c, 10) for c in TSURUOKA_2004_REPL_CHEAP])
 TSURUOKA_REPL = dict([(c, 10) for c in NONNUM_T2004_REPL_CHEAP])
 
+# maximum number of candidates aligned together by
+# tsuruoka_local_batch. Candidates are grouped by length to limit
+# padding.
+TSURUOKA_BATCH_SIZE = 512
+
+# cost of unreachable cells in the batched alignment; larger than any
+# real cost but far enough from the int64 limit not to overflow
+_UNREACHABLE = 1 << 60
+
 def tsuruoka(a, b):
     # Special case for empties
     if len(a) == 0 or len(b) == 0:
@@ -111,6 +125,113 @@ def tsuruoka_local(a, b, edge_insert_cost=1, max_cost=maxint):
     else:
         return max_cost
 
+def tsuruoka_local_batch(a, bs, edge_insert_cost=1, max_cost=maxint):
+    # Returns [tsuruoka_local(a, b, edge_insert_cost, max_cost) for b
+    # in bs]. If numpy is available, the alignments to the candidates
+    # are computed together, one anti-diagonal of the DP matrix at a
+    # time, dropping each candidate once its cost reaches max_cost.
+
+    if (numpy is None or len(a) == 0 or
+        not isinstance(edge_insert_cost, (int, long))):
+        return [tsuruoka_local(a, b, edge_insert_cost, max_cost) for b in bs]
+
+    costs = [None] * len(bs)
+    pending = []
+    for k, b in enumerate(bs):
+        if len(b) == 0 or a in b:
+            # special cases, no alignment needed
+            costs[k] = tsuruoka_local(a, b, edge_insert_cost, max_cost)
+        else:
+            pending.append(k)
+
+    pending.sort(key=lambda k: len(bs[k]))
+    for start in xrange(0, len(pending), TSURUOKA_BATCH_SIZE):
+        chunk = pending[start:start+TSURUOKA_BATCH_SIZE]
+        chunk_costs = _tsuruoka_local_numpy(a, [bs[k] for k in chunk],
+                                            edge_insert_cost, max_cost)
+        for k, cost in zip(chunk, chunk_costs):
+            costs[k] = cost
+    return costs
+
+def _tsuruoka_local_numpy(a, bs, edge_insert_cost, max_cost):
+    # tsuruoka_local DP for non-empty a and bs, vectorised over the
+    # candidates and the cells of each anti-diagonal. Diagonal d holds
+    # the cells D[i][d-i] indexed by i; D[i][j] depends on D[i-1][j]
+    # and D[i][j-1] on diagonal d-1 and on D[i-1][j-1] on diagonal
+    # d-2. Costs are capped at max_cost, which does not affect the
+    # result as all costs are non-negative.
+    m = len(a)
+    n_max = max(len(b) for b in bs)
+    cap = min(max_cost, _UNREACHABLE)
+
+    # map characters to integers, 0 is padding
+    alphabet = [None]
+    code = {}
+    for b in bs:
+        for c in b:
+            if c not in code:
+                code[c] = len(alphabet)
+                alphabet.append(c)
+    a_codes = numpy.array([code.get(c, -1) for c in a], numpy.int64)
+    ins = numpy.array([100] + [TSURUOKA_INS.get(c, 100)
+                               for c in alphabet[1:]], numpy.int64)
+    repl = numpy.array([[50] + [TSURUOKA_REPL.get((a_c, c), 50)
+                                for c in alphabet[1:]] for a_c in a],
+                       numpy.int64)
+    dele = numpy.array([TSURUOKA_DEL.get(c, 100) for c in a], numpy.int64)
+    first_col = numpy.concatenate(([0], numpy.cumsum(dele)))
+
+    # b characters padded so that the characters b[d-i-1] compared
+    # against a[i-1] for i = m..1 on diagonal d are chars[:,d-1:d-1+m]
+    chars = numpy.zeros((len(bs), 2*m + n_max), numpy.int64)
+    for k, b in enumerate(bs):
+        chars[k, m:m+len(b)] = [code[c] for c in b]
+    lengths = numpy.array([len(b) for b in bs], numpy.int64)
+
+    rows = numpy.arange(m)
+    prev2 = numpy.empty((len(bs), m+1), numpy.int64)
+    prev2.fill(_UNREACHABLE)
+    prev1 = prev2.copy()
+    prev1[:,0] = 0
+    # last row of the DP matrix, D[m][j]
+    last = numpy.empty((len(bs), n_max+1), numpy.int64)
+    last.fill(cap)
+    # candidates still under max_cost, as indices to bs
+    active = numpy.arange(len(bs))
+
+    for d in xrange(1, m + n_max + 1):
+        c = chars[:,d-1:d-1+m][:,::-1]
+        diag = prev2[:,:-1]
+        curr = numpy.empty_like(prev1)
+        curr[:,0] = min(d * edge_insert_cost, cap)
+        curr[:,1:] = numpy.where(
+            c == a_codes, diag,
+            numpy.minimum(numpy.minimum(prev1[:,:-1] + dele,
+                                        prev1[:,1:] + ins[c]),
+                          diag + repl[rows, c]))
+        numpy.minimum(curr, cap, curr)
+        if d <= m:
+            curr[:,d] = min(first_col[d], cap)
+            curr[:,d+1:] = _UNREACHABLE
+        if d >= m:
+            last[active,d-m] = curr[:,m]
+
+        # any alignment passes through one of the two last diagonals;
+        # stop aligning candidates whose cells there all reach max_cost
+        alive = numpy.minimum(prev1.min(1), curr.min(1)) < cap
+        if not alive.all():
+            if not alive.any():
+                break
+            active, chars = active[alive], chars[alive]
+            prev1, curr = prev1[alive], curr[alive]
+        prev2, prev1 = prev1, curr
+
+    # any number of trailing inserts have edge_insert_cost
+    cols = numpy.arange(n_max+1)
+    trailing = edge_insert_cost * (lengths[:,None] - cols)
+    costs = numpy.where(cols <= lengths[:,None], last + trailing, cap).min(1)
+    return [int(cost) if cost < max_cost else max_cost for cost in costs]
+
 def tsuruoka_norm(a, b):
     return 1 - (tsuruoka(a,b) / (max(len(a),len(b)) * 100.))
 
@@ -148,3 +269,47 @@ if __name__ == '__main__':
         print 'tsuruoka', a, b, tsuruoka(a,b)
         print 'tsuruoka_local', a, b, tsuruoka_local(a,b)
         print 'tsuruoka_norm', a, b, tsuruoka_norm(a,b)
+
+    import random
+    import unittest
+
+    class TsuruokaLocalBatchTest(unittest.TestCase):
+        def assertBatchEqual(self, a, bs, **kwargs):
+            self.assertEqual(tsuruoka_local_batch(a, bs, **kwargs),
+                             [tsuruoka_local(a, b, **kwargs) for b in bs])
+
+        def test_examples(self):
+            bs = ['sitting', 'Sunday', 'caps', '', 'bar', 'dog', '___dog__',
+                  '__d_o_g__', 'DOG', 'do g', 'd-o-g', 'god']
+            for a in ('kitten', 'Saturday', 'Caps', '', 'dog', 'd o g'):
+                self.assertBatchEqual(a, bs)
+
+        def test_random(self):
+            rnd = random.Random(0)
+            chars = 'abcABC -_12'
+            def rndstr(max_len):
+                return ''.join(rnd.choice(chars)
+                               for i in range(rnd.randint(0, max_len)))
+            for i in range(100):
+                a = rndstr(8)
+                bs = [rndstr(20) for j in range(rnd.randint(1, 50))]
+                for max_cost in (maxint, 500, 200, 50, 10, 0):
+                    for edge_insert_cost in (0, 1, 7):
+                        self.assertBatchEqual(
+                            a, bs, edge_insert_cost=edge_insert_cost,
+                            max_cost=max_cost)
+
+        def test_unicode(self):
+            self.assertBatchEqual(u'\u00e4bc', [u'\u00c4bc', u'a\u00e4b',
+                                                 u'x\u00e4bcx', u'abc'])
+
+        def test_chunks(self):
+            global TSURUOKA_BATCH_SIZE
+            size, TSURUOKA_BATCH_SIZE = TSURUOKA_BATCH_SIZE, 3
+            try:
+                self.assertBatchEqual('abc', ['ab', 'bc', 'a-b-c', 'xabcx',
+                                              'ABC', 'cba', 'b', 'abd'])
+            finally:
+                TSURUOKA_BATCH_SIZE = size
+
+    unittest.main()
@@ -10,12 +10,21 @@ from __future__ import with_statement
 import re
 import annotation
 
+from bisect import bisect_left, bisect_right
+from hashlib import sha1
+from os.path import join as path_join
+
+from ahocorasick import AhoCorasick
+from jsonwrap import dumps, loads
+from lrucache import LRUCache
 from message import Messager
 
 ### Constants
 DEFAULT_EMPTY_STRING = "***"
 REPORT_SEARCH_TIMINGS = False
 DEFAULT_RE_FLAGS = re.UNICODE
+# Subdirectory of WORK_DIR for persistent search result cache files
+SEARCH_CACHE_DIRNAME = 'searchcache'
 ###
 
 if REPORT_SEARCH_TIMINGS:
@@ -31,6 +40,19 @@ except ImportError:
     # unlimited
     MAX_SEARCH_RESULT_NUMBER = -1
 
+# Search results are cached by query and the state of the searched
+# files; see config_template.py.
+try:
+    from config import SEARCH_CACHE_SIZE
+except ImportError:
+    SEARCH_CACHE_SIZE = 100
+try:
+    from config import SEARCH_CACHE_PERSIST
+except ImportError:
+    SEARCH_CACHE_PERSIST = False
+
+__search_cache = LRUCache(SEARCH_CACHE_SIZE)
+
 # TODO: nested_types restriction not consistently enforced in
 # searches.
 
@@ -144,6 +166,62 @@ class NoteMatch(object):
     def __str__(self):
         assert False, "INTERNAL ERROR: not implemented"
 
+class TextBoundSpanIndex(object):
+    """
+    Index of the spans of a set of TextBoundAnnotations sorted by
+    start offset, supporting containment queries without comparing
+    against every annotation.
+    """
+    def __init__(self, textbounds):
+        spans = []
+        for t in textbounds:
+            for start, end in t.spans:
+                spans.append((start, end, t))
+        spans.sort(key=lambda s: (s[0], s[1]))
+
+        self._starts = [s[0] for s in spans]
+        self._ends = [s[1] for s in spans]
+        self._anns = [s[2] for s in spans]
+        # the longest span bounds how far back an enclosing span can start
+        self._max_length = max([e-s for s, e in zip(self._starts, self._ends)] +
+                               [0])
+
+    def containing(self, start, end):
+        """
+        Returns the textbounds having a span that contains the given
+        span, in index order.
+        """
+        found = []
+        first = bisect_left(self._starts, end - self._max_length)
+        last = bisect_right(self._starts, start)
+        for i in xrange(first, last):
+            t = self._anns[i]
+            if self._ends[i] >= end and t not in found:
+                found.append(t)
+        return found
+
+    def any_contained_in(self, ann):
+        """
+        Returns True if any textbound other than the given one is
+        contained in it, False otherwise.
+        """
+        for start, end in ann.spans:
+            first = bisect_left(self._starts, start)
+            last = bisect_right(self._starts, end)
+            for i in xrange(first, last):
+                t = self._anns[i]
+                if self._ends[i] <= end and t is not ann and ann.contains(t):
+                    return True
+        return False
+
+def _nested_type_index(ann_obj, nested_types):
+    """
+    Returns a TextBoundSpanIndex of the textbounds of the given types
+    in the given Annotations object.
+    """
+    return TextBoundSpanIndex([t for t in ann_obj.get_textbounds()
+                               if t.type in nested_types])
+
 def __filenames_to_annotations(filenames):
     """
     Given file names, returns corresponding Annotations objects.
@@ -178,41 +256,39 @@ def __filenames_to_annotations(filenames):
 
     return anns
 
-def __directory_to_annotations(directory):
+def __directory_to_filenames(directory):
     """
-    Given a directory, returns Annotations objects for contained files.
+    Given a directory, returns the (suffixless) filenames of the
+    contained documents, sorted by document name.
     """
     # TODO: put this shared functionality in a more reasonable place
     from document import real_directory,_listdir
     from os.path import join as path_join
 
     real_dir = real_directory(directory)
-    # Get the document names
-    base_names = [fn[0:-4] for fn in _listdir(real_dir) if fn.endswith('txt')]
-
-    filenames = [path_join(real_dir, bn) for bn in base_names]
+    # Get the document names; sorted for a stable order, which is
+    # required for search result cursors to be resumable.
+    base_names = sorted([fn[0:-4] for fn in _listdir(real_dir) if fn.endswith('txt')])
 
-    return __filenames_to_annotations(filenames)
+    return [path_join(real_dir, bn) for bn in base_names]
 
-def __document_to_annotations(directory, document):
+def __document_to_filenames(directory, document):
     """
-    Given a directory and a document, returns an Annotations object
-    for the file.
+    Given a directory and a document, returns a list containing the
+    filename of the document.
     """
     # TODO: put this shared functionality in a more reasonable place
     from document import real_directory
     from os.path import join as path_join
 
     real_dir = real_directory(directory)
-    filenames = [path_join(real_dir, document)]
+    return [path_join(real_dir, document)]
 
-    return __filenames_to_annotations(filenames)
-
-def __doc_or_dir_to_annotations(directory, document, scope):
+def __doc_or_dir_to_filenames(directory, document, scope):
     """
     Given a directory, a document, and a scope specification
     with the value "collection" or "document" selecting between
-    the two, returns Annotations object for either the specific
+    the two, returns the filenames of either the specific
     document identified (scope=="document") or all documents in
     the given directory (scope=="collection").
     """
@@ -220,7 +296,7 @@ def __doc_or_dir_to_annotations(directory, document, scope):
     # TODO: lots of magic values here; try to avoid this
 
     if scope == "collection":
-        return __directory_to_annotations(directory)
+        return __directory_to_filenames(directory)
     elif scope == "document":
         # NOTE: "/NO-DOCUMENT/" is a workaround for a brat
         # client-server comm issue (issue #513).
@@ -228,7 +304,7 @@ def __doc_or_dir_to_annotations(directory, document, scope):
             Messager.warning('No document selected for search in document.')
             return []
         else:
-            return __document_to_annotations(directory, document)
+            return __document_to_filenames(directory, document)
     else:
         Messager.error('Unrecognized search scope specification %s' % scope)
         return []
@@ -326,25 +402,42 @@ def eq_text_neq_type_spans(ann_objs, restrict_types=None, ignore_types=None, nes
 
     return matches
 
+class OffsetSentenceMap(object):
+    """
+    Maps character offsets in a text to sentence numbers. Stores only
+    the sentence end offsets, looking up offsets by binary search.
+    """
+    def __init__(self, s):
+        from ssplit import regex_sentence_boundary_gen
+
+        self._ends = []
+        self._numbers = []
+        sprev, snum = 0, 1 # note: sentences indexed from 1
+        for sstart, send in regex_sentence_boundary_gen(s):
+            # if there are extra newlines (i.e. more than one) in between
+            # the previous end and the current start, those need to be
+            # added to the sentence number
+            snum += max(0, s.count("\n", sprev, sstart) - 1)
+            # offsets from the previous end up to this end belong to
+            # this sentence
+            if send > sprev:
+                self._ends.append(send)
+                self._numbers.append(snum)
+            sprev = send
+            snum += 1
+
+    def __getitem__(self, offset):
+        i = bisect_right(self._ends, offset)
+        if offset < 0 or i == len(self._ends):
+            raise KeyError(offset)
+        return self._numbers[i]
+
 def _get_offset_sentence_map(s):
     """
     Helper, sentence-splits and returns a mapping from character
     offsets to sentence number.
     """
-    from ssplit import regex_sentence_boundary_gen
-
-    m = {} # TODO: why is this a dict and not an array?
-    sprev, snum = 0, 1 # note: sentences indexed from 1
-    for sstart, send in regex_sentence_boundary_gen(s):
-        # if there are extra newlines (i.e. more than one) in between
-        # the previous end and the current start, those need to be
-        # added to the sentence number
-        snum += max(0,len([nl for nl in s[sprev:sstart] if nl == "\n"]) - 1)
-        for o in range(sprev, send):
-            m[o] = snum
-        sprev = send
-        snum += 1
-    return m
+    return OffsetSentenceMap(s)
 
 def _split_and_tokenize(s):
     """
@@ -427,9 +520,12 @@ def eq_text_partially_marked(ann_objs, restrict_types=None, ignore_types=None, n
 
     text_type_ann_map = _get_text_type_ann_map(ann_objs, restrict_types, ignore_types, nested_types)
 
-    max_length_tagged = max([len(s) for s in text_type_ann_map]+[0])
+    # find occurrences of all tagged strings in a single pass over each
+    # document text. The empty string (zero-width annotations) can't
+    # be matched by the automaton and is handled separately.
+    tagged_matcher = AhoCorasick([s for s in text_type_ann_map if s != ""])
+    empty_tagged = "" in text_type_ann_map
 
-    # TODO: faster and less hacky way to detect missing annotations
     text_untagged_map = {}
     for ann_obj in ann_objs:
         doctext = ann_obj.get_document_text()
@@ -451,32 +547,46 @@ def eq_text_partially_marked(ann_objs, restrict_types=None, ignore_types=None, n
         # this one too
         sentence_num = _get_offset_sentence_map(doctext)
 
-        start_offset = 0
-        for start in range(len(tokens)):
-            for end in range(start, len(tokens)):
-                s = "".join(tokens[start:end])                
-                end_offset = start_offset + len(s)
-
-                if len(s) > max_length_tagged:
-                    # can't hit longer strings, none tagged
-                    break
-
-                if s not in text_type_ann_map:
-                    # consistently untagged
-                    continue
-
-                # Some matching is tagged; this is considered
-                # inconsistent (for this check) if the current span
-                # has no fully covering tagging. Note that type
-                # matching is not considered here.
-                start_spanning = offset_ann_map.get(start_offset, set())
-                end_spanning = offset_ann_map.get(end_offset-1, set()) # NOTE: -1 needed, see _get_offset_ann_map()
-                if len(start_spanning & end_spanning) == 0:
-                    if s not in text_untagged_map:
-                        text_untagged_map[s] = []
-                    text_untagged_map[s].append((ann_obj, start_offset, end_offset, s, sentence_num[start_offset]))
-
-            start_offset += len(tokens[start])
+        # Candidate spans start at the start of a token and end at the
+        # start of a later token (the last token is never included),
+        # i.e. are the joined token sequences tokens[start:end] for
+        # 0 <= start <= end < len(tokens). Map token start offsets
+        # to token indices to find the tagged strings among these.
+        offset_token_indices = {}
+        token_offset = 0
+        for i, token in enumerate(tokens):
+            offset_token_indices.setdefault(token_offset, []).append(i)
+            token_offset += len(token)
+
+        candidates = []
+        for start_offset, end_offset in tagged_matcher.finditer(doctext):
+            if (start_offset not in offset_token_indices or
+                end_offset not in offset_token_indices):
+                continue
+            for start in offset_token_indices[start_offset]:
+                for end in offset_token_indices[end_offset]:
+                    if end >= start:
+                        candidates.append((start, end, start_offset, end_offset))
+        if empty_tagged:
+            for start_offset, indices in offset_token_indices.iteritems():
+                for i in indices:
+                    candidates.append((i, i, start_offset, start_offset))
+        # process in token order for consistent output
+        candidates.sort()
+
+        for start, end, start_offset, end_offset in candidates:
+            s = doctext[start_offset:end_offset]
+
+            # Some matching is tagged; this is considered
+            # inconsistent (for this check) if the current span
+            # has no fully covering tagging. Note that type
+            # matching is not considered here.
+            start_spanning = offset_ann_map.get(start_offset, set())
+            end_spanning = offset_ann_map.get(end_offset-1, set()) # NOTE: -1 needed, see _get_offset_ann_map()
+            if len(start_spanning & end_spanning) == 0:
+                if s not in text_untagged_map:
+                    text_untagged_map[s] = []
+                text_untagged_map[s].append((ann_obj, start_offset, end_offset, s, sentence_num[start_offset]))
 
     # form match objects, grouping by text
     for text in text_untagged_map:
@@ -597,7 +707,7 @@ def _get_match_regex(text, text_match="word", match_case=False,
 def search_anns_for_textbound(ann_objs, text, restrict_types=None, 
                               ignore_types=None, nested_types=None, 
                               text_match="word", match_case=False,
-                              entities_only=False):
+                              entities_only=False, max_matches=None):
     """
     Searches for the given text in the Textbound annotations in the
     given Annotations objects.  Returns a SearchMatchSet object.
@@ -612,6 +722,10 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
     ignore_types   = [] if ignore_types is None else ignore_types
     nested_types   = [] if nested_types is None else nested_types
 
+    # default to the configured limit
+    if max_matches is None:
+        max_matches = MAX_SEARCH_RESULT_NUMBER
+
     description = "Textbounds containing text '%s'" % text
     if restrict_types != []:
         description = description + ' (of type %s)' % (",".join(restrict_types))
@@ -630,6 +744,9 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
         # collect per-document (ann_obj) for sorting
         ann_matches = []
 
+        if nested_types != []:
+            nested_index = _nested_type_index(ann_obj, nested_types)
+
         if entities_only:
             candidates = ann_obj.get_textbounds()
         else:
@@ -643,12 +760,8 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
             if (text != None and text != "" and 
                 text != DEFAULT_EMPTY_STRING and not match_regex.search(t.get_text())):
                 continue
-            if nested_types != []:
-                # TODO: massively inefficient
-                nested = [x for x in ann_obj.get_textbounds() 
-                          if x != t and t.contains(x)]
-                if len([x for x in nested if x.type in nested_types]) == 0:
-                    continue
+            if nested_types != [] and not nested_index.any_contained_in(t):
+                continue
 
             ann_matches.append(t)
 
@@ -660,12 +773,12 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
         for t in ann_matches:
             matches.add_match(ann_obj, t)    
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_matches <= 0 --> no limit
+        if len(matches) > max_matches and max_matches > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_matches)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_matches)
 
     # sort by document name for output
     matches.sort_matches()
@@ -678,7 +791,8 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
 
 def search_anns_for_note(ann_objs, text, category,
                          restrict_types=None, ignore_types=None,
-                         text_match="word", match_case=False):
+                         text_match="word", match_case=False,
+                         max_matches=None):
     """
     Searches for the given text in the comment annotations in the
     given Annotations objects.  Returns a SearchMatchSet object.
@@ -692,6 +806,10 @@ def search_anns_for_note(ann_objs, text, category,
     restrict_types = [] if restrict_types is None else restrict_types
     ignore_types   = [] if ignore_types is None else ignore_types
 
+    # default to the configured limit
+    if max_matches is None:
+        max_matches = MAX_SEARCH_RESULT_NUMBER
+
     if category is not None:
         description = "Comments on %s containing text '%s'" % (category, text)
     else:
@@ -733,12 +851,12 @@ def search_anns_for_note(ann_objs, text, category,
         for t in ann_matches:
             matches.add_match(ann_obj, t)    
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_matches <= 0 --> no limit
+        if len(matches) > max_matches and max_matches > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_matches)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_matches)
 
     # sort by document name for output
     matches.sort_matches()
@@ -751,10 +869,14 @@ def search_anns_for_note(ann_objs, text, category,
 
 def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type, 
                              restrict_types=None, ignore_types=None, 
-                             text_match="word", match_case=False):
+                             nested_types=None,
+                             text_match="word", match_case=False,
+                             max_matches=None):
     """
     Searches the given Annotations objects for relation annotations
-    matching the given specification. Returns a SearchMatchSet object.
+    matching the given specification. If nested_types is given, only
+    relations with an argument containing a textbound of one of these
+    types match. Returns a SearchMatchSet object.
     """
 
     global REPORT_SEARCH_TIMINGS
@@ -764,11 +886,18 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
     # treat None and empty list uniformly
     restrict_types = [] if restrict_types is None else restrict_types
     ignore_types   = [] if ignore_types is None else ignore_types
+    nested_types   = [] if nested_types is None else nested_types
+
+    # default to the configured limit
+    if max_matches is None:
+        max_matches = MAX_SEARCH_RESULT_NUMBER
 
     # TODO: include args in description
     description = "Relations"
     if restrict_types != []:
         description = description + ' (of type %s)' % (",".join(restrict_types))
+    if nested_types != []:
+        description = description + ' (argument nesting annotation of type %s)' % (",".join(nested_types))
     matches = SearchMatchSet(description)
 
     # compile regular expressions according to arguments for matching
@@ -786,6 +915,19 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
     for ann_obj in ann_objs:
         # collect per-document (ann_obj) for sorting
         ann_matches = []
+
+        if nested_types != []:
+            nested_index = _nested_type_index(ann_obj, nested_types)
+
+            def nests_type(arg_ids):
+                for aid in arg_ids:
+                    arg_ann = ann_obj.get_ann_by_id(aid)
+                    if isinstance(arg_ann, annotation.EventAnnotation):
+                        # events span their triggers
+                        arg_ann = ann_obj.get_ann_by_id(arg_ann.trigger)
+                    if nested_index.any_contained_in(arg_ann):
+                        return True
+                return False
         
         # binary relations and equivs need to be treated separately due
         # to different structure (not a great design there)
@@ -808,6 +950,9 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
                     continue
                 if arg2type is not None and arg2type != arg2ent.type:
                     continue
+
+            if nested_types != [] and not nests_type((r.arg1, r.arg2)):
+                continue
                 
             ann_matches.append(r)
 
@@ -842,6 +987,9 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
             if not match_found:
                 continue
 
+            if nested_types != [] and not nests_type(r.entities):
+                continue
+
             ann_matches.append(r)
 
         # TODO: sort, e.g. by offset of participant occurring first
@@ -851,12 +999,12 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
         for r in ann_matches:
             matches.add_match(ann_obj, r)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_matches <= 0 --> no limit
+        if len(matches) > max_matches and max_matches > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_matches)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_matches)
 
     # sort by document name for output
     matches.sort_matches()
@@ -869,10 +1017,14 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
 
 def search_anns_for_event(ann_objs, trigger_text, args, 
                           restrict_types=None, ignore_types=None, 
-                          text_match="word", match_case=False):
+                          nested_types=None,
+                          text_match="word", match_case=False,
+                          max_matches=None):
     """
     Searches the given Annotations objects for Event annotations
-    matching the given specification. Returns a SearchMatchSet object.
+    matching the given specification. If nested_types is given, only
+    events whose trigger contains a textbound of one of these types
+    match. Returns a SearchMatchSet object.
     """
 
     global REPORT_SEARCH_TIMINGS
@@ -882,11 +1034,18 @@ def search_anns_for_event(ann_objs, trigger_text, args,
     # treat None and empty list uniformly
     restrict_types = [] if restrict_types is None else restrict_types
     ignore_types   = [] if ignore_types is None else ignore_types
+    nested_types   = [] if nested_types is None else nested_types
+
+    # default to the configured limit
+    if max_matches is None:
+        max_matches = MAX_SEARCH_RESULT_NUMBER
 
     # TODO: include args in description
     description = "Event triggered by text containing '%s'" % trigger_text
     if restrict_types != []:
         description = description + ' (of type %s)' % (",".join(restrict_types))
+    if nested_types != []:
+        description = description + ' (trigger nesting annotation of type %s)' % (",".join(nested_types))
     matches = SearchMatchSet(description)
 
     # compile a regular expression according to arguments for matching
@@ -901,6 +1060,9 @@ def search_anns_for_event(ann_objs, trigger_text, args,
         # collect per-document (ann_obj) for sorting
         ann_matches = []
 
+        if nested_types != []:
+            nested_index = _nested_type_index(ann_obj, nested_types)
+
         for e in ann_obj.get_events():
             if e.type in ignore_types:
                 continue
@@ -919,6 +1081,9 @@ def search_anns_for_event(ann_objs, trigger_text, args,
                 not trigger_match_regex.search(t_ann.text)):
                 continue
 
+            if nested_types != [] and not nested_index.any_contained_in(t_ann):
+                continue
+
             # interpret unconstrained (all blank values) argument
             # "constraints" as no constraint
             arg_constraints = []
@@ -981,12 +1146,12 @@ def search_anns_for_event(ann_objs, trigger_text, args,
         for t_obj, e in ann_matches:
             matches.add_match(ann_obj, e)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_matches <= 0 --> no limit
+        if len(matches) > max_matches and max_matches > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_matches)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_matches)
 
     # sort by document name for output
     matches.sort_matches()
@@ -999,7 +1164,8 @@ def search_anns_for_event(ann_objs, trigger_text, args,
 
 def search_anns_for_text(ann_objs, text, 
                          restrict_types=None, ignore_types=None, nested_types=None, 
-                         text_match="word", match_case=False):
+                         text_match="word", match_case=False,
+                         max_matches=None):
     """
     Searches for the given text in the document texts of the given
     Annotations objects.  Returns a SearchMatchSet object.
@@ -1014,6 +1180,10 @@ def search_anns_for_text(ann_objs, text,
     ignore_types   = [] if ignore_types is None else ignore_types
     nested_types   = [] if nested_types is None else nested_types
 
+    # default to the configured limit
+    if max_matches is None:
+        max_matches = MAX_SEARCH_RESULT_NUMBER
+
     description = "Text matching '%s'" % text
     if restrict_types != []:
         description = description + ' (embedded in %s)' % (",".join(restrict_types))
@@ -1032,19 +1202,16 @@ def search_anns_for_text(ann_objs, text,
     for ann_obj in ann_objs:
         doctext = ann_obj.get_document_text()
 
+        # only need to care about embedding annotations if there's
+        # some annotation-based restriction
+        if restrict_types != [] or ignore_types != []:
+            span_index = TextBoundSpanIndex(ann_obj.get_textbounds())
+
         for m in match_regex.finditer(doctext):
-            # only need to care about embedding annotations if there's
-            # some annotation-based restriction
-            #if restrict_types == [] and ignore_types == []:
-            # TODO: _extremely_ naive and slow way to find embedding
-            # annotations.  Use some reasonable data structure
-            # instead.
             embedding = []
             # if there are no type restrictions, we can skip this bit
             if restrict_types != [] or ignore_types != []:
-                for t in ann_obj.get_textbounds():
-                    if t.contains(m):
-                        embedding.append(t)
+                embedding = span_index.containing(m.start(), m.end())
 
             # Note interpretation of ignore_types here: if the text
             # span is embedded in one or more of the ignore_types or
@@ -1061,12 +1228,12 @@ def search_anns_for_text(ann_objs, text,
             tm = TextMatch(m.start(), m.end(), m.group())
             matches.add_match(ann_obj, tm)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # max_matches <= 0 --> no limit
+        if len(matches) > max_matches and max_matches > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % max_matches)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_matches)
 
     if REPORT_SEARCH_TIMINGS:
         process_delta = datetime.now() - process_start
@@ -1130,66 +1297,48 @@ def format_results(matches, concordancing=False, context_length=50,
                           ('Annotation', 'string')]
 
     # determine which additional fields can be shown; depends on the
-    # type of the results
+    # type of the results. A field is shown only if all matches have
+    # it; the common attributes are checked in a single pass.
+    match_list = list(matches.get_matches())
 
-    # TODO: this is much uglier than necessary, revise
     include_type = True
-    try:
-        for ann_obj, ann in matches.get_matches():
-            ann.type
-    except AttributeError:
-        include_type = False
-
     include_text = True
-    try:
-        for ann_obj, ann in matches.get_matches():
-            ann.text
-    except AttributeError:
-        include_text = False
-
     include_trigger_text = True
-    try:
-        for ann_obj, ann in matches.get_matches():
-            ann.trigger
-    except AttributeError:
-        include_trigger_text = False
-
-    include_context = False
-    if include_text and concordancing:
-        include_context = True
-        try:
-            for ann_obj, ann in matches.get_matches():
-                ann.first_start()
-                ann.last_end()
-        except AttributeError:
+    include_context = include_text and concordancing
+    match_args = []
+    for ann_obj, ann in match_list:
+        if include_type and not hasattr(ann, 'type'):
+            include_type = False
+        if include_text and not hasattr(ann, 'text'):
+            include_text = include_context = False
+        if include_trigger_text and not hasattr(ann, 'trigger'):
+            include_trigger_text = False
+        if include_context and not (hasattr(ann, 'first_start') and
+                                    hasattr(ann, 'last_end')):
             include_context = False
 
+        if include_argument_text or include_argument_type:
+            args = (_get_arg_n(ann_obj, ann, 0), _get_arg_n(ann_obj, ann, 1))
+            if include_argument_text and not (hasattr(args[0], 'text') and
+                                              hasattr(args[1], 'text')):
+                include_argument_text = False
+            if include_argument_type and not (hasattr(args[0], 'type') and
+                                              hasattr(args[1], 'type')):
+                include_argument_type = False
+            match_args.append(args)
+
+    # only event matches (with triggers) need the trigger annotations
     include_trigger_context = False
+    trigger_anns = []
     if include_trigger_text and concordancing and not include_context:
         include_trigger_context = True
-        try:
-            for ann_obj, ann in matches.get_matches():
-                trigger = ann_obj.get_ann_by_id(ann.trigger)
-                trigger.first_start()
-                trigger.last_end()
-        except AttributeError:
-            include_trigger_context = False
-
-    if include_argument_text:
-        try:
-            for ann_obj, ann in matches.get_matches():
-                _get_arg_n(ann_obj, ann, 0).text
-                _get_arg_n(ann_obj, ann, 1).text
-        except AttributeError:
-            include_argument_text = False
-
-    if include_argument_type:
-        try:
-            for ann_obj, ann in matches.get_matches():
-                _get_arg_n(ann_obj, ann, 0).type
-                _get_arg_n(ann_obj, ann, 1).type
-        except AttributeError:
-            include_argument_type = False
+        for ann_obj, ann in match_list:
+            trigger = ann_obj.get_ann_by_id(ann.trigger)
+            if not (hasattr(trigger, 'first_start') and
+                    hasattr(trigger, 'last_end')):
+                include_trigger_context = False
+                break
+            trigger_anns.append(trigger)
 
     # extend header fields in order of data fields
     if include_type:
@@ -1222,72 +1371,78 @@ def format_results(matches, concordancing=False, context_length=50,
 
     # gather sets of reference IDs by document to highlight
     # all matches in a document at once
+    docids = []
+    reference_ids = []
     matches_by_doc = {}
-    for ann_obj, ann in matches.get_matches():
+    for ann_obj, ann in match_list:
         docid = basename(ann_obj.get_document())
-
+        rid = ann.reference_id()
+        docids.append(docid)
+        reference_ids.append(rid)
         if docid not in matches_by_doc:
             matches_by_doc[docid] = []
-
-        matches_by_doc[docid].append(ann.reference_id())
+        matches_by_doc[docid].append(rid)
 
     # fill in content
     items = []
-    for ann_obj, ann in matches.get_matches():
+    doctexts = {}
+    for i, (ann_obj, ann) in enumerate(match_list):
         # First value ("a") signals that the item points to a specific
         # annotation, not a collection (directory) or document.
         # second entry is non-listed "pointer" to annotation
-        docid = basename(ann_obj.get_document())
+        docid, rid = docids[i], reference_ids[i]
 
         # matches in the same doc other than the focus match
-        other_matches = [rid for rid in matches_by_doc[docid] 
-                         if rid != ann.reference_id()]
+        other_matches = [r for r in matches_by_doc[docid] if r != rid]
 
-        items.append(["a", { 'matchfocus' : [ann.reference_id()],
-                             'match' : other_matches,
-                             }, 
-                      docid, ann.reference_text()])
+        item = ["a", { 'matchfocus' : [rid],
+                       'match' : other_matches,
+                       }, 
+                docid, ann.reference_text()]
+        items.append(item)
 
         if include_type:
-            items[-1].append(ann.type)
+            item.append(ann.type)
 
         if include_context:
             context_ann = ann
         elif include_trigger_context:
-            context_ann = ann_obj.get_ann_by_id(ann.trigger)
+            context_ann = trigger_anns[i]
         else:
             context_ann = None
 
         if context_ann is not None:
+            if docid not in doctexts:
+                doctexts[docid] = ann_obj.get_document_text()
+            doctext = doctexts[docid]
+            first_start = context_ann.first_start()
+            last_end = context_ann.last_end()
+
             # left context
-            start = max(context_ann.first_start() - context_length, 0)
-            doctext = ann_obj.get_document_text()
-            items[-1].append(doctext[start:context_ann.first_start()])
+            item.append(doctext[max(first_start - context_length, 0):
+                                first_start])
 
         if include_text:
-            items[-1].append(ann.text)
+            item.append(ann.text)
 
         if include_trigger_text:
             try:
-                items[-1].append(ann_obj.get_ann_by_id(ann.trigger).text)
+                item.append(ann_obj.get_ann_by_id(ann.trigger).text)
             except:
                 # TODO: specific exception
-                items[-1].append("(ERROR)")
+                item.append("(ERROR)")
 
         if context_ann is not None:
             # right context
-            end = min(context_ann.last_end() + context_length, 
-                      len(ann_obj.get_document_text()))
-            doctext = ann_obj.get_document_text()
-            items[-1].append(doctext[context_ann.last_end():end])
+            item.append(doctext[last_end:last_end + context_length])
 
         if include_argument_type:
-            items[-1].append(_get_arg_n(ann_obj, ann, 0).type)
-            items[-1].append(_get_arg_n(ann_obj, ann, 1).type)
+            item.append(match_args[i][0].type)
+            item.append(match_args[i][1].type)
 
         if include_argument_text:
-            items[-1].append(_get_arg_n(ann_obj, ann, 0).text)
-            items[-1].append(_get_arg_n(ann_obj, ann, 1).text)
+            item.append(match_args[i][0].text)
+            item.append(match_args[i][1].text)
 
     response['items'] = items
     return response
@@ -1308,10 +1463,267 @@ def _to_bool(s):
     else:
         assert False, "Error: '%s' is not bool or JSON boolean" % str(s)
 
+def _get_page_size(page_size):
+    """
+    Given a page size sent by the client (or None), returns the
+    number of search results to return per page. Page sizes are
+    capped by MAX_SEARCH_RESULT_NUMBER (if positive); a value <= 0
+    stands for no limit.
+    """
+    if page_size is None or page_size == "":
+        size = MAX_SEARCH_RESULT_NUMBER
+    else:
+        try:
+            size = int(page_size)
+        except ValueError:
+            Messager.warning('Search page size should be an integer, got "%s".' % page_size)
+            size = MAX_SEARCH_RESULT_NUMBER
+
+    if MAX_SEARCH_RESULT_NUMBER > 0 and (size <= 0 or size > MAX_SEARCH_RESULT_NUMBER):
+        size = MAX_SEARCH_RESULT_NUMBER
+
+    return size
+
+def _parse_search_cursor(cursor):
+    """
+    Given a search result cursor sent by the client (or None),
+    returns a (document position, offset) pair identifying the
+    match from which to continue the search.
+    """
+    if cursor is None or cursor == "":
+        return 0, 0
+
+    try:
+        doc_pos, offset = [int(i) for i in cursor.split(':')]
+        assert doc_pos >= 0 and offset >= 0
+        return doc_pos, offset
+    except (ValueError, AssertionError):
+        Messager.warning('Invalid search cursor "%s", searching from the start.' % cursor)
+        return 0, 0
+
+def _format_search_cursor(doc_pos, offset):
+    return "%d:%d" % (doc_pos, offset)
+
+def _search_page(filenames, search_function, cursor=None, page_size=None):
+    """
+    Runs a search document by document over the given files, starting
+    at the given cursor, and stops once a page of results has been
+    collected. search_function is invoked with a list containing one
+    Annotations object and should return a SearchMatchSet of all
+    matches in that document.
+
+    Returns a tuple (matches, next_cursor, count_estimate, count_exact)
+    where matches is a SearchMatchSet with the matches for the page,
+    next_cursor is the cursor from which to continue the search (None
+    if no documents remain), count_estimate an estimate of the total
+    number of matches for the search (extrapolated from the documents
+    searched), and count_exact is True if count_estimate is exact.
+    """
+
+    page_size = _get_page_size(page_size)
+    doc_pos, offset = _parse_search_cursor(cursor)
+
+    page = None
+    next_cursor = None
+    searched_docs, searched_matches = 0, 0
+
+    i = doc_pos
+    while i < len(filenames):
+        doc_matches = search_function(__filenames_to_annotations([filenames[i]]))
+        if page is None:
+            page = SearchMatchSet(doc_matches.criterion)
+
+        doc_match_list = doc_matches.get_matches()
+        searched_docs += 1
+        searched_matches += len(doc_match_list)
+
+        j = offset if i == doc_pos else 0
+        while j < len(doc_match_list):
+            if page_size > 0 and len(page) >= page_size:
+                break
+            ann_obj, ann = doc_match_list[j]
+            page.add_match(ann_obj, ann)
+            j += 1
+        i += 1
+
+        if page_size > 0 and len(page) >= page_size:
+            if j < len(doc_match_list):
+                # page filled partway through the document
+                next_cursor = _format_search_cursor(i-1, j)
+            elif i < len(filenames):
+                next_cursor = _format_search_cursor(i, 0)
+            break
+
+    if page is None:
+        # nothing searched; no criterion available either
+        page = SearchMatchSet("")
+
+    # estimate total number of matches from the average number of
+    # matches per document among those searched
+    if searched_docs != 0:
+        per_doc = float(searched_matches) / searched_docs
+    else:
+        per_doc = 0.0
+    if next_cursor is None:
+        count_estimate = int(round(per_doc * doc_pos)) + searched_matches
+        count_exact = doc_pos == 0
+    else:
+        count_estimate = max(int(round(per_doc * len(filenames))),
+                             searched_matches)
+        count_exact = False
+
+    return page, next_cursor, count_estimate, count_exact
+
+def _collection_generation(filenames):
+    """
+    Given (suffixless) document filenames, returns an identifier for
+    the current state of their text and annotation files. The value
+    changes whenever any of the files is modified, added or removed.
+    """
+    from os import stat
+
+    files_hash = sha1()
+    for fn in filenames:
+        for suff in [annotation.TEXT_FILE_SUFFIX] + annotation.KNOWN_FILE_SUFF:
+            path = fn + '.' + suff
+            try:
+                st = stat(path)
+            except OSError:
+                # no such file (or not accessible), ignore
+                continue
+            if isinstance(path, unicode):
+                path = path.encode('utf-8')
+            files_hash.update('%s\t%r\t%d\n' % (path, st.st_mtime, st.st_size))
+    return files_hash.hexdigest()
+
+def __search_cache_path(key):
+    from config import WORK_DIR
+    return path_join(WORK_DIR, SEARCH_CACHE_DIRNAME,
+                     sha1(repr(key)).hexdigest() + '.json')
+
+def __prune_search_cache_dir(cache_dir):
+    # remove the least recently used cache files beyond the cache size
+    from os import listdir, remove
+    from os.path import getmtime
+
+    paths = [path_join(cache_dir, fn) for fn in listdir(cache_dir)
+             if fn.endswith('.json')]
+    if len(paths) <= SEARCH_CACHE_SIZE:
+        return
+    paths.sort(key=getmtime)
+    for path in paths[:len(paths)-SEARCH_CACHE_SIZE]:
+        try:
+            remove(path)
+        except OSError:
+            # removed concurrently, most likely
+            pass
+
+def _get_cached_search_results(key):
+    """
+    Returns the cached search results (a JSON string) for the given
+    cache key, or None if none are cached.
+    """
+    cached = __search_cache.get(key)
+    if cached is None and SEARCH_CACHE_PERSIST:
+        from os import utime
+        path = __search_cache_path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                cached = cache_file.read()
+            # mark as recently used for pruning
+            utime(path, None)
+        except (IOError, OSError):
+            return None
+        __search_cache.put(key, cached)
+    return cached
+
+def _cache_search_results(key, results):
+    """
+    Stores the given search results (a JSON string) in the cache
+    under the given key.
+    """
+    __search_cache.put(key, results)
+    if SEARCH_CACHE_PERSIST:
+        from os import close as os_close, makedirs, rename, remove
+        from os.path import dirname, isdir
+        from tempfile import mkstemp
+
+        path = __search_cache_path(key)
+        cache_dir = dirname(path)
+        tmp_file_path = None
+        try:
+            if not isdir(cache_dir):
+                makedirs(cache_dir)
+            # write to a temporary file and move it in place, for safety
+            tmp_file_fh, tmp_file_path = mkstemp(dir=cache_dir)
+            os_close(tmp_file_fh)
+            with open(tmp_file_path, 'wb') as tmp_file:
+                tmp_file.write(results)
+            rename(tmp_file_path, path)
+            tmp_file_path = None
+            __prune_search_cache_dir(cache_dir)
+        except (IOError, OSError):
+            # the cache is an optimisation only; never fail the search
+            pass
+        finally:
+            if tmp_file_path is not None:
+                remove(tmp_file_path)
+
+def _search_results(directory, document, scope, query, search_function,
+                    cursor, page_size, concordancing, context_length,
+                    include_argument_text=False, include_argument_type=False):
+    """
+    Shared implementation of the brat search interface functions:
+    runs the given search for one page of results and formats the
+    page for the client. If search_function is None, no documents
+    are searched. query should be a tuple identifying the search
+    function and its arguments, used as part of the result cache key.
+    """
+    if search_function is not None:
+        filenames = __doc_or_dir_to_filenames(directory, document, scope)
+    else:
+        filenames = []
+
+    cache_key = None
+    results = None
+    if SEARCH_CACHE_SIZE > 0 and search_function is not None:
+        cache_key = (directory, query, tuple(filenames),
+                     _collection_generation(filenames),
+                     cursor or None, _get_page_size(page_size),
+                     concordancing, unicode(context_length),
+                     include_argument_text, include_argument_type)
+        cached = _get_cached_search_results(cache_key)
+        if cached is not None:
+            results = loads(cached)
+
+    if results is None:
+        matches, next_cursor, count_estimate, count_exact = _search_page(
+            filenames, search_function, cursor, page_size)
+
+        results = format_results(matches, concordancing, context_length,
+                                 include_argument_text, include_argument_type)
+        results['collection'] = directory
+        results['cursor'] = next_cursor
+        results['page_size'] = _get_page_size(page_size)
+        results['count_estimate'] = count_estimate
+        results['count_exact'] = count_exact
+
+        if cache_key is not None:
+            _cache_search_results(cache_key, dumps(results))
+
+    return results
+
+def _normalise_query_text(text):
+    # None, the empty string and DEFAULT_EMPTY_STRING all stand for
+    # "no constraint" in searches
+    if text is None or text == DEFAULT_EMPTY_STRING:
+        return ""
+    return text
+
 def search_text(collection, document, scope="collection",
                 concordancing="false", context_length=50,
                 text_match="word", match_case="false",
-                text=""):
+                text="", cursor=None, page_size=None):
 
     directory = collection
 
@@ -1319,21 +1731,27 @@ def search_text(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)    
+    def search(ann_objs):
+        return search_anns_for_text(ann_objs, text, 
+                                    text_match=text_match, 
+                                    match_case=match_case,
+                                    max_matches=-1)
 
-    matches = search_anns_for_text(ann_objs, text, 
-                                   text_match=text_match, 
-                                   match_case=match_case)
-        
-    results = format_results(matches, concordancing, context_length)
-    results['collection'] = directory
-    
-    return results
+    # check the query once here instead of separately for each document
+    if _get_match_regex(text, text_match, match_case) is None:
+        # invalid query (reported to the user), don't search
+        search = None
+
+    query = ('text', _normalise_query_text(text), text_match, match_case)
+
+    return _search_results(directory, document, scope, query, search,
+                           cursor, page_size, concordancing, context_length)
 
 def search_entity(collection, document, scope="collection",
                   concordancing="false", context_length=50,
                   text_match="word", match_case="false",
-                  type=None, text=DEFAULT_EMPTY_STRING):
+                  type=None, text=DEFAULT_EMPTY_STRING,
+                  cursor=None, page_size=None):
 
     directory = collection
 
@@ -1341,26 +1759,32 @@ def search_entity(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_textbound(ann_objs, text, 
-                                        restrict_types=restrict_types, 
-                                        text_match=text_match,
-                                        match_case=match_case)
-        
-    results = format_results(matches, concordancing, context_length)
-    results['collection'] = directory
-    
-    return results
+    def search(ann_objs):
+        return search_anns_for_textbound(ann_objs, text, 
+                                         restrict_types=restrict_types, 
+                                         text_match=text_match,
+                                         match_case=match_case,
+                                         max_matches=-1)
+
+    if _get_match_regex(text, text_match, match_case) is None:
+        # invalid query (reported to the user), don't search
+        search = None
+
+    query = ('entity', _normalise_query_text(text), text_match, match_case,
+             tuple(restrict_types))
+
+    return _search_results(directory, document, scope, query, search,
+                           cursor, page_size, concordancing, context_length)
 
 def search_note(collection, document, scope="collection",
                 concordancing="false", context_length=50,
                 text_match="word", match_case="false",
-                category=None, type=None, text=DEFAULT_EMPTY_STRING):
+                category=None, type=None, text=DEFAULT_EMPTY_STRING,
+                cursor=None, page_size=None):
 
     directory = collection
 
@@ -1368,26 +1792,32 @@ def search_note(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_note(ann_objs, text, category,
-                                   restrict_types=restrict_types, 
-                                   text_match=text_match,
-                                   match_case=match_case)
-        
-    results = format_results(matches, concordancing, context_length)
-    results['collection'] = directory
-    
-    return results
+    def search(ann_objs):
+        return search_anns_for_note(ann_objs, text, category,
+                                    restrict_types=restrict_types, 
+                                    text_match=text_match,
+                                    match_case=match_case,
+                                    max_matches=-1)
+
+    if _get_match_regex(text, text_match, match_case) is None:
+        # invalid query (reported to the user), don't search
+        search = None
+
+    query = ('note', _normalise_query_text(text), text_match, match_case,
+             category, tuple(restrict_types))
+
+    return _search_results(directory, document, scope, query, search,
+                           cursor, page_size, concordancing, context_length)
 
 def search_event(collection, document, scope="collection",
                  concordancing="false", context_length=50,
                  text_match="word", match_case="false",
-                 type=None, trigger=DEFAULT_EMPTY_STRING, args={}):
+                 type=None, trigger=DEFAULT_EMPTY_STRING, args={},
+                 cursor=None, page_size=None):
 
     directory = collection
 
@@ -1395,8 +1825,6 @@ def search_event(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
@@ -1404,25 +1832,39 @@ def search_event(collection, document, scope="collection",
     # to get around lack of JSON object parsing in dispatcher, parse
     # args here. 
     # TODO: parse JSON in dispatcher; this is far from the right place to do this..
-    from jsonwrap import loads
     args = loads(args)
 
-    matches = search_anns_for_event(ann_objs, trigger, args, 
-                                    restrict_types=restrict_types,
-                                    text_match=text_match, 
-                                    match_case=match_case)
-
-    results = format_results(matches, concordancing, context_length)
-    results['collection'] = directory
-    
-    return results
+    def search(ann_objs):
+        return search_anns_for_event(ann_objs, trigger, args, 
+                                     restrict_types=restrict_types,
+                                     text_match=text_match, 
+                                     match_case=match_case,
+                                     max_matches=-1)
+
+    if (trigger is not None and
+        _get_match_regex(trigger, text_match, match_case) is None):
+        # invalid query (reported to the user), don't search
+        search = None
+
+    # all-blank argument constraints are ignored in search
+    arg_constraints = tuple(sorted([(arg.get('role'), arg.get('type'),
+                                     arg.get('text')) for arg in args
+                                    if (arg.get('role') != '' or
+                                        arg.get('type') != '' or
+                                        arg.get('text') != '')]))
+    query = ('event', _normalise_query_text(trigger), text_match, match_case,
+             tuple(restrict_types), arg_constraints)
+
+    return _search_results(directory, document, scope, query, search,
+                           cursor, page_size, concordancing, context_length)
 
 def search_relation(collection, document, scope="collection", 
                     concordancing="false", context_length=50,
                     text_match="word", match_case="false",
                     type=None, arg1=None, arg1type=None, 
                     arg2=None, arg2type=None,
-                    show_text=False, show_type=False):
+                    show_text=False, show_type=False,
+                    cursor=None, page_size=None):
 
     directory = collection
 
@@ -1432,23 +1874,31 @@ def search_relation(collection, document, scope="collection",
     show_text = _to_bool(show_text)
     show_type = _to_bool(show_type)
     
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_relation(ann_objs, arg1, arg1type,
-                                       arg2, arg2type,
-                                       restrict_types=restrict_types,
-                                       text_match=text_match,
-                                       match_case=match_case)
-
-    results = format_results(matches, concordancing, context_length,
-                             show_text, show_type)
-    results['collection'] = directory
-    
-    return results
+    def search(ann_objs):
+        return search_anns_for_relation(ann_objs, arg1, arg1type,
+                                        arg2, arg2type,
+                                        restrict_types=restrict_types,
+                                        text_match=text_match,
+                                        match_case=match_case,
+                                        max_matches=-1)
+
+    if ((arg1 is not None and
+         _get_match_regex(arg1, text_match, match_case) is None) or
+        (arg2 is not None and
+         _get_match_regex(arg2, text_match, match_case) is None)):
+        # invalid query (reported to the user), don't search
+        search = None
+
+    query = ('relation', arg1, arg1type, arg2, arg2type, text_match,
+             match_case, tuple(restrict_types))
+
+    return _search_results(directory, document, scope, query, search,
+                           cursor, page_size, concordancing, context_length,
+                           show_text, show_type)
 
 ### filename list interface functions (e.g. command line) ###
 
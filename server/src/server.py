@@ -33,6 +33,9 @@ CONF_TEMPLATE_FNAME = 'config_template.py'
 CONFIG_CHECK_LOCK = allocate_lock()
 ###
 
+# Whether the configuration has passed _config_check() in this process
+_config_checked = False
+
 
 class PermissionError(Exception):
     def json(self, json_dic):
@@ -144,11 +147,6 @@ def _convert_log_level(log_level):
         assert False, 'Should not happen'
 
 
-class DefaultNoneDict(dict):
-    def __missing__(self, key):
-        return None
-
-
 def _safe_serve(params, client_ip, client_hostname, cookie_data):
     # Note: Only logging imports here
     from config import WORK_DIR
@@ -166,10 +164,13 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
 
     # Do the necessary imports after enabling the logging, order critical
     try:
-        from common import ProtocolError, ProtocolArgumentError, NoPrintJSONError
+        from common import (ProtocolError, ProtocolArgumentError,
+                NoPrintJSONError, DefaultNoneDict)
+        from context import get_context
         from dispatch import dispatch
         from jsonwrap import dumps
         from message import Messager
+        from metrics import add_time
         from session import get_session, init_session, close_session, NoSessionError, SessionStoreError
     except ImportError:
         # Note: Heisenbug trap for #612, remove after resolved
@@ -183,6 +184,7 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
     try:
         # Unpack the arguments into something less obscure than the
         #   Python FieldStorage object (part dictonary, part list, part FUBAR)
+        parse_start = time()
         http_args = DefaultNoneDict()
         for k in params:
             # Also take the opportunity to convert Strings into Unicode,
@@ -192,6 +194,7 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
             except TypeError:
                 Messager.error('protocol argument error: expected string argument %s, got %s' % (k, type(params.getvalue(k))))
                 raise ProtocolArgumentError
+        add_time('parse', time() - parse_start)
 
         # Dispatch the request
         json_dic = dispatch(http_args, client_ip, client_hostname)
@@ -199,6 +202,7 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
         # Internal error, only reported to client not to log
         json_dic = {}
         e.json(json_dic)
+        get_context().error = json_dic.get('exception', 'protocolError')
 
         # Add a human-readable version of the error
         err_str = unicode(e)
@@ -219,7 +223,9 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
         cookie_hdrs = None
 
     if response_is_JSON:
+        serialise_start = time()
         response_data = ((JSON_HDR, ), dumps(Messager.output_json(json_dic)))
+        add_time('serialise', time() - serialise_start)
 
     return (cookie_hdrs, response_data)
 
@@ -266,10 +272,45 @@ def _server_crash(cookie_hdrs, e):
     json_dic = {
             'exception': 'serverCrash',
             }
+    _note_error(json_dic)
     return (cookie_hdrs, ((JSON_HDR, ), dumps(Messager.output_json(json_dic))))
 
+# Note the exception reported to the client for the request metrics
+def _note_error(json_dic):
+    from context import get_context
+    get_context().error = json_dic['exception']
+
+def _record_metrics(context, response):
+    try:
+        from metrics import record_request
+        record_request(context, response[1][1])
+    except Exception:
+        # Never fail a request because of its metrics
+        from logging import exception as log_exception
+        log_exception('Failed to record request metrics')
+
 # Serve the client request
 def serve(params, client_ip, client_hostname, cookie_data):
+    # All per-request state (session, messages etc.) is kept in a
+    # context for the current thread, so that threads can serve
+    # requests concurrently
+    try:
+        from context import begin_request, end_request
+    except ImportError:
+        # Python too old for the context, let _serve() report it
+        return _serve(params, client_ip, client_hostname, cookie_data)
+
+    context = begin_request(client_ip, client_hostname)
+    try:
+        response = _serve(params, client_ip, client_hostname, cookie_data)
+        _record_metrics(context, response)
+        return response
+    finally:
+        end_request()
+
+def _serve(params, client_ip, client_hostname, cookie_data):
+    global _config_checked
+
     # The session relies on the config, wait-for-it
     cookie_hdrs = None
 
@@ -295,16 +336,21 @@ def serve(params, client_ip, client_hostname, cookie_data):
     from message import Messager
     
     try:
-        # We need to lock here since flup uses threads for each request and
-        # can thus manipulate each other's global variables
-        try:
-            CONFIG_CHECK_LOCK.acquire()
-            _config_check()
-        finally:
-            CONFIG_CHECK_LOCK.release()
+        # The check temporarily replaces the module search path, so
+        # concurrent requests must not run it at the same time. Once
+        # passed, it is not repeated.
+        if not _config_checked:
+            try:
+                CONFIG_CHECK_LOCK.acquire()
+                if not _config_checked:
+                    _config_check()
+                    _config_checked = True
+            finally:
+                CONFIG_CHECK_LOCK.release()
     except ConfigurationError, e:
         json_dic = {}
         e.json(json_dic)
+        _note_error(json_dic)
         return cookie_hdrs, ((JSON_HDR, ), dumps(Messager.output_json(json_dic)))
     # We can now safely read the config
     from config import DEBUG
@@ -314,6 +360,7 @@ def serve(params, client_ip, client_hostname, cookie_data):
     except PermissionError, e:
         json_dic = {}
         e.json(json_dic)
+        _note_error(json_dic)
         return cookie_hdrs, ((JSON_HDR, ), dumps(Messager.output_json(json_dic)))
 
     try:
@@ -5,7 +5,14 @@
 '''
 Session handling class.
 
-Note: New modified version using pickle instead of shelve.
+The data of the sessions is kept in a session store chosen by the
+SESSION_STORE configuration option: pickle files (one per session, the
+default and the format of earlier versions), an SQLite database in WAL
+mode shared by all server processes or the memory of a single server
+process. Sessions are only
+written back to the store when their data has changed (or has not been
+written for a day, to keep them from expiring), so read-only requests
+do no writes, and expired sessions are removed now and then.
 
 Author:     Goran Topic         <goran is s u-tokyo ac jp>
 Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
@@ -15,28 +22,43 @@ Version:    2011-03-11
 from __future__ import with_statement
 
 from Cookie import CookieError, SimpleCookie
-from atexit import register as atexit_register
 from datetime import datetime, timedelta
 from hashlib import sha224
-from os import close as os_close, makedirs, remove
-from os.path import exists, dirname, join as path_join, isfile
-from shutil import copy
-from shutil import move
+from os import close as os_close, getpid, listdir, makedirs, remove, rename
+from os.path import dirname, exists, join as path_join, getmtime
+from random import random
 from tempfile import mkstemp
+from threading import Lock, local
+from time import time
 
 try:
-    from cPickle import dump as pickle_dump, load as pickle_load
+    from cPickle import (dump as pickle_dump, load as pickle_load,
+            dumps as pickle_dumps, loads as pickle_loads, HIGHEST_PROTOCOL)
 except ImportError:
-    from pickle import dump as pickle_dump, load as pickle_load
+    from pickle import (dump as pickle_dump, load as pickle_load,
+            dumps as pickle_dumps, loads as pickle_loads, HIGHEST_PROTOCOL)
 
 from config import WORK_DIR
+from context import get_context
+
+try:
+    from config import SESSION_STORE
+except ImportError:
+    SESSION_STORE = 'file'
 
 ### Constants
-CURRENT_SESSION = None
 SESSION_COOKIE_KEY = 'sid'
 # Where we store our session data files
 SESSIONS_DIR=path_join(WORK_DIR, 'sessions')
+SESSIONS_DB=path_join(SESSIONS_DIR, 'sessions.db')
 EXPIRATION_DELTA = timedelta(days=30)
+# Unchanged sessions are written back after this many seconds, so that
+# sessions in use do not expire
+TOUCH_INTERVAL = 24 * 60 * 60
+# Probability of removing the expired sessions at the end of a request
+GC_PROBABILITY = 0.01
+# Seconds to wait for other processes writing the session database
+SQLITE_TIMEOUT = 10
 ###
 
 
@@ -79,7 +101,18 @@ class SessionCookie(SimpleCookie):
 
 
 class Session(dict):
-    def __init__(self, cookie):
+    # Set when the data changes, so that it is stored on close
+    dirty = False
+    # Time the session was last stored, None if never
+    saved = None
+    # Set when the session is invalidated, so that it is not stored again
+    invalidated = False
+
+    def __init__(self, cookie, data=None, saved=None):
+        dict.__init__(self)
+        if data is not None:
+            dict.update(self, data)
+        self.saved = saved
         self.cookie = cookie
         sid = self.cookie.get_sid()
         self.init_cookie(sid)
@@ -101,6 +134,39 @@ class Session(dict):
         except CookieError:
             pass
 
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            dict.__setitem__(self, key, value)
+            self.dirty = True
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.dirty = True
+
+    def clear(self):
+        if self:
+            dict.clear(self)
+            self.dirty = True
+
+    def pop(self, key, *default):
+        if key in self:
+            self.dirty = True
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self.dirty = True
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
     def get(self, key, default=None):
         try:
             return self[key]
@@ -115,8 +181,203 @@ class Session(dict):
                 self.get_sid(), self.cookie, dict.__str__(self), )
 
 
-def get_session_pickle_path(sid):
-    return path_join(SESSIONS_DIR, '%s.pickle' % (sid, ))
+class SessionStore(object):
+    '''
+    Stores the data of sessions, as dictionaries, by session id together
+    with the time they were stored. Subclasses implement
+
+    load(sid): returns the data of the session with the given id and the
+        time it was stored, or None if there is no such session.
+    save(sid, data, saved): stores the data of the session with the given
+        id at the given time. Raises SessionStoreError if the data could
+        not be stored.
+    delete(sid): removes the session with the given id, if any.
+    gc(before): removes the sessions last stored before the given time.
+    '''
+
+
+class MemorySessionStore(SessionStore):
+    '''
+    Keeps the sessions in the memory of the server process, shared by its
+    threads. Only for servers serving all requests from a single process,
+    the sessions are lost when it exits.
+    '''
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = Lock()
+
+    def load(self, sid):
+        with self._lock:
+            stored = self._sessions.get(sid)
+        if stored is None:
+            return None
+        data, saved = stored
+        return dict(data), saved
+
+    def save(self, sid, data, saved):
+        with self._lock:
+            self._sessions[sid] = (dict(data), saved)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def gc(self, before):
+        with self._lock:
+            for sid, (_, saved) in self._sessions.items():
+                if saved < before:
+                    del self._sessions[sid]
+
+
+class FileSessionStore(SessionStore):
+    '''
+    Keeps each session in a pickle file in the given directory, with the
+    time it was stored as the modification time of the file.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, sid):
+        return path_join(self.directory, '%s.pickle' % (sid, ))
+
+    def load(self, sid):
+        ppath = self._path(sid)
+        try:
+            saved = getmtime(ppath)
+            with open(ppath, 'rb') as session_pickle:
+                data = pickle_load(session_pickle)
+        except Exception, e:
+            # Missing or unreadable, either way there is no session
+            return None
+        return dict(data), saved
+
+    def save(self, sid, data, saved):
+        try:
+            if not exists(self.directory):
+                makedirs(self.directory)
+            # Write to a temporary file and move it in place, for safety
+            tmp_file_fh, tmp_file_path = mkstemp(dir=self.directory,
+                    suffix='.tmp')
+            try:
+                os_close(tmp_file_fh)
+                with open(tmp_file_path, 'wb') as tmp_file:
+                    pickle_dump(dict(data), tmp_file, HIGHEST_PROTOCOL)
+                rename(tmp_file_path, self._path(sid))
+            except:
+                remove(tmp_file_path)
+                raise
+        except (IOError, OSError):
+            # failed store: no permissions?
+            raise SessionStoreError
+
+    def delete(self, sid):
+        try:
+            remove(self._path(sid))
+        except OSError:
+            pass
+
+    def gc(self, before):
+        try:
+            filenames = listdir(self.directory)
+        except OSError:
+            return
+        for filename in filenames:
+            if not filename.endswith('.pickle'):
+                continue
+            ppath = path_join(self.directory, filename)
+            try:
+                if getmtime(ppath) < before:
+                    remove(ppath)
+            except OSError:
+                # Removed by another process
+                pass
+
+
+class SQLiteSessionStore(SessionStore):
+    '''
+    Keeps the sessions in an SQLite database in WAL mode, so that server
+    processes reading sessions do not block each other or the writers.
+    Each thread (and process) uses its own connection.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        # Connections must not be shared with forked processes
+        if connection is not None and self._local.pid == getpid():
+            return connection
+
+        import sqlite3 as sqlite
+        directory = dirname(self.path)
+        if not exists(directory):
+            makedirs(directory)
+        connection = sqlite.connect(self.path, timeout=SQLITE_TIMEOUT)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                    'sid TEXT PRIMARY KEY, data BLOB, saved REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS sessions_saved '
+                    'ON sessions (saved)')
+        self._local.connection = connection
+        self._local.pid = getpid()
+        return connection
+
+    def _execute(self, sql, args):
+        import sqlite3 as sqlite
+        try:
+            connection = self._connection()
+            with connection:
+                return connection.execute(sql, args).fetchone()
+        except (sqlite.Error, OSError), e:
+            raise SessionStoreError(str(e))
+
+    def load(self, sid):
+        try:
+            row = self._execute('SELECT data, saved FROM sessions '
+                    'WHERE sid = ?', (sid, ))
+        except SessionStoreError:
+            return None
+        if row is None:
+            return None
+        try:
+            return pickle_loads(str(row[0])), row[1]
+        except Exception, e:
+            return None
+
+    def save(self, sid, data, saved):
+        import sqlite3 as sqlite
+        self._execute('INSERT OR REPLACE INTO sessions (sid, data, saved) '
+                'VALUES (?, ?, ?)', (sid, sqlite.Binary(pickle_dumps(
+                    dict(data), HIGHEST_PROTOCOL)), saved))
+
+    def delete(self, sid):
+        self._execute('DELETE FROM sessions WHERE sid = ?', (sid, ))
+
+    def gc(self, before):
+        self._execute('DELETE FROM sessions WHERE saved < ?', (before, ))
+
+
+def _create_session_store(name):
+    if name == 'sqlite':
+        return SQLiteSessionStore(SESSIONS_DB)
+    elif name == 'file':
+        return FileSessionStore(SESSIONS_DIR)
+    elif name == 'memory':
+        return MemorySessionStore()
+    else:
+        raise ValueError('unknown SESSION_STORE %r, expected "sqlite", '
+                '"file" or "memory"' % (name, ))
+
+__store = _create_session_store(SESSION_STORE)
+
+def get_session_store():
+    return __store
 
 def init_session(remote_address, cookie_data=None):
     if cookie_data is not None:
@@ -135,67 +396,54 @@ def init_session(remote_address, cookie_data=None):
             # For some reason the cookie did not contain a SID, set to default
             cookie.set_sid(sid)
 
-    # Set the session singleton (there can be only one!)
-    global CURRENT_SESSION
-    ppath = get_session_pickle_path(cookie.get_sid())
-    if isfile(ppath):
-        # Load our old session data and initialise the cookie
-        try:
-            with open(ppath, 'rb') as session_pickle:
-                CURRENT_SESSION = pickle_load(session_pickle)
-            CURRENT_SESSION.init_cookie(CURRENT_SESSION.get_sid())
-        except Exception, e:
-            # On any error, just create a new session
-            CURRENT_SESSION = Session(cookie)            
+    # Set the session of the current request (there can be only one!)
+    stored = get_session_store().load(cookie.get_sid())
+    if stored is not None:
+        # Our old session data, with the cookie of the request
+        data, saved = stored
+        get_context().session = Session(cookie, data, saved)
     else:
-        # Create a new session
-        CURRENT_SESSION = Session(cookie)
+        # Create a new session, stored once it has some data
+        get_context().session = Session(cookie)
 
 def get_session():
-    if CURRENT_SESSION is None:
+    session = get_context().session
+    if session is None:
         raise NoSessionError
-    return CURRENT_SESSION
+    return session
 
 def invalidate_session():
-    global CURRENT_SESSION
-    if CURRENT_SESSION is None:
+    session = get_context().session
+    if session is None:
         return
 
-    # Set expired and remove from disk
-    CURRENT_SESSION.cookie.set_expired()
-    ppath = get_session_pickle_path(CURRENT_SESSION.get_sid())
-    if isfile(ppath):
-        remove(ppath)
+    # Set expired and remove from the store
+    session.cookie.set_expired()
+    session.invalidated = True
+    get_session_store().delete(session.get_sid())
 
 def close_session():
     # Do we have a session to save in the first place?
-    if CURRENT_SESSION is None:
+    session = get_context().session
+    if session is None or session.invalidated:
         return
 
-    try:
-        makedirs(SESSIONS_DIR)
-    except OSError, e:
-        if e.errno == 17:
-            # Already exists
-            pass
-        else:
-            raise
+    store = get_session_store()
+    now = time()
+    # Unchanged sessions are only stored to keep them from expiring
+    if session.dirty or (session.saved is not None and
+            now - session.saved > TOUCH_INTERVAL):
+        store.save(session.get_sid(), session, now)
+        session.dirty = False
+        session.saved = now
 
-    # Write to a temporary file and move it in place, for safety
-    tmp_file_path = None
-    try:
-        tmp_file_fh, tmp_file_path = mkstemp()
-        os_close(tmp_file_fh)
-
-        with open(tmp_file_path, 'wb') as tmp_file:
-            pickle_dump(CURRENT_SESSION, tmp_file)
-        copy(tmp_file_path, get_session_pickle_path(CURRENT_SESSION.get_sid()))
-    except IOError:
-        # failed store: no permissions?
-        raise SessionStoreError
-    finally:
-        if tmp_file_path is not None:
-            remove(tmp_file_path)
+    if random() < GC_PROBABILITY:
+        try:
+            store.gc(now - EXPIRATION_DELTA.days * 24 * 60 * 60)
+        except SessionStoreError, e:
+            # The expired sessions can wait for another request
+            from logging import warning as log_warning
+            log_warning('Failed to remove expired sessions: %s' % (e, ))
 
 def save_conf(config):
     get_session()['conf'] = config
@@ -245,3 +493,34 @@ if __name__ == '__main__':
     finally:
         if tmp_file_path is not None:
             remove(tmp_file_path)
+
+    # Store checks: only changed sessions are stored, expired ones removed
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    tmp_dir = mkdtemp()
+    try:
+        for store in (MemorySessionStore(), FileSessionStore(tmp_dir),
+                SQLiteSessionStore(path_join(tmp_dir, 'sessions.db'))):
+            __store = store
+            init_session('127.0.0.1')
+            sid = get_session().get_sid()
+            close_session()
+            assert store.load(sid) is None
+
+            init_session('127.0.0.1', cookie_data='sid=%s' % (sid, ))
+            get_session()['user'] = 'editor'
+            close_session()
+            data, saved = store.load(sid)
+            assert data == {'user': 'editor'}
+
+            init_session('127.0.0.1', cookie_data='sid=%s' % (sid, ))
+            assert not get_session().dirty
+            get_session()['user'] = 'editor'
+            assert not get_session().dirty
+            close_session()
+            assert store.load(sid)[1] == saved
+
+            store.gc(saved + 1)
+            assert store.load(sid) is None
+    finally:
+        rmtree(tmp_dir)
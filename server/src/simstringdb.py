@@ -5,8 +5,11 @@ import os
 import sys
 
 from common import ProtocolError
+from lrucache import LRUCache
 from message import Messager
-from os.path import join as path_join, sep as path_sep
+from ngramdb import ngrams
+from os.path import exists, join as path_join, sep as path_sep
+from threading import local
 
 try:
     from config import BASE_DIR, WORK_DIR
@@ -17,9 +20,28 @@ except ImportError:
     sys_path.append(path_join(dirname(__file__), '../..'))
     from config import BASE_DIR, WORK_DIR
 
+try:
+    from config import NGRAM_CACHE_SIZE
+except ImportError:
+    NGRAM_CACHE_SIZE = 2000
+
 # Filename extension used for DB file.
 SS_DB_FILENAME_EXTENSION = 'ss.db'
 
+# Filename extension used for the built-in n-gram index (ngramdb)
+NG_DB_FILENAME_EXTENSION = 'ngram.db'
+
+# Approximate string index implementations: the simstring library,
+# the built-in n-gram index or an SQLite FTS5 trigram table in the
+# normalization DB (see normdb.ids_by_name_fts; not supported by the
+# ssdb_* functions). Selectable per DB with the INDEX argument in the
+# normalization section of tools.conf.
+SIMSTRING_INDEX = 'simstring'
+NGRAM_INDEX = 'ngram'
+FTS5_INDEX = 'fts5'
+INDEX_TYPES = [SIMSTRING_INDEX, NGRAM_INDEX, FTS5_INDEX]
+DEFAULT_INDEX = SIMSTRING_INDEX
+
 # Default similarity measure
 DEFAULT_SIMILARITY_MEASURE = 'cosine'
 
@@ -32,6 +54,15 @@ DEFAULT_NGRAM_LENGTH = 3
 # Whether to include marks for begins and ends of strings
 DEFAULT_INCLUDE_MARKS = False
 
+# n-gram sets of DB strings, kept for filtering lookup results (see
+# supstring_filter)
+__ngram_cache = LRUCache(NGRAM_CACHE_SIZE)
+
+# Open DB handles, reused across lookups. Handles are not shared
+# between threads, so each thread has its own pool, mapping (DB file
+# path, measure, threshold) to (handle, file state when opened).
+__reader_pool = local()
+
 SIMSTRING_MISSING_ERROR = '''Error: failed to import the simstring library.
 This library is required for approximate string matching DB lookup.
 Please install simstring and its Python bindings from
@@ -54,6 +85,11 @@ class ssdbNotFoundError(Exception):
 
 # Note: The only reason we use a function call for this is to delay the import
 def __set_db_measure(db, measure):
+    import ngramdb
+    if isinstance(db, ngramdb.reader):
+        db.measure = measure
+        return
+
     try:
         import simstring
     except ImportError:
@@ -66,10 +102,11 @@ def __set_db_measure(db, measure):
             }
     db.measure = ss_measure_by_str[measure]
 
-def __ssdb_path(db):
+def __ssdb_path(db, index=SIMSTRING_INDEX):
     '''
     Given a simstring DB name/path, returns the path for the file that
-    is expected to contain the simstring DB.
+    is expected to contain the simstring DB (or the built-in n-gram
+    index if index is NGRAM_INDEX).
     '''
     # Assume we have a path relative to the brat root if the value
     # contains a separator, name only otherwise. 
@@ -79,26 +116,66 @@ def __ssdb_path(db):
         base = BASE_DIR
     else:
         base = WORK_DIR
-    return path_join(base, db+'.'+SS_DB_FILENAME_EXTENSION)
+    if index == NGRAM_INDEX:
+        extension = NG_DB_FILENAME_EXTENSION
+    else:
+        extension = SS_DB_FILENAME_EXTENSION
+    return path_join(base, db+'.'+extension)
+
+def __index_type(dbname, index):
+    # _select_index() without messages, returns None if no index is
+    # available
+    if index not in INDEX_TYPES:
+        index = DEFAULT_INDEX
+
+    if index == SIMSTRING_INDEX:
+        try:
+            import simstring
+        except ImportError:
+            if exists(__ssdb_path(dbname, NGRAM_INDEX)):
+                return NGRAM_INDEX
+            return None
+    return index
+
+def _select_index(dbname, index=None):
+    '''
+    Given a DB name and the configured index type (None for default),
+    returns the index type to use. Falls back on the built-in n-gram
+    index if the simstring library is not available and an n-gram
+    index exists for the DB.
+    '''
+    if index is not None and index not in INDEX_TYPES:
+        Messager.warning('Unknown approximate string index type "%s" for '
+                         'DB %s, using %s.' % (index, dbname, DEFAULT_INDEX))
+
+    selected = __index_type(dbname, index)
+    if selected is None:
+        Messager.error(SIMSTRING_MISSING_ERROR, duration=-1)
+        raise NoSimStringError
+    return selected
 
 def ssdb_build(strs, dbname, ngram_length=DEFAULT_NGRAM_LENGTH,
-               include_marks=DEFAULT_INCLUDE_MARKS):
+               include_marks=DEFAULT_INCLUDE_MARKS, index=None):
     '''
     Given a list of strings, a DB name, and simstring options, builds
-    a simstring DB for the strings.
+    a simstring DB (or a built-in n-gram index if index is
+    NGRAM_INDEX) for the strings.
     '''
-    try:
-        import simstring
-    except ImportError:
-        Messager.error(SIMSTRING_MISSING_ERROR, duration=-1)
-        raise NoSimStringError
+    if index == NGRAM_INDEX:
+        import ngramdb as ssdb_module
+    else:
+        try:
+            import simstring as ssdb_module
+        except ImportError:
+            Messager.error(SIMSTRING_MISSING_ERROR, duration=-1)
+            raise NoSimStringError
 
-    dbfn = __ssdb_path(dbname)
+    dbfn = __ssdb_path(dbname, index)
     try:
         # only library defaults (n=3, no marks) supported just now (TODO)
         assert ngram_length == 3, "Error: unsupported n-gram length"
         assert include_marks == False, "Error: begin/end marks not supported"
-        db = simstring.writer(dbfn)
+        db = ssdb_module.writer(dbfn)
         for s in strs:
             db.insert(s)
         db.close()
@@ -111,97 +188,128 @@ def ssdb_build(strs, dbname, ngram_length=DEFAULT_NGRAM_LENGTH,
 def ssdb_delete(dbname):
     '''
     Given a DB name, deletes all files associated with the simstring
-    DB.
+    DB and the n-gram index.
     '''
 
     dbfn = __ssdb_path(dbname)
-    os.remove(dbfn)
+    if exists(dbfn):
+        os.remove(dbfn)
     for fn in glob.glob(dbfn+'.*.cdb'):
         os.remove(fn)
+    ngdbfn = __ssdb_path(dbname, NGRAM_INDEX)
+    if exists(ngdbfn):
+        os.remove(ngdbfn)
 
-def ssdb_open(dbname):
+def ssdb_open(dbname, index=None):
     '''
-    Given a DB name, opens it as a simstring DB and returns the handle.
-    The caller is responsible for invoking close() on the handle.
+    Given a DB name, opens it as a simstring DB (or built-in n-gram
+    index, see _select_index()) and returns the handle. The caller is
+    responsible for invoking close() on the handle.
     '''
-    try:
-        import simstring
-    except ImportError:
-        Messager.error(SIMSTRING_MISSING_ERROR, duration=-1)
-        raise NoSimStringError
+    index = _select_index(dbname, index)
 
+    if index == NGRAM_INDEX:
+        import ngramdb
+        try:
+            return ngramdb.reader(__ssdb_path(dbname, index))
+        except (IOError, ngramdb.ngramdbFormatError):
+            Messager.error('Failed to open n-gram index DB %s' % dbname)
+            raise ssdbNotFoundError(dbname)
+
+    import simstring
     try:
         return simstring.reader(__ssdb_path(dbname))
     except IOError:
         Messager.error('Failed to open simstring DB %s' % dbname)
         raise ssdbNotFoundError(dbname)
 
-def ssdb_lookup(s, dbname, measure=DEFAULT_SIMILARITY_MEASURE, 
-                threshold=DEFAULT_THRESHOLD):
+def __file_state(fn):
+    # identifies the current version of the given file (None if
+    # missing), see normdb.db_file_state()
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+def ssdb_file_state(dbname, index=None):
     '''
-    Given a string and a DB name, returns the strings matching in the
-    associated simstring DB.
+    Returns a value identifying the current version of the index file
+    of the given DB (None if missing or if the index is the FTS5 table
+    of the normalization DB), changing whenever it is rebuilt. Unlike
+    the lookups, reports nothing if no index is available.
     '''
-    db = ssdb_open(dbname)
-
-    __set_db_measure(db, measure)
-    db.threshold = threshold
+    index = __index_type(dbname, index)
+    if index is None or index == FTS5_INDEX:
+        # no index, or covered by the state of the normalization DB
+        return None
+    return __file_state(__ssdb_path(dbname, index))
 
-    result = db.retrieve(s)
-    db.close()
+def _get_reader(dbname, measure, threshold, index=None):
+    '''
+    Returns a handle for the given DB as opened by ssdb_open() with
+    the given similarity measure and threshold set, reusing the
+    handle opened by the current thread unless the DB file has been
+    replaced or modified since. The handle must not be closed by the
+    caller.
+    '''
+    index = _select_index(dbname, index)
+    dbfn = __ssdb_path(dbname, index)
+    file_state = __file_state(dbfn)
 
-    # assume simstring DBs always contain UTF-8 - encoded strings
-    result = [r.decode('UTF-8') for r in result]
+    try:
+        pool = __reader_pool.readers
+    except AttributeError:
+        pool = __reader_pool.readers = {}
 
-    return result
+    key = (dbfn, measure, threshold)
+    db, opened_state = pool.get(key, (None, None))
+    if db is not None and (file_state is None or opened_state != file_state):
+        db.close()
+        del pool[key]
+        db = None
+    if db is None:
+        db = ssdb_open(dbname, index)
+        __set_db_measure(db, measure)
+        db.threshold = threshold
+        pool[key] = (db, file_state)
+    return db
 
-def ngrams(s, out=None, n=DEFAULT_NGRAM_LENGTH, be=DEFAULT_INCLUDE_MARKS):
+def close_readers():
     '''
-    Extracts n-grams from the given string s and adds them into the
-    given set out (or a new set if None). Returns the set. If be is
-    True, affixes begin and end markers to strings.
+    Closes the DB handles opened by the current thread.
     '''
+    pool = getattr(__reader_pool, 'readers', {})
+    for db, _ in pool.values():
+        db.close()
+    pool.clear()
 
-    if out is None:
-        out = set()
-
-    # implementation mirroring ngrams() in ngram.h in simstring-1.0
-    # distribution.
-
-    mark = '\x01'
-    src = ''
-    if be:
-        # affix begin/end marks
-        for i in range(n-1):
-            src += mark
-        src += s
-        for i in range(n-1):
-            src += mark
-    elif len(s) < n:
-        # pad strings shorter than n
-        src = s
-        for i in range(n-len(s)):
-            src += mark
-    else:
-        src = s
+def _cached_ngrams(s):
+    # ngrams() through the n-gram set cache. The returned set must not
+    # be modified.
+    s_ngrams = __ngram_cache.get(s)
+    if s_ngrams is None:
+        s_ngrams = ngrams(s)
+        __ngram_cache.put(s, s_ngrams)
+    return s_ngrams
+
+def ssdb_lookup(s, dbname, measure=DEFAULT_SIMILARITY_MEASURE, 
+                threshold=DEFAULT_THRESHOLD, index=None):
+    '''
+    Given a string and a DB name, returns the strings matching in the
+    associated simstring DB.
+    '''
+    db = _get_reader(dbname, measure, threshold, index)
 
-    # count n-grams
-    stat = {}
-    for i in range(len(src)-n+1):
-        ngram = src[i:i+n]
-        stat[ngram] = stat.get(ngram, 0) + 1
+    result = db.retrieve(s)
 
-    # convert into a set
-    for ngram, count in stat.items():
-        out.add(ngram)
-        # add ngram affixed with number if it appears more than once
-        for i in range(1, count):
-            out.add(ngram+str(i+1))
+    # assume simstring DBs always contain UTF-8 - encoded strings
+    result = [r.decode('UTF-8') for r in result]
 
-    return out
+    return result
 
 def ssdb_supstring_lookup(s, dbname, threshold=DEFAULT_THRESHOLD,
-                          with_score=False):
+                          with_score=False, index=None):
     '''
     Given a string s and a DB name, returns the strings in the
     associated simstring DB that likely contain s as an (approximate)
@@ -209,30 +317,47 @@ def ssdb_supstring_lookup(s, dbname, threshold=DEFAULT_THRESHOLD,
     where score is the fraction of n-grams in s that are also found in
     the matched string.
     '''
-    try:
-        import simstring
-    except ImportError:
-        Messager.error(SIMSTRING_MISSING_ERROR, duration=-1)
-        raise NoSimStringError
+    return ssdb_supstring_lookup_batch([s], dbname, threshold, with_score,
+                                       index)[s]
 
-    db = ssdb_open(dbname.encode('UTF-8'))
+def ssdb_supstring_lookup_batch(strs, dbname, threshold=DEFAULT_THRESHOLD,
+                                with_score=False, index=None):
+    '''
+    Given a list of strings and a DB name, returns a dict mapping
+    each of the strings to its ssdb_supstring_lookup() result. With
+    the built-in n-gram index, the n-grams shared by the strings are
+    looked up only once.
+    '''
+    db = _get_reader(dbname.encode('UTF-8'), 'overlap', threshold, index)
 
-    __set_db_measure(db, 'overlap')
-    db.threshold = threshold
+    strs = list(set(strs))
+    if hasattr(db, 'retrieve_many'):
+        retrieved = db.retrieve_many(strs)
+    else:
+        # no batch query in the simstring library
+        retrieved = [db.retrieve(s) for s in strs]
 
-    result = db.retrieve(s)
-    db.close()
+    results = {}
+    for s, result in zip(strs, retrieved):
+        # assume simstring DBs always contain UTF-8 - encoded strings
+        result = [r.decode('UTF-8') for r in result]
 
-    # assume simstring DBs always contain UTF-8 - encoded strings
-    result = [r.decode('UTF-8') for r in result]
+        # The simstring overlap measure is symmetric and thus does not
+        # differentiate between substring and superstring matches.
+        results[s] = supstring_filter(s, result, threshold, with_score)
+    return results
 
-    # The simstring overlap measure is symmetric and thus does not
-    # differentiate between substring and superstring matches.
+def supstring_filter(s, strs, threshold=DEFAULT_THRESHOLD, with_score=False):
+    '''
+    Given a string s and a list of strings, returns the strings that
+    likely contain s as an (approximate) substring, as for
+    ssdb_supstring_lookup().
+    '''
     # Replicate a small bit of the simstring functionality (mostly the
     # ngrams() function) to filter to substrings only.
-    s_ngrams = ngrams(s)
+    s_ngrams = _cached_ngrams(s)
     filtered = []
-    for r in result:
+    for r in strs:
         if s in r:
             # avoid calculation: simple containment => score=1
             if with_score:
@@ -240,7 +365,7 @@ def ssdb_supstring_lookup(s, dbname, threshold=DEFAULT_THRESHOLD,
             else:
                 filtered.append(r)
         else:
-            r_ngrams = ngrams(r)
+            r_ngrams = _cached_ngrams(r)
             overlap = s_ngrams & r_ngrams
             if len(overlap) >= len(s_ngrams) * threshold:
                 if with_score:
@@ -250,27 +375,18 @@ def ssdb_supstring_lookup(s, dbname, threshold=DEFAULT_THRESHOLD,
 
     return filtered
 
-def ssdb_supstring_exists(s, dbname, threshold=DEFAULT_THRESHOLD):
+def ssdb_supstring_exists(s, dbname, threshold=DEFAULT_THRESHOLD,
+                          index=None):
     '''
     Given a string s and a DB name, returns whether at least one
     string in the associated simstring DB likely contains s as an
     (approximate) substring.
     '''
-    try:
-        import simstring
-    except ImportError:
-        Messager.error(SIMSTRING_MISSING_ERROR, duration=-1)
-        raise NoSimStringError
-
     if threshold == 1.0:
         # optimized (not hugely, though) for this common case
-        db = ssdb_open(dbname.encode('UTF-8'))
-
-        __set_db_measure(db, 'overlap')
-        db.threshold = threshold
+        db = _get_reader(dbname.encode('UTF-8'), 'overlap', threshold, index)
 
         result = db.retrieve(s)
-        db.close()
 
         # assume simstring DBs always contain UTF-8 - encoded strings
         result = [r.decode('UTF-8') for r in result]
@@ -281,7 +397,8 @@ def ssdb_supstring_exists(s, dbname, threshold=DEFAULT_THRESHOLD):
         return False
     else:
         # naive implementation for everything else
-        return len(ssdb_supstring_lookup(s, dbname, threshold)) != 0
+        return len(ssdb_supstring_lookup(s, dbname, threshold,
+                                         index=index)) != 0
 
 if __name__ == "__main__":
     # test
@@ -317,11 +434,17 @@ if __name__ == "__main__":
         "-12345",
         "012345",
         ]
+    try:
+        import simstring
+        index = SIMSTRING_INDEX
+    except ImportError:
+        index = NGRAM_INDEX
     print 'strings:', strings
-    ssdb_build(strings, dbname)
+    ssdb_build(strings, dbname, index=index)
     for t in ['0', '012', '012345', '0123456', '0123456789']:
         print 'lookup for', t
-        for s in ssdb_supstring_lookup(t, dbname):
+        for s in ssdb_supstring_lookup(t, dbname, index=index):
             print s, 'contains', t, '(threshold %f)' % DEFAULT_THRESHOLD
+    close_readers()
     ssdb_delete(dbname)
     
@@ -204,7 +204,5 @@ def retrieve_stored(document, suffix):
     hdrs = [('Content-Type', content_type),
             ('Content-Disposition', 'inline; filename=' + filename)]
 
-    with open(stored_path, 'rb') as stored_file:
-        data = stored_file.read()
-
-    raise NoPrintJSONError(hdrs, data)
+    # Streamed to the client, see wsgi.py
+    raise NoPrintJSONError(hdrs, open(stored_path, 'rb'))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+WSGI interface to the brat server, used by all of the entry points
+(ajax.cgi, ajax.fcgi, ajax.wsgi and standalone.py).
+'''
+
+from cgi import FieldStorage
+from threading import BoundedSemaphore
+from urlparse import parse_qs
+
+from metrics import PROMETHEUS_CONTENT_TYPE, prometheus_text, response_size
+from server import serve
+
+try:
+    from config import SLOW_ACTION_THREADS
+except ImportError:
+    SLOW_ACTION_THREADS = 2
+try:
+    from config import METRICS_ENDPOINT
+except ImportError:
+    METRICS_ENDPOINT = True
+
+### Constants
+# Actions that may keep a thread busy for seconds; at most
+# SLOW_ACTION_THREADS of these are served at the same time, so that
+# they cannot take up all the threads of the server
+SLOW_ACTIONS = frozenset((
+    'tag',
+    'suggestSpanTypes',
+    'normAuto',
+    'downloadCollection',
+    'searchTextInCollection',
+    'searchEntityInCollection',
+    'searchEventInCollection',
+    'searchRelationInCollection',
+    'searchNoteInCollection',
+    ))
+# Path of the metrics of the serving process (see metrics.py)
+METRICS_PATH = '/metrics'
+# Size of the blocks of streamed response bodies
+BLOCK_SIZE = 64 * 1024
+###
+
+if SLOW_ACTION_THREADS > 0:
+    _slow_action_slots = BoundedSemaphore(SLOW_ACTION_THREADS)
+else:
+    _slow_action_slots = None
+
+
+class RequestParams(dict):
+    '''
+    Request parameters as parsed by parse_qs(), with the getvalue()
+    of FieldStorage used by the brat server.
+    '''
+
+    def getvalue(self, key, default=None):
+        values = self.get(key)
+        if values is None:
+            return default
+        elif len(values) == 1:
+            return values[0]
+        else:
+            return values
+
+
+class Request(object):
+    '''
+    A brat request, parsed from a WSGI environment. The parameters
+    are read from the query string and the request body, reading at
+    most CONTENT_LENGTH bytes of the latter.
+    '''
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.method = environ.get('REQUEST_METHOD', 'GET')
+        self.client_ip = environ.get('REMOTE_ADDR')
+        self.client_hostname = environ.get('REMOTE_HOST')
+        self.cookie_data = environ.get('HTTP_COOKIE')
+        self.params = self._parse_params()
+
+    def _parse_params(self):
+        environ = self.environ
+        query_string = environ.get('QUERY_STRING', '')
+        if self.method != 'POST':
+            return RequestParams(parse_qs(query_string))
+
+        content_type = environ.get('CONTENT_TYPE', '')
+        if not content_type.startswith('application/x-www-form-urlencoded'):
+            # e.g. multipart, leave to FieldStorage
+            return FieldStorage(fp=environ['wsgi.input'], environ=environ)
+
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        body = environ['wsgi.input'].read(content_length)
+        if query_string and body:
+            query_string = query_string + '&' + body
+        else:
+            query_string = query_string or body
+        return RequestParams(parse_qs(query_string))
+
+    @property
+    def action(self):
+        return self.params.getvalue('action')
+
+    def serve(self):
+        '''
+        Serves the request, returning a (headers, body) tuple where
+        body is as for iter_body().
+        '''
+
+        if _slow_action_slots is not None and self.action in SLOW_ACTIONS:
+            _slow_action_slots.acquire()
+            try:
+                cookie_hdrs, response_data = serve(self.params,
+                        self.client_ip, self.client_hostname,
+                        self.cookie_data)
+            finally:
+                _slow_action_slots.release()
+        else:
+            cookie_hdrs, response_data = serve(self.params, self.client_ip,
+                    self.client_hostname, self.cookie_data)
+
+        if cookie_hdrs is not None:
+            response_hdrs = [hdr for hdr in cookie_hdrs]
+        else:
+            response_hdrs = []
+        # WSGI requires headers as byte strings
+        for k, v in response_data[0]:
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            response_hdrs.append((k, v))
+
+        # Hack to support binary data and general Unicode for SVGs and JSON
+        body = response_data[1]
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        return response_hdrs, body
+
+
+def iter_body(body, block_size=BLOCK_SIZE):
+    '''
+    Generates the blocks of a response body, closing the file if the
+    body is one.
+    '''
+
+    if isinstance(body, str):
+        for i in xrange(0, len(body), block_size):
+            yield body[i:i+block_size]
+    else:
+        try:
+            while True:
+                block = body.read(block_size)
+                if not block:
+                    break
+                yield block
+        finally:
+            body.close()
+
+def application(environ, start_response):
+    if METRICS_ENDPOINT and environ.get('PATH_INFO') == METRICS_PATH:
+        body = prometheus_text()
+        start_response('200 OK', [('Content-Type', PROMETHEUS_CONTENT_TYPE),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    request = Request(environ)
+    response_hdrs, body = request.serve()
+    response_hdrs.append(('Content-Length', str(response_size(body))))
+
+    # Not returning 200 OK is a breach of protocol with the client
+    start_response('200 OK', response_hdrs)
+
+    if isinstance(body, str):
+        # Do not split small responses (e.g. JSON) into blocks
+        if len(body) <= BLOCK_SIZE:
+            return [body]
+        return iter_body(body)
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(body, BLOCK_SIZE)
+    return iter_body(body)
+
+
+def serve_threaded(port, host=''):
+    '''
+    Serves brat requests with a thread per connection until
+    interrupted.
+    '''
+
+    from SocketServer import ThreadingMixIn
+    from wsgiref.simple_server import (make_server, WSGIServer,
+            WSGIRequestHandler)
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    class QuietWSGIRequestHandler(WSGIRequestHandler):
+        def log_request(self, code='-', size='-'):
+            pass
+
+    httpd = make_server(host, port, application,
+            server_class=ThreadingWSGIServer,
+            handler_class=QuietWSGIRequestHandler)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    from StringIO import StringIO
+    from tempfile import TemporaryFile
+    from unittest import TestCase
+    import unittest
+
+    class RequestTest(TestCase):
+        def test_get(self):
+            request = Request({'QUERY_STRING': 'action=getDocument&a=1&a=2',
+                               'REMOTE_ADDR': '127.0.0.1'})
+            self.assertEqual(request.action, 'getDocument')
+            self.assertEqual(request.params.getvalue('a'), ['1', '2'])
+            self.assertEqual(request.params.getvalue('b'), None)
+            self.assertEqual(request.client_ip, '127.0.0.1')
+
+        def test_post(self):
+            body = 'action=login&user=u%C3%A4'
+            request = Request({
+                    'REQUEST_METHOD': 'POST',
+                    'QUERY_STRING': 'protocol=1',
+                    'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                    'CONTENT_LENGTH': str(len(body)),
+                    'wsgi.input': StringIO(body + 'trailing'),
+                    })
+            self.assertEqual(sorted(request.params), ['action',
+                'protocol', 'user'])
+            self.assertEqual(request.params.getvalue('user'), 'u\xc3\xa4')
+
+        def test_iter_body(self):
+            body = 'x' * 10
+            self.assertEqual(list(iter_body(body, 4)),
+                             ['xxxx', 'xxxx', 'xx'])
+            f = TemporaryFile()
+            f.write(body)
+            f.seek(0)
+            self.assertEqual(response_size(f), 10)
+            self.assertEqual(''.join(iter_body(f, 4)), body)
+            self.assertTrue(f.closed)
+
+    unittest.main()
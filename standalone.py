@@ -13,15 +13,19 @@ import os
 from posixpath import normpath
 from urllib import unquote
 
-from cgi import FieldStorage
 from BaseHTTPServer import HTTPServer
 from SimpleHTTPServer import SimpleHTTPRequestHandler
-from SocketServer import ForkingMixIn
+from SocketServer import ForkingMixIn, ThreadingMixIn
+from threading import Condition
+import signal
 import socket
+from time import sleep
 
 # brat imports
 sys.path.append(os.path.join(os.path.dirname(__file__), 'server/src'))
-from server import serve
+from metrics import (PROMETHEUS_CONTENT_TYPE, flush_metrics, prometheus_text,
+        response_size, share_metrics, start_metrics_flusher)
+from wsgi import Request, iter_body, METRICS_ENDPOINT, METRICS_PATH
 
 # pre-import everything possible (TODO: prune unnecessary)
 import annlog
@@ -38,6 +42,7 @@ import filelock
 import gtbtokenize
 import jsonwrap
 import message
+import metrics
 import normdb
 import norm
 import predict
@@ -57,15 +62,32 @@ import tag
 import tokenise
 import undo
 import verify_annotations
+import wsgi
+
+try:
+    from config import STANDALONE_WORKERS
+except ImportError:
+    STANDALONE_WORKERS = 0
+try:
+    from config import STANDALONE_MAX_REQUESTS
+except ImportError:
+    STANDALONE_MAX_REQUESTS = 1000
 
 _VERBOSE_HANDLER = False
 _DEFAULT_SERVER_ADDR = ''
 _DEFAULT_SERVER_PORT = 8001
+# seconds to wait for the next request on a kept-alive connection
+_KEEP_ALIVE_TIMEOUT = 15
+# seconds to wait before replacing a failed worker, doubled for each
+# further failure before a worker exits normally
+_RESPAWN_DELAY = 1
+_MAX_RESPAWN_DELAY = 60
 
 _PERMISSIONS = """
 Allow: /ajax.cgi
 Disallow: *.py
 Disallow: *.cgi
+Disallow: *.wsgi
 Disallow: /.htaccess
 Disallow: *.py~  # no emacs backups
 Disallow: *.cgi~
@@ -159,6 +181,42 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
 
     permissions = PathPermissions().parse(_PERMISSIONS.split('\n'))
 
+    # keep connections alive (all responses give a content length),
+    # buffering output to send each response in as few packets as
+    # possible
+    protocol_version = 'HTTP/1.1'
+    timeout = _KEEP_ALIVE_TIMEOUT
+    wbufsize = -1
+
+    def handle_one_request(self):
+        if getattr(self, 'raw_requestline', ''):
+            # waiting for the next request on a kept-alive connection
+            self.server.connection_idle(self.connection)
+        self.raw_requestline = ''
+        SimpleHTTPRequestHandler.handle_one_request(self)
+        if not self.raw_requestline:
+            # connection closed or timed out, no request
+            return
+        # count requests for worker recycling (see PreforkingBratServer)
+        self.server.count_request()
+
+    def parse_request(self):
+        # the request line has arrived
+        self.server.connection_busy(self.connection)
+        return SimpleHTTPRequestHandler.parse_request(self)
+
+    def log_error(self, format, *args):
+        if format.startswith('Request timed out') and not _VERBOSE_HANDLER:
+            # idle connections are expected to time out
+            return
+        SimpleHTTPRequestHandler.log_error(self, format, *args)
+
+    def end_headers(self):
+        if self.server.retiring():
+            # last request before the worker is replaced
+            self.send_header('Connection', 'close')
+        SimpleHTTPRequestHandler.end_headers(self)
+
     def log_request(self, code='-', size='-'):
         if _VERBOSE_HANDLER:
             SimpleHTTPRequestHandler.log_request(self, code, size)
@@ -177,54 +235,56 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
         else:
             return False    
 
-    def run_brat_direct(self):
-        """Execute brat server directly."""
+    def is_metrics(self):
+        path = self.path.split('?', 1)[0]
+        return METRICS_ENDPOINT and path == METRICS_PATH
 
-        remote_addr = self.client_address[0]
-        remote_host = self.address_string()
-        cookie_data = ', '.join(filter(None, self.headers.getheaders('cookie')))
+    def send_metrics(self):
+        """Send the metrics of all processes of the server."""
+
+        data = prometheus_text()
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def brat_environ(self):
+        """Return the WSGI environment of a brat request, reading the
+        request body from the connection."""
 
         query_string = ''
         i = self.path.find('?')
         if i != -1:
             query_string = self.path[i+1:]
-            
-        saved = sys.stdin, sys.stdout, sys.stderr
-        sys.stdin, sys.stdout = self.rfile, self.wfile
-
-        # set env to get FieldStorage to read params
-        env = {}
-        env['REQUEST_METHOD'] = self.command
-        content_length = self.headers.getheader('content-length')
-        if content_length:
-            env['CONTENT_LENGTH'] = content_length
-        if query_string:
-            env['QUERY_STRING'] = query_string
-        os.environ.update(env)
-        params = FieldStorage()
 
-        # Call main server
-        cookie_hdrs, response_data = serve(params, remote_addr, remote_host,
-                                           cookie_data)
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'QUERY_STRING': query_string,
+            'CONTENT_TYPE': self.headers.getheader('content-type', ''),
+            'CONTENT_LENGTH': self.headers.getheader('content-length', ''),
+            'REMOTE_ADDR': self.client_address[0],
+            'REMOTE_HOST': self.address_string(),
+            'wsgi.input': self.rfile,
+            }
+        cookie_data = ', '.join(filter(None, self.headers.getheaders('cookie')))
+        if cookie_data:
+            environ['HTTP_COOKIE'] = cookie_data
+        return environ
 
-        sys.stdin, sys.stdout, sys.stderr = saved
+    def run_brat_direct(self):
+        """Execute brat server directly."""
 
-        # Package and send response
-        if cookie_hdrs is not None:
-            response_hdrs = [hdr for hdr in cookie_hdrs]
-        else:
-            response_hdrs = []
-        response_hdrs.extend(response_data[0])
+        # Call main server
+        response_hdrs, body = Request(self.brat_environ()).serve()
 
         self.send_response(200)
-        self.wfile.write('\n'.join('%s: %s' % (k, v) for k, v in response_hdrs))
-        self.wfile.write('\n')
-        self.wfile.write('\n')
-        # Hack to support binary data and general Unicode for SVGs and JSON
-        if isinstance(response_data[1], unicode):
-            self.wfile.write(response_data[1].encode('utf-8'))
-        else:
-            self.wfile.write(response_data[1])
+        for k, v in response_hdrs:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(response_size(body)))
+        self.end_headers()
+        for block in iter_body(body):
+            self.wfile.write(block)
         return 0
 
     def allow_path(self):
@@ -263,6 +323,8 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
             self.send_error(403)
         elif self.is_brat():
             self.run_brat_direct()
+        elif self.is_metrics():
+            self.send_metrics()
         else:
             SimpleHTTPRequestHandler.do_GET(self)
 
@@ -277,6 +339,174 @@ class BratServer(ForkingMixIn, HTTPServer):
     def __init__(self, server_address):
         HTTPServer.__init__(self, server_address, BratHTTPRequestHandler)
 
+    # each forked child handles a single connection and exits, so
+    # there are no workers to recycle
+    def count_request(self):
+        pass
+
+    def retiring(self):
+        return False
+
+    def shutdown_request(self, request):
+        HTTPServer.shutdown_request(self, request)
+        # only called in the forked child, which then exits
+        flush_metrics()
+
+    def connection_idle(self, connection):
+        pass
+
+    def connection_busy(self, connection):
+        pass
+
+class PreforkingBratServer(ThreadingMixIn, HTTPServer):
+    """Serves requests with a fixed pool of worker processes forked
+    after binding, which keep their caches across requests. Each
+    worker serves its connections in threads, and is replaced after
+    handling max_requests requests (no limit if 0) once its open
+    connections are closed: kept-alive ones waiting for a request at
+    once, the others after their current response."""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, workers, max_requests):
+        HTTPServer.__init__(self, server_address, BratHTTPRequestHandler)
+        self.workers = workers
+        self.max_requests = max_requests
+        self.requests_handled = 0
+        self.connections = 0
+        self.idle = set()
+        self.retired = False
+        self.lock = Condition()
+
+    def count_request(self):
+        self.lock.acquire()
+        try:
+            self.requests_handled += 1
+        finally:
+            self.lock.release()
+
+    def retiring(self):
+        # whether the request being served is the last before the
+        # worker is replaced
+        return (self.max_requests and
+                self.requests_handled+1 >= self.max_requests)
+
+    def connection_idle(self, connection):
+        self.lock.acquire()
+        try:
+            if self.retired:
+                self.close_idle(connection)
+            else:
+                self.idle.add(connection)
+        finally:
+            self.lock.release()
+
+    def connection_busy(self, connection):
+        self.lock.acquire()
+        try:
+            self.idle.discard(connection)
+        finally:
+            self.lock.release()
+
+    def close_idle(self, connection):
+        # end the wait for a request; the handler then returns
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def process_request(self, request, client_address):
+        self.lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self.lock.release()
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except:
+            self.connection_closed(request)
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request,
+                                                  client_address)
+        finally:
+            self.connection_closed(request)
+
+    def connection_closed(self, connection):
+        self.lock.acquire()
+        try:
+            self.idle.discard(connection)
+            self.connections -= 1
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def work(self):
+        # all workers block in accept() on the shared listening socket
+        while (not self.max_requests or
+               self.requests_handled < self.max_requests):
+            self._handle_request_noblock()
+        # let the open connections finish
+        self.lock.acquire()
+        try:
+            self.retired = True
+            for connection in self.idle:
+                self.close_idle(connection)
+            while self.connections:
+                self.lock.wait()
+        finally:
+            self.lock.release()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 0
+            try:
+                if METRICS_ENDPOINT:
+                    start_metrics_flusher()
+                self.work()
+            except KeyboardInterrupt:
+                pass
+            except:
+                self.handle_error(None, None)
+                status = 1
+            flush_metrics()
+            os._exit(status)
+        return pid
+
+    def serve_forever(self):
+        # stop the workers also when terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        children = set()
+        delay = 0
+        try:
+            while True:
+                while len(children) < self.workers:
+                    children.add(self.spawn())
+                pid, status = os.wait()
+                if pid not in children:
+                    continue
+                children.remove(pid)
+                if status:
+                    # don't turn a worker failing at startup into a
+                    # fork loop
+                    delay = min(max(2*delay, _RESPAWN_DELAY),
+                                _MAX_RESPAWN_DELAY)
+                    print >> sys.stderr, ("Worker %d failed, replacing it "
+                                          "in %d seconds" % (pid, delay))
+                    sleep(delay)
+                else:
+                    delay = 0
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
 def main(argv):
     # warn if root/admin
     try:
@@ -305,7 +535,17 @@ server is experimental and should not be run as administrator.
         port = _DEFAULT_SERVER_PORT
 
     try:
-        server = BratServer((_DEFAULT_SERVER_ADDR, port))
+        if METRICS_ENDPOINT:
+            # requests are served by forked processes, which add their
+            # metrics to a DB read by whichever process serves /metrics
+            share_metrics()
+        if STANDALONE_WORKERS > 0:
+            server = PreforkingBratServer((_DEFAULT_SERVER_ADDR, port),
+                                          STANDALONE_WORKERS,
+                                          STANDALONE_MAX_REQUESTS)
+            print >> sys.stderr, "Using %d worker processes" % STANDALONE_WORKERS
+        else:
+            server = BratServer((_DEFAULT_SERVER_ADDR, port))
         print >> sys.stderr, "Serving brat at http://%s:%d" % server.server_address
         server.serve_forever()
     except KeyboardInterrupt:
@@ -32,26 +32,39 @@
 # a search for "Human Calcitonin" would match P01258 but not P01257.
 # Fields with TYPE "info" are not used for querying.
 
+# Alternatively, with option --obo the input file is an OBO ontology,
+# whose terms are converted into lines of this format as the file is
+# read (see tools/oboextract.py), optionally restricted to given
+# ontology prefixes and subtrees.
+
 from __future__ import with_statement
 
 import sys
-import codecs
+import io
 from datetime import datetime
+from multiprocessing import Process, Queue
+from Queue import Empty, Full
 from os.path import dirname, basename, splitext, join
 
 import sqlite3 as sqlite
 
+# assume script in brat tools/ directory, extend path to find ngramdb.py
+sys.path.append(join(dirname(__file__), '../server/src'))
+import ngramdb
+import oboextract
+
 try:
     import simstring
 except ImportError:
-    errorstr = """
+    simstring = None
+
+SIMSTRING_MISSING_ERROR = """
     Error: failed to import the simstring library.
-    This library is required for approximate string matching DB lookup.
-    Please install simstring and its python bindings from 
+    This library is required for approximate string matching DB lookup
+    with simstring. Please install simstring and its python bindings from 
     http://www.chokkan.org/software/simstring/
+    or create a built-in n-gram index instead (option -i ngram).
 """
-    print >> sys.stderr, errorstr
-    sys.exit(1)
 
 # Default encoding for input text
 DEFAULT_INPUT_ENCODING = 'UTF-8'
@@ -67,6 +80,13 @@ SQL_DB_FILENAME_EXTENSION = 'db'
 # Filename extension used for simstring database file.
 SS_DB_FILENAME_EXTENSION = 'ss.db'
 
+# Filename extension used for the built-in n-gram index file.
+NG_DB_FILENAME_EXTENSION = 'ngram.db'
+
+# Approximate string index types (see server/src/simstringdb.py)
+SIMSTRING_INDEX = 'simstring'
+NGRAM_INDEX = 'ngram'
+
 # Length of n-grams in simstring DBs
 DEFAULT_NGRAM_LENGTH = 3
 
@@ -76,6 +96,24 @@ DEFAULT_INCLUDE_MARKS = False
 # Maximum number of "error" lines to output
 MAX_ERROR_LINES = 100
 
+# Number of input lines loaded per chunk (and transaction in bulk mode)
+BULK_CHUNK_SIZE = 50000
+
+# SQLite settings for bulk mode. Without a rollback journal or syncs,
+# a failed load leaves a broken DB, which is simply built again.
+BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode=OFF;",
+    "PRAGMA synchronous=OFF;",
+    "PRAGMA cache_size=-262144;",
+]
+
+# Maximum number of chunks of strings waiting for the index worker
+# in bulk mode
+BULK_QUEUE_SIZE = 8
+
+# Number of input lines between progress reports (verbose mode)
+PROGRESS_INTERVAL = 100000
+
 # Supported TYPE values
 TYPE_VALUES = ["name", "attr", "info"]
 
@@ -150,6 +188,22 @@ CREATE_INDEX_COMMANDS = [
 "CREATE INDEX infos_entity_id ON infos (entity_id);",
 ]
 
+# SQL for creating and filling the optional FTS5 trigram table of
+# normalized names (for INDEX:fts5, see server/src/normdb.py)
+CREATE_FTS_COMMANDS = [
+"CREATE VIRTUAL TABLE names_fts USING fts5(normvalue, tokenize='trigram');",
+"INSERT INTO names_fts (normvalue) SELECT DISTINCT(normvalue) FROM names;",
+]
+
+# SQL for inserting rows into each table
+INSERT_COMMANDS = {
+    "entities" : "INSERT into entities VALUES (?, ?)",
+    "labels" : "INSERT into labels VALUES (?, ?)",
+    "names" : "INSERT into names VALUES (?, ?, ?, ?, ?)",
+    "attributes" : "INSERT into attributes VALUES (?, ?, ?, ?, ?)",
+    "infos" : "INSERT into infos VALUES (?, ?, ?, ?)",
+}
+
 # SQL for selecting strings to be inserted into the simstring DB for
 # approximate search
 SELECT_SIMSTRING_STRINGS_COMMAND = """
@@ -189,6 +243,13 @@ def argparser():
     ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Verbose output")
     ap.add_argument("-d", "--database", default=None, help="Base name of databases to create (default by input file name in brat work directory)")
     ap.add_argument("-e", "--encoding", default=DEFAULT_INPUT_ENCODING, help="Input text encoding (default "+DEFAULT_INPUT_ENCODING+")")
+    ap.add_argument("-b", "--bulk", default=False, action="store_true", help="Bulk load mode for large inputs: load in large transactions without journaling and build the approximate string index in parallel")
+    ap.add_argument("-f", "--fts5", default=False, action="store_true", help="Also create an SQLite FTS5 trigram index of names in the SQL DB (requires SQLite 3.34 or later)")
+    ap.add_argument("-o", "--obo", default=False, action="store_true", help="Input is an OBO ontology")
+    ap.add_argument("-l", "--limit", default=None, metavar="PREFIX", help="With --obo, limit to terms with given ontology prefix or prefixes (multiple separated by \"|\")")
+    ap.add_argument("-r", "--root", default=[], metavar="TERM", nargs="+", help="With --obo, limit to subtrees rooted at given terms (names or IDs)")
+    ap.add_argument("-x", "--exclude", default=[], metavar="TERM", nargs="+", help="With --obo, exclude subtrees rooted at given terms (names or IDs)")
+    ap.add_argument("-i", "--index", default=None, choices=[SIMSTRING_INDEX, NGRAM_INDEX], help="Approximate string index to create (default simstring if available, ngram otherwise)")
     ap.add_argument("file", metavar="FILE", help="Normalization data")
     return ap
 
@@ -199,12 +260,69 @@ def sqldb_filename(dbname):
     '''
     return join(default_db_dir(), dbname+'.'+SQL_DB_FILENAME_EXTENSION)
 
-def ssdb_filename(dbname):
+def ssdb_filename(dbname, index=SIMSTRING_INDEX):
     '''
     Given a DB name, returns the  name of the file that is expected to
-    contain the simstring DB.
+    contain the simstring DB (or n-gram index).
     '''
-    return join(default_db_dir(), dbname+'.'+SS_DB_FILENAME_EXTENSION)
+    return join(default_db_dir(), dbname+'.'+ssdb_extension(index))
+
+def ssdb_extension(index):
+    if index == NGRAM_INDEX:
+        return NG_DB_FILENAME_EXTENSION
+    else:
+        return SS_DB_FILENAME_EXTENSION
+
+def open_ssdb(index, ssdbfn):
+    if index == NGRAM_INDEX:
+        return ngramdb.writer(ssdbfn)
+    else:
+        return simstring.writer(ssdbfn)
+
+def build_ssdb(index, ssdbfn, strings, results):
+    # Index worker process for bulk mode: inserts the strings of the
+    # chunks received from the strings queue into the simstring DB (or
+    # n-gram index) until None is received, then puts the number of
+    # strings in the results queue.
+    ssdb = open_ssdb(index, ssdbfn)
+    count = 0
+    while True:
+        chunk = strings.get()
+        if chunk is None:
+            break
+        for s in chunk:
+            # encode as UTF-8 for simstring
+            ssdb.insert(s.encode('utf-8'))
+        count += len(chunk)
+    ssdb.close()
+    results.put(count)
+
+def put_to_worker(worker, queue, item):
+    # queue.put() that fails instead of blocking if the worker has died
+    while True:
+        try:
+            queue.put(item, timeout=1)
+            return
+        except Full:
+            if not worker.is_alive():
+                raise RuntimeError("index worker exited")
+
+def get_from_worker(worker, queue):
+    # queue.get() that fails instead of blocking if the worker has died
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not worker.is_alive():
+                raise RuntimeError("index worker exited")
+
+def seconds_since(start_time):
+    delta = datetime.now() - start_time
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def report_progress(line_count, import_count, start_time):
+    seconds = max(seconds_since(start_time), 0.001)
+    print >> sys.stderr, "  %d lines, %d entries (%.0f lines/second)" % (line_count, import_count, line_count / seconds)
 
 def main(argv):
     arg = argparser().parse_args(argv[1:])
@@ -215,23 +333,62 @@ def main(argv):
 
     infn = arg.file
 
+    index = arg.index
+    if index is None:
+        index = SIMSTRING_INDEX if simstring is not None else NGRAM_INDEX
+    if index == SIMSTRING_INDEX and simstring is None:
+        print >> sys.stderr, SIMSTRING_MISSING_ERROR
+        return 1
+
     if arg.database is None:
         # default database file name
         bn = splitext(basename(infn))[0]
         sqldbfn = sqldb_filename(bn)
-        ssdbfn = ssdb_filename(bn)
+        ssdbfn = ssdb_filename(bn, index)
     else:
         sqldbfn = arg.database+'.'+SQL_DB_FILENAME_EXTENSION
-        ssdbfn = arg.database+'.'+SS_DB_FILENAME_EXTENSION
+        ssdbfn = arg.database+'.'+ssdb_extension(index)
 
     if arg.verbose:
         print >> sys.stderr, "Storing SQL DB as %s and" % sqldbfn
-        print >> sys.stderr, "  simstring DB as %s" % ssdbfn
+        print >> sys.stderr, "  %s DB as %s" % (index, ssdbfn)
     start_time = datetime.now()
 
     import_count, duplicate_count, error_count, simstring_count = 0, 0, 0, 0
+    line_count = 0
+
+    if arg.bulk:
+        # build the approximate string index in a separate process
+        # while loading the SQL DB, sending it the strings to index in
+        # chunks. (Started before connecting to the SQL DB so that the
+        # connection is not shared with the worker.)
+        ss_strings, ss_results = Queue(BULK_QUEUE_SIZE), Queue()
+        ss_worker = Process(target=build_ssdb,
+                            args=(index, ssdbfn, ss_strings, ss_results))
+        # terminated on exit if the load fails
+        ss_worker.daemon = True
+        ss_worker.start()
+    else:
+        ss_worker = None
+
+    if arg.obo and (arg.root or arg.exclude):
+        # the subtrees are determined by reading the is_a relations of
+        # the whole ontology before the terms are loaded
+        if arg.verbose:
+            print >> sys.stderr, "Reading ontology structure ...",
+        with io.open(infn, 'rU', encoding=arg.encoding) as inf:
+            obo_ids = oboextract.subtree_ids(inf, arg.root or None,
+                                             arg.exclude)
+        if arg.verbose:
+            print >> sys.stderr, "done."
+    else:
+        obo_ids = None
 
-    with codecs.open(infn, 'rU', encoding=arg.encoding) as inf:        
+    # (io.open decodes considerably faster than codecs.open)
+    with io.open(infn, 'rU', encoding=arg.encoding) as inf:
+        if arg.obo:
+            limit_prefixes = arg.limit.split("|") if arg.limit else None
+            inf = oboextract.iter_norm_db_lines(inf, limit_prefixes, obo_ids)
 
         # create SQL DB
         try:
@@ -241,6 +398,12 @@ def main(argv):
             return 1
         cursor = connection.cursor()
 
+        if arg.bulk:
+            # manage transactions explicitly
+            connection.isolation_level = None
+            for command in BULK_LOAD_PRAGMAS:
+                cursor.execute(command)
+
         # create SQL tables
         if arg.verbose:
             print >> sys.stderr, "Creating tables ...",
@@ -255,15 +418,44 @@ def main(argv):
         # import data
         if arg.verbose:
             print >> sys.stderr, "done."
-            print >> sys.stderr, "Importing data ...",
+            print >> sys.stderr, "Importing data ..."
 
         next_eid = 1
         label_id = {}
         next_lid = 1
         next_pid = dict([(t,1) for t in TYPE_VALUES])
 
+        # rows are buffered and inserted in chunks, as are the distinct
+        # strings sent to the index worker in bulk mode. Entities are
+        # inserted directly to detect duplicate IDs, except in bulk
+        # mode, where the IDs seen are kept in memory instead.
+        rows = dict([(t, []) for t in INSERT_COMMANDS.keys()])
+        seen_ids = set()
+        ss_chunk, ss_seen = [], set()
+
+        def flush_chunk():
+            for table in ["entities", "labels"] + TABLE_HAS_NORMVALUE.keys():
+                if rows[table]:
+                    cursor.executemany(INSERT_COMMANDS[table], rows[table])
+                    rows[table] = []
+            if arg.bulk:
+                cursor.execute("COMMIT")
+                put_to_worker(ss_worker, ss_strings, ss_chunk[:])
+                del ss_chunk[:]
+
+        if arg.bulk:
+            cursor.execute("BEGIN")
+
         for i, l in enumerate(inf):
             l = l.rstrip('\n')
+            line_count = i+1
+
+            if line_count % BULK_CHUNK_SIZE == 0:
+                flush_chunk()
+                if arg.bulk:
+                    cursor.execute("BEGIN")
+            if arg.verbose and line_count % PROGRESS_INTERVAL == 0:
+                report_progress(line_count, import_count, start_time)
 
             # parse line into ID and TYPE:LABEL:STRING triples
             try:
@@ -295,9 +487,18 @@ def main(argv):
             # insert entity
             eid = next_eid
             next_eid += 1
-            try:
-                cursor.execute("INSERT into entities VALUES (?, ?)", (eid, id_))
-            except sqlite.IntegrityError, e:
+            e = None
+            if not arg.bulk:
+                try:
+                    cursor.execute(INSERT_COMMANDS["entities"], (eid, id_))
+                except sqlite.IntegrityError, e:
+                    pass
+            elif id_ in seen_ids:
+                e = "duplicate ID"
+            else:
+                seen_ids.add(id_)
+                rows["entities"].append((eid, id_))
+            if e is not None:
                 if error_count < MAX_ERROR_LINES:
                     print >> sys.stderr, "Error inserting %s (skipping): %s" % (id_, e)
                 elif error_count == MAX_ERROR_LINES:
@@ -311,7 +512,7 @@ def main(argv):
             for label in new_labels:
                 lid = next_lid
                 next_lid += 1
-                cursor.execute("INSERT into labels VALUES (?, ?)", (lid, label))
+                rows["labels"].append((lid, label))
                 label_id[label] = lid
 
             # insert associated strings
@@ -322,23 +523,27 @@ def main(argv):
                 lid = label_id[label] # TODO
                 if TABLE_HAS_NORMVALUE[table]:
                     normstring = string_norm_form(string)
-                    cursor.execute("INSERT into %s VALUES (?, ?, ?, ?, ?)" % table,
-                                   (pid, eid, lid, string, normstring))
+                    rows[table].append((pid, eid, lid, string, normstring))
+                    if arg.bulk and normstring not in ss_seen:
+                        ss_seen.add(normstring)
+                        ss_chunk.append(normstring)
                 else:
-                    cursor.execute("INSERT into %s VALUES (?, ?, ?, ?)" % table,
-                                   (pid, eid, lid, string))
+                    rows[table].append((pid, eid, lid, string))
 
             import_count += 1
 
-            if arg.verbose and (i+1)%10000 == 0:
-                print >> sys.stderr, '.',
+        flush_chunk()
 
         if arg.verbose:
+            report_progress(line_count, import_count, start_time)
             print >> sys.stderr, "done."
 
-        # create SQL indices
+        # create SQL indices. (These are created only after the data
+        # is loaded, which is considerably faster than maintaining
+        # them during the load.)
         if arg.verbose:
             print >> sys.stderr, "Creating indices ...",
+            index_start_time = datetime.now()
 
         for command in CREATE_INDEX_COMMANDS:
             try:
@@ -348,23 +553,44 @@ def main(argv):
                 return 1
 
         if arg.verbose:
-            print >> sys.stderr, "done."
+            print >> sys.stderr, "done (%.1f seconds)." % seconds_since(index_start_time)
+
+        # create full-text index
+        if arg.fts5:
+            if arg.verbose:
+                print >> sys.stderr, "Creating FTS5 index ...",
+
+            for command in CREATE_FTS_COMMANDS:
+                try:
+                    cursor.execute(command)
+                except sqlite.OperationalError, e:
+                    print >> sys.stderr, "Error creating FTS5 index (SQLite %s):" % sqlite.sqlite_version, e
+                    return 1
+
+            if arg.verbose:
+                print >> sys.stderr, "done."
 
         # wrap up SQL table creation
         connection.commit()
 
-        # create simstring DB
+        # create simstring DB (or n-gram index)
         if arg.verbose:
-            print >> sys.stderr, "Creating simstring DB ...",
+            print >> sys.stderr, "Creating %s DB ..." % index,
         
         try:
-            ssdb = simstring.writer(ssdbfn)
-            for row in cursor.execute(SELECT_SIMSTRING_STRINGS_COMMAND):
-                # encode as UTF-8 for simstring
-                s = row[0].encode('utf-8')
-                ssdb.insert(s)
-                simstring_count += 1
-            ssdb.close()
+            if arg.bulk:
+                # wait for the worker
+                put_to_worker(ss_worker, ss_strings, None)
+                simstring_count = get_from_worker(ss_worker, ss_results)
+                ss_worker.join()
+            else:
+                ssdb = open_ssdb(index, ssdbfn)
+                for row in cursor.execute(SELECT_SIMSTRING_STRINGS_COMMAND):
+                    # encode as UTF-8 for simstring
+                    s = row[0].encode('utf-8')
+                    ssdb.insert(s)
+                    simstring_count += 1
+                ssdb.close()
         except:
             print >> sys.stderr, "Error building simstring DB"
             raise
@@ -379,7 +605,7 @@ def main(argv):
 
     if arg.verbose:
         print >> sys.stderr
-        print >> sys.stderr, "Done in:", str(delta.seconds)+"."+str(delta.microseconds/10000), "seconds"
+        print >> sys.stderr, "Done in:", str(delta.seconds)+"."+str(delta.microseconds/10000), "seconds", "(%.0f lines/second)" % (line_count / max(seconds_since(start_time), 0.001))
     
     print "Done, imported %d entries (%d strings), skipped %d duplicate keys, skipped %d invalid lines" % (import_count, simstring_count, duplicate_count, error_count)
 
@@ -123,9 +123,10 @@ class Term:
     def __str__(self):
         return "%s (%s)" % (self.name, self.tid)
 
-def parse_obo(f, limit_prefixes=None, include_nameless=False):
-    all_terms = []
-    term_by_id = {}
+def iter_obo(f, limit_prefixes=None, include_nameless=False):
+    # generates the terms of the given OBO file one at a time, keeping
+    # only the IDs seen in memory (to skip duplicates).
+    seen_ids = set()
 
     # first non-space block is ontology info
     skip_block = True
@@ -248,11 +249,10 @@ def parse_obo(f, limit_prefixes=None, include_nameless=False):
                 if name is None and not include_nameless:
                     print >> sys.stderr, "Note: ignoring term without name (%s) on line %d" % (tid, ln)
                 else:
-                    if tid not in term_by_id:
-                        t = Term(tid, name, synonyms, definitions, comments,
-                                 is_a, part_of)
-                        all_terms.append(t)
-                        term_by_id[tid] = t
+                    if tid not in seen_ids:
+                        seen_ids.add(tid)
+                        yield Term(tid, name, synonyms, definitions, comments,
+                                   is_a, part_of)
                     else:
                         print >> sys.stderr, "Error: duplicate ID '%s'; discarding all but first definition" % tid
                 tid, prefix, name, synonyms, definitions, comments, is_a, part_of, obsolete = None, None, None, [], [], [], [], [], False
@@ -265,9 +265,84 @@ def parse_obo(f, limit_prefixes=None, include_nameless=False):
     assert tid is None
     assert name is None
     assert is_a == []
-    
+
+def parse_obo(f, limit_prefixes=None, include_nameless=False):
+    all_terms = list(iter_obo(f, limit_prefixes, include_nameless))
+    term_by_id = dict([(t.tid, t) for t in all_terms])
     return all_terms, term_by_id
 
+def case_normalize_term(t):
+    # FMA systematically capitalizes initial letter; WBbt has a mix
+    # of capitalization conventions; SAO capitalizes all words.
+    if t.obo_idspace() in ("FMA", "WBbt"):
+        t.case_normalize_initial()
+    elif t.obo_idspace() == "SAO":
+        t.case_normalize_all_words()
+
+def norm_db_line(t, synonyms=True, definitions=True, comments=False):
+    # returns the given term as a line in the input format of
+    # norm_db_init.py (without newline).
+    strs = []
+    strs.append("name:Name:"+t.name)
+    if synonyms:
+        for synstr, syntype in t.synonyms:
+            # never mind synonym type
+            #strs.append("name:synonym-"+syntype+':'+synstr)
+            strs.append("name:Synonym:"+synstr)
+    if definitions:
+        for d in t.defs:
+            strs.append("info:Definition:"+d.replace('\t', ' '))
+    if comments:
+        for c in t.comments:
+            strs.append("info:Comment:"+c.replace('\t', ' '))
+    # don't include ontology prefix in ID
+    id_ = t.tid.replace(t.obo_idspace()+':', '', 1)
+    return id_ + '\t' + '\t'.join(strs)
+
+def subtree_ids(f, roots, exclude=None):
+    # returns the IDs of the terms in the subtrees rooted at the given
+    # terms (names or IDs) of the given OBO file (all terms if roots
+    # is None), leaving out the subtrees rooted at the terms in
+    # exclude. Only IDs and is_a relations are kept in memory.
+    if exclude is None:
+        exclude = []
+    children = {}
+    root_ids, exclude_ids = [], []
+    for t in iter_obo(f):
+        for ptid, pname in t.is_a:
+            children.setdefault(ptid, []).append(t.tid)
+        if roots is None or t.tid in roots or t.name in roots:
+            root_ids.append(t.tid)
+        if t.tid in exclude or t.name in exclude:
+            exclude_ids.append(t.tid)
+
+    def descendants(tids, skip):
+        found = set()
+        stack = list(tids)
+        while stack:
+            tid = stack.pop()
+            if tid in found or tid in skip:
+                continue
+            found.add(tid)
+            stack.extend(children.get(tid, []))
+        return found
+
+    return descendants(root_ids, descendants(exclude_ids, set()))
+
+def iter_norm_db_lines(f, limit_prefixes=None, ids=None, case_normalize=True,
+                       synonyms=True, definitions=True, comments=False):
+    # generates the terms of the given OBO file as lines in the input
+    # format of norm_db_init.py, limited to the given ontology
+    # prefixes and IDs (see subtree_ids()) if not None.
+    for t in iter_obo(f):
+        if limit_prefixes and t.obo_idspace() not in limit_prefixes:
+            continue
+        if ids is not None and t.tid not in ids:
+            continue
+        if case_normalize:
+            case_normalize_term(t)
+        yield norm_db_line(t, synonyms, definitions, comments)
+
 def argparser():
     import argparse
 
@@ -363,13 +438,7 @@ def main(argv=None):
 
     if not arg.no_case_normalization:
         for t in all_terms:
-            # FMA systematically capitalizes initial letter; WBbt has
-            # a mix of capitalization conventions; SAO capitalizes all
-            # words.
-            if t.obo_idspace() in ("FMA", "WBbt"):
-                t.case_normalize_initial()
-            elif t.obo_idspace() == "SAO":
-                t.case_normalize_all_words()
+            case_normalize_term(t)
 
     print >> sys.stderr, "OK, parsed %d (non-obsolete) terms." % len(all_terms)
 
@@ -473,22 +542,8 @@ def main(argv=None):
             for t in root_stt:
                 if limit_prefixes and t.obo_idspace() not in limit_prefixes:
                     continue
-                strs = []
-                strs.append("name:Name:"+t.name)
-                if not arg.no_synonyms:
-                    for synstr, syntype in t.synonyms:
-                        # never mind synonym type
-                        #strs.append("name:synonym-"+syntype+':'+synstr)
-                        strs.append("name:Synonym:"+synstr)
-                if not arg.no_definitions:
-                    for d in t.defs:
-                        strs.append("info:Definition:"+d.replace('\t', ' '))
-                if arg.comments:
-                    for c in t.comments:
-                        strs.append("info:Comment:"+c.replace('\t', ' '))
-                # don't include ontology prefix in ID
-                id_ = t.tid.replace(t.obo_idspace()+':', '', 1) 
-                print id_ + '\t' + '\t'.join(strs)
+                print norm_db_line(t, not arg.no_synonyms,
+                                   not arg.no_definitions, arg.comments)
 #                 print "%s\t%s\t%s" % (n, tid, ntype)
         else:
             # separate the children of the root term in output
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Summarise the profiles of brat server requests stored when profiling
+# is enabled in the brat configuration (see PROFILE_SAMPLE_RATE in
+# config_template.py): the number and duration of the profiled
+# requests and the functions taking the most time, per action.
+
+from __future__ import with_statement
+
+import sys
+import json
+from os import listdir
+from os.path import dirname, join
+from pstats import Stats
+
+# assume script in brat tools/ directory, extend path to find profiling.py
+sys.path.append(join(dirname(__file__), '../server/src'))
+from profiling import (hot_functions, PROFILE_DIR_NAME, PROFILE_SUFFIX,
+        META_SUFFIX)
+
+def default_profile_dir():
+    # (Guessing we're in the brat tools/ directory...)
+    sys.path.append(join(dirname(__file__), '..'))
+    try:
+        from config import WORK_DIR
+        return join(WORK_DIR, PROFILE_DIR_NAME)
+    except ImportError:
+        print >> sys.stderr, "Warning: failed to determine brat work directory, using current instead."
+        return "."
+
+def argparser():
+    import argparse
+
+    ap=argparse.ArgumentParser(description="Summarise profiles of brat server requests by action")
+    ap.add_argument("-d", "--directory", default=None, help="Directory containing the profiles (default profiles/ in brat work directory)")
+    ap.add_argument("-n", "--top", default=20, type=int, help="Number of functions to list per action (default 20)")
+    ap.add_argument("-s", "--sort", default="tottime", choices=["tottime", "cumtime"], help="Order functions by own time (tottime, default) or time including callees (cumtime)")
+    ap.add_argument("-a", "--action", default=[], action="append", help="Only summarise given action (can be repeated)")
+    ap.add_argument("-c", "--collection", default=None, help="Only summarise requests for collections starting with given path")
+    return ap
+
+def read_profiles(directory, actions, collection):
+    # returns metadata of profiles, with the path of the profile added,
+    # grouped by action
+    by_action = {}
+    for fn in sorted(listdir(directory)):
+        if not fn.endswith(META_SUFFIX):
+            continue
+        base = join(directory, fn[:-len(META_SUFFIX)])
+        try:
+            with open(base + META_SUFFIX) as meta_file:
+                meta = json.load(meta_file)
+        except ValueError:
+            # incomplete, possibly still being written
+            continue
+        if actions and meta['action'] not in actions:
+            continue
+        if collection is not None and not (meta['collection'] or
+                '').startswith(collection):
+            continue
+        meta['path'] = base + PROFILE_SUFFIX
+        by_action.setdefault(meta['action'], []).append(meta)
+    return by_action
+
+def summarise(action, metas, top, sort, out=sys.stdout):
+    durations = sorted(m['duration'] for m in metas)
+    print >> out, "%s: %d requests, mean %.3fs, median %.3fs, max %.3fs" % (
+        action, len(durations), sum(durations)/len(durations),
+        durations[len(durations)//2], durations[-1])
+
+    stats = None
+    for meta in metas:
+        try:
+            if stats is None:
+                stats = Stats(meta['path'])
+            else:
+                stats.add(meta['path'])
+        except (IOError, EOFError):
+            print >> sys.stderr, "Warning: failed to read %s" % meta['path']
+    if stats is None:
+        return
+
+    print >> out, "  %8s %10s %10s  %s" % ("calls", "tottime", "cumtime",
+                                           "function")
+    for function, calls, tottime, cumtime in hot_functions(stats, top, sort):
+        print >> out, "  %8d %10.4f %10.4f  %s" % (calls, tottime, cumtime,
+                                                   function)
+    print >> out
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+
+    directory = args.directory
+    if directory is None:
+        directory = default_profile_dir()
+
+    try:
+        by_action = read_profiles(directory, set(args.action),
+                                  args.collection)
+    except OSError, e:
+        print >> sys.stderr, "Error reading profiles: %s" % e
+        return 1
+    if not by_action:
+        print >> sys.stderr, "No profiles found in %s" % directory
+        return 1
+
+    # slowest actions (by total time spent) first
+    for action, metas in sorted(by_action.items(),
+                                key=lambda a: -sum(m['duration'] for m in a[1])):
+        summarise(action, metas, args.top, args.sort)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))